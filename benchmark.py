@@ -0,0 +1,410 @@
+"""
+benchmark.py
+
+Reproducible benchmarks of cardiff ingest, flush and delivery. Each workload
+is generated from a fixed seed and run in its own process, driving
+Cardiff.process_data, Cardiff.snapshot, Backend.timer_values, the naming of
+metrics for delivery and each backend against local sinks that read and
+discard what they are sent.
+The results can be saved as a JSON baseline, and a run compared against the
+baseline exits with a non-zero status when a result regresses past the
+threshold.
+
+The AMQP backend is not benchmarked since it needs a broker. Metrics are named
+with Backend.metric_values, timer_metric_values and internal_values as the
+backends do. When flatdict is installed, naming them by flattening nested
+dicts with it, as the backends did before, is timed alongside and the names
+and values of both are compared.
+
+"""
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from cardiff.backends import base
+from cardiff.backends import graphite
+from cardiff.backends import influxdb
+from cardiff.backends import logger
+from cardiff.backends import statsd
+from cardiff.backends import upstream
+from cardiff import controller
+
+try:
+    import flatdict
+except ImportError:
+    flatdict = None
+
+BASELINE = 'benchmark.json'
+INTERVALS = 10
+SEED = 8125
+THRESHOLD = 0.2
+
+BACKENDS = ['graphite', 'graphite_pickle', 'influxdb', 'logger', 'statsd',
+            'upstream']
+
+# The number of keys per metric type, the lines in each flush interval, the
+# weight of each metric type and the number of lines packed in each packet
+WORKLOADS = {
+    'counters': {'keys': 1000, 'lines': 50000, 'mix': {'c': 1},
+                 'packing': 1},
+    'mixed': {'keys': 10000, 'lines': 100000,
+              'mix': {'c': 4, 'g': 2, 's': 1, 'ms': 3}, 'packing': 5},
+    'high_cardinality': {'keys': 100000, 'lines': 100000,
+                         'mix': {'c': 4, 'g': 3, 'ms': 3}, 'packing': 10},
+    'large_timers': {'keys': 100, 'lines': 100000, 'mix': {'ms': 1},
+                     'packing': 10}}
+
+
+class SinkHandler(SocketServer.BaseRequestHandler):
+    """Read and discard everything sent over a TCP connection"""
+    def handle(self):
+        while self.request.recv(65536):
+            pass
+
+
+class HTTPSinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Read and discard the body of each request over keep-alive connections,
+    standing in for an InfluxDB write endpoint.
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSink(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def sink(pipe):
+    """Run TCP, UDP and HTTP sinks on ephemeral local ports, sending the
+    ports back through the pipe.
+
+    :param multiprocessing.Connection pipe: The pipe to send the ports on
+
+    """
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), SinkHandler)
+    server.daemon_threads = True
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    http = HTTPSink(('127.0.0.1', 0), HTTPSinkHandler)
+    thread = threading.Thread(target=http.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pipe.send((server.server_address[1], udp.getsockname()[1],
+               http.server_address[1]))
+    server.serve_forever()
+
+
+def create_backends(names, interval, tcp_port, udp_port, http_port):
+    """Return the backends to benchmark, delivering to the sinks
+
+    :param list names: The backends to create
+    :param int interval: The flush interval
+    :param int tcp_port: The TCP sink port
+    :param int udp_port: The UDP sink port
+    :param int http_port: The HTTP sink port
+    :rtype: list
+
+    """
+    factories = {
+        'graphite': lambda: graphite.GraphiteBackend(
+            {'host': '127.0.0.1', 'port': tcp_port}, interval),
+        'graphite_pickle': lambda: graphite.GraphiteBackend(
+            {'host': '127.0.0.1', 'port': tcp_port,
+             'format': graphite.PICKLE}, interval),
+        'influxdb': lambda: influxdb.InfluxDBBackend(
+            {'host': '127.0.0.1', 'port': http_port}, interval),
+        'logger': lambda: logger.LoggerBackend({}, interval),
+        'statsd': lambda: statsd.StatsdBackend(
+            {'host': '127.0.0.1', 'port': udp_port}, interval),
+        'upstream': lambda: upstream.UpstreamBackend(
+            {'host': '127.0.0.1', 'port': tcp_port}, interval)}
+    return [(name, factories[name]()) for name in names]
+
+
+def flatdict_names(backend, counters, timers, int_counters):
+    """Name the values by flattening them nested by type with flatdict,
+    the way the backends did before naming each series once.
+
+    :param cardiff.backends.base.Backend backend: Calculates timer values
+    :param dict counters: The counter values
+    :param dict timers: The timer values
+    :param dict int_counters: The internal counters
+    :rtype: dict
+
+    """
+    internal = dict()
+    for (metric_type, host, name), value in int_counters.iteritems():
+        internal.setdefault(metric_type, dict()).setdefault(
+            host, dict())[name] = value
+    flat = flatdict.FlatDict({
+        controller.METRICS_COUNTER: dict([(str(key), value) for key, value
+                                          in counters.iteritems()]),
+        controller.METRICS_TIMER: dict([(str(key), value) for key, value
+                                        in backend.timer_values(
+                                            timers).iteritems()]),
+        controller.METRICS_INTERNAL: {controller.METRICS_COUNTER: internal}},
+        '.')
+    return dict([(key, flat[key]) for key in flat.keys()])
+
+
+def names(backend, counters, timers, int_counters):
+    """Name the values the way the backends do as they deliver them
+
+    :param cardiff.backends.base.Backend backend: The backend naming them
+    :param dict counters: The counter values
+    :param dict timers: The timer values
+    :param dict int_counters: The internal counters
+    :rtype: list
+
+    """
+    internal = '%s.%s' % (controller.METRICS_INTERNAL,
+                          controller.METRICS_COUNTER)
+    return list(itertools.chain(
+        backend.metric_values(counters, controller.METRICS_COUNTER),
+        backend.timer_metric_values(timers, controller.METRICS_TIMER),
+        backend.internal_values(int_counters, internal)))
+
+
+def generate(workload, seed):
+    """Return the packets of one flush interval of the workload
+
+    :param dict workload: The workload definition
+    :param int seed: The seed for the random number generator
+    :rtype: list
+
+    """
+    rng = random.Random(seed)
+    types = list()
+    for metric_type, weight in sorted(workload['mix'].items()):
+        types += [metric_type] * weight
+    lines = list()
+    for _line in xrange(workload['lines']):
+        metric_type = rng.choice(types)
+        key = 'bench.%s.key_%i' % (metric_type, rng.randrange(workload['keys']))
+        if metric_type == 'c':
+            value = rng.randint(1, 10)
+        elif metric_type == 'g':
+            value = rng.randint(0, 1000)
+        elif metric_type == 's':
+            value = rng.randint(0, 100)
+        else:
+            value = '%.3f' % rng.lognormvariate(3, 1)
+        lines.append('%s:%s|%s' % (key, value, metric_type))
+    packing = workload['packing']
+    return ['\n'.join(lines[offset:offset + packing])
+            for offset in xrange(0, len(lines), packing)]
+
+
+def percentile(values, percent):
+    """Return the nearest rank percentile of the values
+
+    :param list values: The values
+    :param int percent: The percentile
+    :rtype: float
+
+    """
+    values = sorted(values)
+    return values[max(0, int(round(len(values) * percent / 100.0)) - 1)]
+
+
+def run_workload(name, workload, backend_names, intervals, queue):
+    """Run the workload, putting the results on the queue
+
+    :param str name: The workload name
+    :param dict workload: The workload definition
+    :param list backend_names: The backends to deliver to
+    :param int intervals: The number of flush intervals to run
+    :param multiprocessing.Queue queue: The queue to put the results on
+
+    """
+    parent, child = multiprocessing.Pipe()
+    sinks = multiprocessing.Process(target=sink, args=(child,))
+    sinks.daemon = True
+    sinks.start()
+    tcp_port, udp_port, http_port = parent.recv()
+
+    interval = controller.FLUSH_INTERVAL
+    cardiff = controller.standalone(interval)
+    backends = create_backends(backend_names, interval, tcp_port, udp_port,
+                               http_port)
+    calculator = base.Backend({}, interval)
+    namer = base.Backend({}, interval)
+
+    packets = [generate(workload, SEED + offset)
+               for offset in xrange(intervals)]
+    ingest, flush, timer_values = 0.0, list(), list()
+    named = {'cardiff': list(), 'flatdict': list()}
+    delivery = dict([(backend, list()) for backend in backend_names])
+    errors = dict()
+    for offset in xrange(intervals):
+        start_time = time.time()
+        for packet in packets[offset]:
+            cardiff.process_data(packet)
+        ingest += time.time() - start_time
+
+        start_time = time.time()
+        stats = cardiff.snapshot()
+        flush.append((time.time() - start_time) * 1000)
+
+        start_time = time.time()
+        calculated = calculator.timer_values(stats[4])
+        timer_values.append((time.time() - start_time) * 1000)
+
+        start_time = time.time()
+        values = names(namer, stats[1], stats[4], stats[5])
+        named['cardiff'].append((time.time() - start_time) * 1000)
+        if flatdict:
+            start_time = time.time()
+            expected = flatdict_names(calculator, stats[1], stats[4],
+                                      stats[5])
+            named['flatdict'].append((time.time() - start_time) * 1000)
+            if len(values) != len(expected) or dict(values) != expected:
+                errors['naming'] = 'output differs from flatdict'
+
+        for backend_name, backend in backends:
+            start_time = time.time()
+            try:
+                backend.deliver(*stats)
+            except Exception as error:
+                errors[backend_name] = '%s: %s' % (error.__class__.__name__,
+                                                   error)
+            delivery[backend_name].append((time.time() - start_time) * 1000)
+    sinks.terminate()
+
+    results = {'ingest.packets_per_sec': sum(len(interval_packets)
+                                             for interval_packets in packets)
+                                         / ingest,
+               'ingest.lines_per_sec': workload['lines'] * intervals / ingest,
+               'peak_rss_kb': resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss}
+    for percent in [50, 90, 99]:
+        results['flush.p%i_ms' % percent] = percentile(flush, percent)
+        results['timer_values.p%i_ms' % percent] = percentile(timer_values,
+                                                              percent)
+        for method in named:
+            if named[method]:
+                results['naming.%s.p%i_ms' % (method, percent)] = \
+                    percentile(named[method], percent)
+        for backend_name in backend_names:
+            if backend_name not in errors:
+                results['deliver.%s.p%i_ms' % (backend_name, percent)] = \
+                    percentile(delivery[backend_name], percent)
+    queue.put((name, results, errors))
+
+
+def compare(results, baseline, threshold):
+    """Print each result against its baseline, returning the number of
+    results that regressed past the threshold. Rates regress when they fall
+    and everything else regresses when it rises.
+
+    :param dict results: The results by workload
+    :param dict baseline: The baseline results by workload
+    :param float threshold: The allowed ratio of change
+    :rtype: int
+
+    """
+    regressions = 0
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            value = results[name][metric]
+            expected = baseline.get(name, {}).get(metric)
+            if not expected:
+                print '%-18s %-30s %14.3f' % (name, metric, value)
+                continue
+            change = (value - expected) / float(expected)
+            if metric.endswith('_per_sec'):
+                regressed = change < -threshold
+            else:
+                regressed = change > threshold
+            regressions += regressed
+            print '%-18s %-30s %14.3f %14.3f %+7.1f%% %s' % (
+                name, metric, value, expected, change * 100,
+                'REGRESSED' if regressed else 'ok')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='The JSON baseline file')
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='The allowed ratio of regression')
+    parser.add_argument('--intervals', type=int, default=INTERVALS,
+                        help='The flush intervals to run per workload')
+    parser.add_argument('--workload', action='append',
+                        choices=sorted(WORKLOADS),
+                        help='A workload to run, defaults to all')
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='A backend to deliver to, defaults to all')
+    args = parser.parse_args()
+
+    # Backends log at INFO, format the records without writing them out
+    logging.getLogger('cardiff').addHandler(logging.NullHandler())
+    logging.getLogger('cardiff').setLevel(logging.INFO)
+    logging.getLogger('cardiff').propagate = False
+
+    results, failures = dict(), 0
+    queue = multiprocessing.Queue()
+    for name in args.workload or sorted(WORKLOADS):
+        process = multiprocessing.Process(
+            target=run_workload,
+            args=(name, WORKLOADS[name], args.backend or BACKENDS,
+                  args.intervals, queue))
+        process.start()
+        name, results[name], errors = queue.get()
+        process.join()
+        for backend_name in sorted(errors):
+            print 'ERROR: %s %s failed: %s' % (name, backend_name,
+                                                errors[backend_name])
+        failures += len(errors)
+
+    # A failed backend is missing from the results, so fail the run rather
+    # than compare or save the results without it
+    if failures:
+        compare(results, {}, args.threshold)
+        print '%i benchmarks failed' % failures
+        sys.exit(1)
+
+    if args.save:
+        with open(args.baseline, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+        compare(results, {}, args.threshold)
+        print 'Saved the baseline to %s' % args.baseline
+        return
+
+    try:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+    except IOError:
+        baseline = dict()
+        print 'No baseline at %s, run with --save to create it' % args.baseline
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print '%i results regressed by more than %i%%' % (
+            regressions, args.threshold * 100)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+admin.py
+
+"""
+import fnmatch
+import heapq
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTERS = 'counters'
+GAUGES = 'gauges'
+SETS = 'sets'
+TIMERS = 'timers'
+TYPES = [COUNTERS, GAUGES, SETS, TIMERS]
+
+TOP = 10
+
+HELP = ['Commands:',
+        '  backends                 Backend health',
+        '  counters|gauges|sets|timers [glob]',
+        '                           Dump the current values',
+        '  delcounters|delgauges|delsets|deltimers <key> [<key> ...]',
+        '                           Delete keys',
+        '  health                   Report that cardiff is up',
+        '  history <glob> [seconds] Recent values from the history',
+        '  hot [n]                  The most updated keys this interval',
+        '  keys                     Key counts by type',
+        '  memory                   Start or stop memory reports per flush',
+        '  profile [seconds]        Start or stop profiling',
+        '  stages                   Per-stage latency histograms',
+        '  stats                    General stats',
+        '  top [n]                  The timers with the most samples',
+        '  quit                     Close the connection']
+
+
+class Admin(object):
+    """Text commands for the admin server that inspect and modify the live
+    state of the controller without waiting for a flush. Commands return an
+    iterator of output lines, and dumps take a shallow copy of the values
+    up front but format them lazily, so that the server can write them in
+    batches between IOLoop events.
+
+    """
+    def __init__(self, controller):
+        """Create a new admin command handler
+
+        :param cardiff.controller.Cardiff controller: The controller
+
+        """
+        self.controller = controller
+        self.commands = {'backends': self.backends,
+                         'health': self.health,
+                         'help': self.help,
+                         'history': self.history,
+                         'hot': self.hot,
+                         'keys': self.keys,
+                         'memory': self.memory,
+                         'profile': self.profile,
+                         'stages': self.stages,
+                         'stats': self.stats,
+                         'top': self.top}
+        for metric_type in TYPES:
+            self.commands[metric_type] = self.dumper(metric_type)
+            self.commands['del%s' % metric_type] = self.deleter(metric_type)
+
+    def execute(self, line):
+        """Return an iterator of the output lines of a command
+
+        :param str line: The command line
+        :rtype: iter
+
+        """
+        parts = line.split()
+        if not parts:
+            return iter(())
+        try:
+            command = self.commands[parts[0].lower()]
+        except KeyError:
+            return iter(['ERROR: Unknown command %s' % parts[0]])
+        try:
+            return command(*parts[1:])
+        except (TypeError, ValueError) as error:
+            return iter(['ERROR: %s' % error])
+
+    def backends(self):
+        """Return the delivery health of each backend. The backend objects
+        of backends delivered to by workers are not the ones delivering, so
+        the status of their worker process is reported instead of their
+        exception counts.
+
+        :rtype: list
+
+        """
+        workers = self.controller.workers.workers \
+            if self.controller.workers else dict()
+        lines = list()
+        for backend in self.controller.backends:
+            health = self.controller.backend_health.get(backend.name, {})
+            worker = workers.get(backend.name)
+            if worker:
+                status = 'worker=%s pid=%s pending=%i exits=%i ' \
+                    'last_exit=%s' % ('alive' if worker.alive
+                                      else 'restarting', worker.pid,
+                                      len(worker.pending), worker.exits,
+                                      worker.last_exit)
+            else:
+                status = 'exceptions=%s last_exception=%s' % \
+                    (backend.exceptions, backend.last_exception)
+            lines.append('%s: %s last_flush=%s duration_ms=%.3f errors=%s '
+                         'last_error=%s' %
+                         (backend.name, status,
+                          health.get('last_flush', 0),
+                          health.get('duration', 0),
+                          health.get('errors', 0),
+                          health.get('last_error')))
+        return lines
+
+    def deleter(self, metric_type):
+        """Return the command that deletes keys of the metric type
+
+        :param str metric_type: The metric type
+        :rtype: method
+
+        """
+        def delete(*keys):
+            if not keys:
+                raise ValueError('No keys specified')
+            values = getattr(self.controller, metric_type)
+            retention = self.controller.retention
+            lines = list()
+            for key in keys:
+                value = self.find(key)
+                if value is None:
+                    lines.append('ERROR: Unknown key %s' % key)
+                    continue
+                found = values.pop(value.id, None) is not None
+                if retention and metric_type == COUNTERS:
+                    found = retention.discard_counter(value.id) or found
+                elif retention and metric_type == GAUGES:
+                    found = retention.discard_gauge(value.id) or found
+                if found:
+                    LOGGER.info('Deleted %s %s', metric_type, key)
+                    lines.append('deleted: %s' % key)
+                else:
+                    lines.append('ERROR: No %s value for %s' %
+                                 (metric_type, key))
+            return lines
+        return delete
+
+    def dumper(self, metric_type):
+        """Return the command that dumps values of the metric type
+
+        :param str metric_type: The metric type
+        :rtype: method
+
+        """
+        def dump(pattern=None):
+            return self.dump(metric_type, self.values(metric_type).items(),
+                             pattern)
+        return dump
+
+    def dump(self, metric_type, items, pattern=None):
+        """Iterate over the values, yielding a line for each series that
+        matches the glob pattern.
+
+        :param str metric_type: The metric type
+        :param list items: The (series id, value) items to dump
+        :param str pattern: The optional glob to filter series by
+        :rtype: iter
+
+        """
+        lookup = self.controller.registry.series
+        for series_id, value in items:
+            key = lookup[series_id]
+            if key is None:
+                continue
+            if pattern and not fnmatch.fnmatchcase(key, pattern):
+                continue
+            if metric_type == SETS:
+                value = 'members=%i' % len(value)
+            elif metric_type == TIMERS:
+                value = 'samples=%i weight=%s' % (len(value), value.weight)
+            yield '%s: %s' % (key, value)
+
+    def find(self, key):
+        """Return the series for a key in canonical form, such as
+        name;tag=value;tag, or None if it is not registered.
+
+        :param str key: The canonical key
+        :rtype: cardiff.series.Series or None
+
+        """
+        parts = key.split(';')
+        tags = tuple(sorted([tuple(tag.split('=', 1)) if '=' in tag
+                             else (tag, '') for tag in parts[1:]]))
+        return self.controller.registry.canonical.get((parts[0], tags))
+
+    @staticmethod
+    def health():
+        """Return the health of the node
+
+        :rtype: list
+
+        """
+        return ['health: up']
+
+    @staticmethod
+    def help():
+        """Return the list of commands
+
+        :rtype: list
+
+        """
+        return HELP
+
+    def history(self, pattern, seconds=None):
+        """Return the values of the series matching the glob over the last
+        seconds, defaulting to the retention of the finest history tier.
+
+        :param str pattern: The glob
+        :param int seconds: The number of seconds of values to return
+        :rtype: iter
+
+        """
+        values = self.controller.query_history(
+            pattern, -int(seconds) if seconds else None)
+        if values is None:
+            return iter(['ERROR: History is not enabled'])
+        return ('%s: %s' % (name, ' '.join(['%i=%s' % (timestamp, value)
+                                            for timestamp, value
+                                            in values[name]]))
+                for name in sorted(values))
+
+    def hot(self, count=None):
+        """Return the most updated keys in the interval with their estimated
+        update count and the possible overestimate.
+
+        :param int count: The number of keys to return
+        :rtype: list
+
+        """
+        if self.controller.topk is None:
+            return ['ERROR: Heavy hitter tracking is not enabled']
+        lookup = self.controller.registry.series
+        return ['%s: updates=%i error=%i' % (lookup[series_id], value, error)
+                for series_id, value, error in self.controller.topk.top(
+                    int(count or self.controller.topk_size))
+                if lookup[series_id] is not None]
+
+    def keys(self):
+        """Return the number of keys of each metric type
+
+        :rtype: list
+
+        """
+        lines = ['%s: %i' % (metric_type, len(self.values(metric_type)))
+                 for metric_type in TYPES]
+        lines.append('series: %i' % len(self.controller.registry))
+        return lines
+
+    def memory(self):
+        """Start or stop comparing memory between flushes
+
+        :rtype: list
+
+        """
+        tracer = self.controller.memory_tracer
+        tracer.toggle()
+        if tracer.active:
+            return ['memory: reporting to %s on each flush' % tracer.directory]
+        return ['memory: stopped']
+
+    def profile(self, duration=None):
+        """Start profiling for the duration or stop profiling early
+
+        :param int duration: The number of seconds to profile for
+        :rtype: list
+
+        """
+        profiler = self.controller.profiler
+        if profiler.active:
+            return ['profile: wrote %s' % profiler.stop()]
+        profiler.start(int(duration) if duration else None)
+        return ['profile: started']
+
+    def stages(self):
+        """Return the latency histogram summary of each stage for the current
+        interval and the lifetime of the process.
+
+        :rtype: list
+
+        """
+        lines = list()
+        for histogram in self.controller.instruments.histograms:
+            for period, values in [('interval', histogram.summary()),
+                                   ('lifetime',
+                                    histogram.lifetime_summary())]:
+                lines.append('%s %s: %s' % (
+                    histogram.name, period,
+                    ' '.join(['%s=%s' % (key, round(values[key], 3))
+                              for key in sorted(values)])))
+        return lines
+
+    def stats(self):
+        """Return general stats about the node
+
+        :rtype: list
+
+        """
+        controller = self.controller
+        lines = ['uptime: %i' % (time.time() - controller.start_time),
+                 'series: %i' % len(controller.registry)]
+        if controller.retention:
+            lines.append('retained_gauges: %i' %
+                         len(controller.retention.gauge_values))
+        if controller.shedder:
+            lines.append('sample_rate: %.3f' % controller.shedder.rate)
+        return lines
+
+    def top(self, count=TOP):
+        """Return the timers holding the most samples
+
+        :param int count: The number of timers to return
+        :rtype: iter
+
+        """
+        items = heapq.nlargest(int(count),
+                               self.controller.timers.iteritems(),
+                               key=lambda item: len(item[1]))
+        return self.dump(TIMERS, items)
+
+    def values(self, metric_type):
+        """Return the current values of the metric type keyed by series id,
+        including retained gauges that have not been updated in the
+        interval.
+
+        :param str metric_type: The metric type
+        :rtype: dict
+
+        """
+        values = getattr(self.controller, metric_type)
+        if metric_type == GAUGES and self.controller.retention:
+            gauges = dict(self.controller.retention.gauge_values)
+            gauges.update(values)
+            return gauges
+        return values
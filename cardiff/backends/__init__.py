@@ -20,6 +20,13 @@ def create(config, flush_interval):
         from cardiff.backends import amqp
         backends.append(amqp.AMQPBackend(amqp_config, flush_interval))
 
+    capture_config = config.get('capture', dict())
+    if capture_config.get('enabled', False):
+        LOGGER.info('Creating CaptureBackend')
+        from cardiff.backends import capture
+        backends.append(capture.CaptureBackend(capture_config,
+                                               flush_interval))
+
     graphite_config = config.get('graphite', dict())
     if graphite_config.get('enabled', False):
         LOGGER.info('Creating GraphiteBackend')
@@ -27,12 +34,26 @@ def create(config, flush_interval):
         backends.append(graphite.GraphiteBackend(graphite_config,
                                                  flush_interval))
 
+    influxdb_config = config.get('influxdb', dict())
+    if influxdb_config.get('enabled', False):
+        LOGGER.info('Creating InfluxDBBackend')
+        from cardiff.backends import influxdb
+        backends.append(influxdb.InfluxDBBackend(influxdb_config,
+                                                 flush_interval))
+
     logger_config = config.get('logger', dict())
     if logger_config.get('enabled', False):
         LOGGER.info('Creating LoggerBackend')
         from cardiff.backends import logger
         backends.append(logger.LoggerBackend(logger_config, flush_interval))
 
+    prometheus_config = config.get('prometheus', dict())
+    if prometheus_config.get('enabled', False):
+        LOGGER.info('Creating PrometheusBackend')
+        from cardiff.backends import prometheus
+        backends.append(prometheus.PrometheusBackend(prometheus_config,
+                                                     flush_interval))
+
     statsd_config = config.get('statsd', dict())
     if statsd_config.get('enabled', False):
         LOGGER.info('Creating StatsdBackend')
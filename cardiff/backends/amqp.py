@@ -1,15 +1,13 @@
 import datetime
-import flatdict
 import logging
 import rmqid
 import time
 
-flatdict.FlatDict.DELIMITER = '.'
-
 LOGGER = logging.getLogger(__name__)
 
 from cardiff.backends import base
 from cardiff import controller
+from cardiff import series
 
 
 BACKEND = 'backend'
@@ -80,87 +78,110 @@ class AMQPBackend(base.Backend):
         start_time = time.time()
         timestamp = datetime.datetime.fromtimestamp(timestamp)
 
-        # Calculate any timer values
-        timer_values = self.flatten(self.timer_values(timers))
-
         with rmqid.Connection(self.amqp_uri) as conn:
             with conn.channel() as channel:
-                self.send_counters(channel, timestamp, counters,
-                                   self.counter_prefix)
-                self.send_gauges(channel, timestamp, gauges,
-                                 self.gauge_prefix)
-                self.send_timers(channel, timestamp, timer_values,
-                                 self.timer_prefix)
+                self.publish(channel, controller.METRICS_COUNTER, timestamp,
+                             self.series_items(counters, self.counter_prefix))
+                self.publish(channel, controller.METRICS_GAUGE, timestamp,
+                             self.series_items(gauges, self.gauge_prefix))
+                self.publish(channel, controller.METRICS_COUNTER, timestamp,
+                             self.timer_items(timers, self.timer_prefix))
                 self.send_internal_stats(channel, start_time, int_counters,
                                          int_gauges, int_timers, timestamp)
 
-
     def send_internal_stats(self, channel, start_time, counters,
                             gauges, timers, timestamp):
         """Send the internal cardiff stats to Graphite. By default this will be
         in the cardiff.graphite
 
-        :param start_time:
-        :param counters:
-        :param gauges:
-        :param timers:
+        :param float start_time: The time delivery started
+        :param dict counters: Internal counters
+        :param dict gauges: Internal gauges
+        :param dict timers: Internal timers
+        :param datetime timestamp: The timestamp for the metrics
         :rtype: None
 
         """
         last_flush = int(time.time())
 
-        values = flatdict.FlatDict({AMQP: {EXCEPTIONS: self.exceptions}})
-        counters[controller.METRICS_BACKEND][self.hostname] = values
-
-        flat_timers = flatdict.FlatDict()
-        for key in timers:
-            flat_timers[key] = flatdict.FlatDict()
-            for host in timers[key]:
-                flat_timers[host] = self.timer_values(timers[key][host])
-
-        values = flatdict.FlatDict({AMQP: {
-            LAST_EXCEPTION: self.last_exception,
-            LAST_FLUSH: last_flush,
-            TIME_SPENT: (last_flush - start_time) * 1000
-        }})
-
-        gauges[controller.METRICS_BACKEND][self.hostname] = values
-
-        self.send_counters(channel, timestamp, counters,
-                           '%s.%s' % (controller.METRICS_INTERNAL,
-                                      self.counter_prefix))
-        self.send_gauges(channel, timestamp, gauges,
-                         '%s.%s' % (controller.METRICS_INTERNAL,
-                                    self.gauge_prefix))
-        self.send_timers(channel, timestamp, flat_timers,
-                         '%s.%s' % (controller.METRICS_INTERNAL,
-                                    self.timer_prefix))
+        counters = dict(counters)
+        counters[self.internal_key(EXCEPTIONS)] = self.exceptions
+
+        gauges = dict(gauges)
+        gauges[self.internal_key(LAST_EXCEPTION)] = self.last_exception
+        gauges[self.internal_key(LAST_FLUSH)] = last_flush
+        gauges[self.internal_key(TIME_SPENT)] = (last_flush -
+                                                 start_time) * 1000
+
+        self.publish(channel, controller.METRICS_COUNTER, timestamp,
+                     self.internal_items(
+                         self.internal_values(counters, '%s.%s' % (
+                             controller.METRICS_INTERNAL,
+                             self.counter_prefix))))
+        self.publish(channel, controller.METRICS_GAUGE, timestamp,
+                     self.internal_items(
+                         self.internal_values(gauges, '%s.%s' % (
+                             controller.METRICS_INTERNAL,
+                             self.gauge_prefix))))
+        self.publish(channel, controller.METRICS_COUNTER, timestamp,
+                     self.internal_items(
+                         self.internal_timer_values(timers, '%s.%s' % (
+                             controller.METRICS_INTERNAL,
+                             self.timer_prefix))))
         self.exceptions = 0
 
-    def get_rmqid_message(self, channel, metric_type, value, timestamp):
-        """
+    def get_rmqid_message(self, channel, metric_type, value, timestamp,
+                          tags=None):
+        """Return a message for the metric value, carrying any tags as
+        message headers.
 
         :param rmqid.Channel channel:
-        :param str key:
+        :param str metric_type:
         :param int or float value:
         :param datetime timestamp:
+        :param tuple tags:
         :return: rmqid.Message
 
         """
-        return rmqid.Message(channel, str(value),
-                             {'app_id': 'cardiff',
-                              'content-type': 'text/plain',
-                              'timestamp': timestamp,
-                              'message_type': metric_type})
+        properties = {'app_id': 'cardiff',
+                      'content-type': 'text/plain',
+                      'timestamp': timestamp,
+                      'message_type': metric_type}
+        if tags:
+            properties['headers'] = dict(tags)
+        return rmqid.Message(channel, str(value), properties)
+
+    def format_internal_name(self, prefix, key):
+        """Return the routing key for an internal stat key
+
+        :param str prefix: The key prefix (internal data type)
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return self.key(prefix, '.'.join(key))
 
-    def flatten(self, values):
-        """Return a nested dict as a flat dict.
+    @staticmethod
+    def internal_items(metrics):
+        """Iterate over (name, value) tuples, yielding the name, the empty
+        tags of internal stats and the value.
 
-        :param dict values: The nested dict to flatten
-        :rtype: dict
+        :param list metrics: The internal stat names and values
+        :rtype: iter
 
         """
-        return flatdict.FlatDict(values).as_dict()
+        for name, value in metrics:
+            yield name, (), value
+
+    def internal_key(self, name):
+        """Return the internal stats key for a stat about this backend
+
+        :param str name: The stat name
+        :rtype: tuple
+
+        """
+        return controller.METRICS_BACKEND, self.hostname, '%s.%s' % (AMQP,
+                                                                     name)
 
     def key(self, prefix, key):
         """Return the properly formatted key for the given type prefix and
@@ -173,35 +194,57 @@ class AMQPBackend(base.Backend):
         """
         return '%s.%s.%s' % (self.prefix, prefix, key)
 
-    def send_counters(self, channel, timestamp, counters, prefix):
-        flat_values = flatdict.FlatDict(counters)
-        for key in flat_values.keys():
-            if flat_values[key] is None:
-                flat_values[key] = 0
-            routing_key = self.key(prefix, key)
-            message = self.get_rmqid_message(channel,
-                                             controller.METRICS_COUNTER,
-                                             flat_values[key],
-                                             timestamp)
-            message.publish(self.exchange, routing_key)
+    def format_name(self, prefix, key):
+        """Return the routing key for the metric key, tags are carried in the
+        message headers.
 
-    def send_gauges(self, channel, timestamp, gauges, prefix):
-        flat_values = flatdict.FlatDict(gauges)
-        for key in flat_values.keys():
-            if flat_values[key] is None:
-                flat_values[key] = 0
-            routing_key = self.key(prefix, key)
-            message = self.get_rmqid_message(channel,
-                                             controller.METRICS_GAUGE,
-                                             flat_values[key],
-                                             timestamp)
-            message.publish(self.exchange, routing_key)
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: str
 
-    def send_timers(self, channel, timestamp, timers, prefix):
-        for key in timers.keys():
-            routing_key = self.key(prefix, key)
-            message = self.get_rmqid_message(channel,
-                                             controller.METRICS_COUNTER,
-                                             timers[key],
-                                             timestamp)
+        """
+        return self.key(prefix, series.name(key))
+
+    def publish(self, channel, metric_type, timestamp, items):
+        """Publish a message for each of the (routing key, tags, value) items
+
+        :param rmqid.Channel channel: The channel to publish on
+        :param str metric_type: The metric type
+        :param datetime timestamp: The timestamp for the metrics
+        :param iter items: The routing keys, tags and values to publish
+
+        """
+        for routing_key, tags, value in items:
+            if value is None:
+                value = 0
+            message = self.get_rmqid_message(channel, metric_type, value,
+                                             timestamp, tags)
             message.publish(self.exchange, routing_key)
+
+    def series_items(self, values, prefix):
+        """Iterate over values keyed by series, yielding the cached routing
+        key, the tags and the value.
+
+        :param dict values: The values to publish
+        :param str prefix: The key prefix (data type)
+        :rtype: iter
+
+        """
+        for key, value in values.iteritems():
+            yield self.metric_name(prefix, key), series.tags(key), value
+
+    def timer_items(self, timers, prefix):
+        """Iterate over timers keyed by series, yielding the cached routing
+        key, the tags and the value for each calculated timer value.
+
+        :param dict timers: The timers to publish
+        :param str prefix: The key prefix (data type)
+        :rtype: iter
+
+        """
+        for key, timer in timers.iteritems():
+            values = self.calc_timer_values(timer)
+            names = self.timer_names(prefix, key, values)
+            tags = series.tags(key)
+            for stat in values:
+                yield names[stat], tags, values[stat]
@@ -1,10 +1,53 @@
+import itertools
 import logging
 import math
 
 from cardiff import controller
+from cardiff import series
 
 LOGGER = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536
+MAX_INTERNAL_NAMES = 10000
+
+
+def batches(values, size):
+    """Iterate over lists of up to size items taken from an iterable, so that
+    output can be encoded a batch at a time as it is produced.
+
+    :param iter values: The items to batch
+    :param int size: The maximum number of items in a batch
+    :rtype: iter
+
+    """
+    values = iter(values)
+    while True:
+        batch = list(itertools.islice(values, size))
+        if not batch:
+            return
+        yield batch
+
+
+def chunks(lines, size=CHUNK_SIZE, separator='\n'):
+    """Iterate over the lines joined by the separator into strings of at most
+    size bytes. A line longer than the size is yielded on its own.
+
+    :param iter lines: The lines to join
+    :param int size: The maximum size of a chunk in bytes
+    :param str separator: The separator to join lines with
+    :rtype: iter
+
+    """
+    chunk, length = list(), 0
+    for line in lines:
+        if chunk and length + len(separator) + len(line) > size:
+            yield separator.join(chunk)
+            chunk, length = list(), 0
+        length += len(line) + (len(separator) if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        yield separator.join(chunk)
+
 
 class Backend(object):
     """Base backend class implements the contract with the controller and
@@ -13,6 +56,10 @@ class Backend(object):
     """
     name = 'base'
 
+    # False for backends that must be delivered to in the main process, such
+    # as those serving requests on the IOLoop
+    worker = True
+
     def __init__(self, config, interval):
         """Create a new backend object to emit stats with
 
@@ -24,11 +71,15 @@ class Backend(object):
         self.hostname = controller.hostname()
         self.exceptions = 0
         self.last_exception = 0
+        self.internal_names = dict()
+        self.names = dict()
+        self.timer_stat_names = dict()
 
     def deliver(self, timestamp, counters, gauges, sets, timers,
                 int_counters, int_gauges, int_timers):
         """Invoked by the core cardiff controller when there are stats to
-        publish.
+        publish. The values are shared with the other backends and must not
+        be modified.
 
         :param float timestamp: The timestamp for the metrics
         :param dict counters: Counters to report
@@ -53,16 +104,20 @@ class Backend(object):
         if not set_data.keys():
             return {'count': 0, 'count_ps': 0}
 
-        keys = set_data.keys().sort()
+        keys = sorted(set_data)
         hist_data = dict()
         for value in keys:
-            key = '%i' % (value * 1000)
+            # Members are strings and only numeric members are bucketed
+            try:
+                key = '%i' % (float(value) * 1000)
+            except ValueError:
+                continue
             if key not in hist_data:
                 hist_data[key] = 0
             hist_data[key] += 1
 
         return {'count': len(keys),
-                'count_ps': len(keys) / self.interval,
+                'count_ps': float(len(keys)) / self.interval,
                 'histogram': hist_data,
                 'values': set_data}
 
@@ -84,13 +139,15 @@ class Backend(object):
                     '95th': 0,
                     '90th': 0}
 
-        # Sort the values for the min/max/median/percentile values
-        timer.sort()
-
-        # Get the count and the sum of the values
-        count = len(timer)
+        # Get the count and the sum of the values, the count being the
+        # number of timings represented if the values were sampled
+        samples = len(timer)
+        count = getattr(timer, 'weight', samples)
         total = sum(timer)
 
+        # Sort the values for the min/max/median/percentile values
+        timer = sorted(timer)
+
         #hist_data = dict()
         #for value in timer:
         #    key = '%i' % (value * 1000)
@@ -104,12 +161,167 @@ class Backend(object):
                 #'histogram_ms': hist_data,
                 'min': timer[0],
                 'max': timer[-1],
-                'mean': total / count,
+                'mean': total / samples,
                 'total': total,
                 'median': self.median(timer),
                 '95th': self.percentile(timer, .95),
                 '90th': self.percentile(timer, .90)}
 
+    def format_name(self, prefix, key):
+        """Return the fully qualified output name for the metric key under
+        the type prefix. Override to implement a backend specific format.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        return '%s.%s' % (prefix, series.name(key))
+
+    def format_internal_name(self, prefix, key):
+        """Return the fully qualified output name for an internal stat key.
+        Override to implement a backend specific format.
+
+        :param str prefix: The key prefix (internal data type)
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return '%s.%s' % (prefix, '.'.join(key))
+
+    def internal_values(self, values, prefix):
+        """Iterate over (name, value) tuples for internal stats keyed by
+        (metric type, host, name) tuples, formatting each name only the
+        first time the key is seen. The cache is cleared when it reaches
+        MAX_INTERNAL_NAMES so names no longer reported do not accumulate.
+
+        :param dict values: The internal stats
+        :param str prefix: The key prefix (internal data type)
+        :rtype: iter
+
+        """
+        names = self.internal_names
+        for key, value in values.iteritems():
+            try:
+                name = names[(prefix, key)]
+            except KeyError:
+                if len(names) >= MAX_INTERNAL_NAMES:
+                    names.clear()
+                name = names[(prefix, key)] = \
+                    self.format_internal_name(prefix, key)
+            yield name, value
+
+    def internal_timer_values(self, timers, prefix):
+        """Iterate over (name, value) tuples of the calculated values for
+        internal timers keyed by (metric type, host, name) tuples.
+
+        :param dict timers: The internal timer values
+        :param str prefix: The key prefix (internal data type)
+        :rtype: iter
+
+        """
+        for name, timer in self.internal_values(timers, prefix):
+            values = self.calc_timer_values(timer)
+            for stat in values:
+                yield '%s.%s' % (name, stat), values[stat]
+
+    def metric_name(self, prefix, key):
+        """Return the output name for the metric key under the type prefix,
+        formatting it only the first time the series is seen. Names are
+        cached by series id, checking the cached series is the same object
+        in case the id has since been reused.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        series_id = getattr(key, 'id', None)
+        if series_id is None:
+            return self.format_name(prefix, key)
+        try:
+            cache = self.names[prefix]
+        except KeyError:
+            cache = self.names[prefix] = dict()
+        try:
+            cached_key, name = cache[series_id]
+            if cached_key is key:
+                return name
+        except KeyError:
+            pass
+        name = self.format_name(prefix, key)
+        cache[series_id] = key, name
+        return name
+
+    def timer_names(self, prefix, key, values):
+        """Return a dict of the output names for each of the calculated
+        timer values for the metric key, cached like metric_name.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :param dict values: The calculated timer values
+        :rtype: dict
+
+        """
+        series_id = getattr(key, 'id', None)
+        if series_id is None:
+            return self.format_timer_names(prefix, key, values)
+        try:
+            cache = self.timer_stat_names[prefix]
+        except KeyError:
+            cache = self.timer_stat_names[prefix] = dict()
+        try:
+            cached_key, names = cache[series_id]
+            if cached_key is key:
+                return names
+        except KeyError:
+            pass
+        names = self.format_timer_names(prefix, key, values)
+        cache[series_id] = key, names
+        return names
+
+    def format_timer_names(self, prefix, key, values):
+        """Return a dict of the output names for each of the calculated
+        timer values for the metric key.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :param dict values: The calculated timer values
+        :rtype: dict
+
+        """
+        name = self.format_name(prefix, key)
+        return dict([(stat, '%s.%s' % (name, stat)) for stat in values])
+
+    def metric_values(self, values, prefix):
+        """Iterate over (name, value) tuples for a dict of values keyed by
+        series. Values are named as they are consumed so that output can be
+        encoded and sent without materializing every metric.
+
+        :param dict values: The values to name
+        :param str prefix: The key prefix (data type)
+        :rtype: iter
+
+        """
+        for key, value in values.iteritems():
+            yield self.metric_name(prefix, key), value
+
+    def timer_metric_values(self, timers, prefix):
+        """Iterate over (name, value) tuples of the calculated values for a
+        dict of timers keyed by series, calculating each timer as it is
+        consumed.
+
+        :param dict timers: The timer values
+        :param str prefix: The key prefix (data type)
+        :rtype: iter
+
+        """
+        for key, timer in timers.iteritems():
+            values = self.calc_timer_values(timer)
+            names = self.timer_names(prefix, key, values)
+            for stat in values:
+                yield names[stat], values[stat]
+
     def median(self, values):
         """Calculate the median list value from a sorted list.
 
@@ -147,6 +359,14 @@ class Backend(object):
             calculated[key] = self.calc_set_values(sets[key])
         return calculated
 
+    def start(self):
+        """Invoked by the controller once it is set up for the backends that
+        are delivered to in its process, to start serving requests on the
+        IOLoop.
+
+        """
+        pass
+
     def timer_values(self, timers):
         """Calculate timer values to show variations on
 
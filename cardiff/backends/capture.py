@@ -0,0 +1,74 @@
+"""
+capture.py
+
+"""
+import json
+import logging
+import threading
+
+from cardiff.backends import base
+
+LOGGER = logging.getLogger(__name__)
+
+PATH = '/tmp/cardiff-capture.json'
+
+
+class CaptureBackend(base.Backend):
+    """Append each flush to a local file as a line of JSON, keyed by the
+    canonical form of each series, so that what cardiff delivered can be
+    compared with what was sent to it.
+
+    """
+    name = 'capture'
+
+    def __init__(self, config, flush_interval):
+        """Create a new backend object to emit stats with
+
+        :param dict config: The backend specific configuration
+
+        """
+        super(CaptureBackend, self).__init__(config, flush_interval)
+        self.path = config.get('path', PATH)
+        self.lock = threading.Lock()
+        LOGGER.info('Will capture stats to %s', self.path)
+
+    def deliver(self, timestamp, counters, gauges, sets, timers,
+                int_counters, int_gauges, int_timers):
+        """Invoked by the core cardiff controller when there are stats to
+        publish.
+
+        :param float timestamp: The timestamp for the metrics
+        :param dict counters: Counters to report
+        :param dict gauges: Gauges to report
+        :param dict sets: Sets to report
+        :param dict timers: Timers to report
+        :param dict int_counters: Internal counters
+        :param dict int_gauges: Internal gauges
+        :param dict int_timers: Internal timers
+
+        """
+        record = {'timestamp': timestamp,
+                  'host': self.hostname,
+                  'counters': counters,
+                  'gauges': gauges,
+                  'sets': dict([(key, len(value))
+                                for key, value in sets.iteritems()]),
+                  'timers': self.timer_values(timers),
+                  'internal': {
+                      'counters': dict(self.internal_values(int_counters,
+                                                            None)),
+                      'gauges': dict(self.internal_values(int_gauges,
+                                                          None))}}
+        with self.lock:
+            with open(self.path, 'a') as handle:
+                handle.write('%s\n' % json.dumps(record))
+
+    def format_internal_name(self, prefix, key):
+        """Return the name an internal stat key is captured with
+
+        :param str prefix: Unused
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return '.'.join(key)
@@ -1,4 +1,4 @@
-import flatdict
+import itertools
 import logging
 import pickle
 import socket
@@ -7,11 +7,10 @@ import time
 
 from cardiff.backends import base
 from cardiff import controller
+from cardiff import series
 
 LOGGER = logging.getLogger(__name__)
 
-flatdict.FlatDict.DELIMITER = '.'
-
 BATCH_SIZE = 300
 
 BACKEND = 'backend'
@@ -25,6 +24,13 @@ LAST_EXCEPTION = 'last_exception'
 LAST_FLUSH = 'last_flush'
 TIME_SPENT = 'prepare_time_ms'
 
+INTERNAL_COUNTERS = '%s.%s' % (controller.METRICS_INTERNAL,
+                               controller.METRICS_COUNTER)
+INTERNAL_GAUGES = '%s.%s' % (controller.METRICS_INTERNAL,
+                             controller.METRICS_GAUGE)
+INTERNAL_TIMERS = '%s.%s' % (controller.METRICS_INTERNAL,
+                             controller.METRICS_TIMER)
+
 
 class GraphiteBackend(base.Backend):
     """Publish metrics into graphite either via the plain text or pickle
@@ -41,9 +47,10 @@ class GraphiteBackend(base.Backend):
         """
         super(GraphiteBackend, self).__init__(config, flush_interval)
 
-        # Format and Batch Size (used only for pickle format)
+        # Format, Batch Size (pickle format) and Chunk Size (plaintext)
         self.format = config.get('format', PLAINTEXT)
         self.batch_size = config.get('batch_size', BATCH_SIZE)
+        self.chunk_size = config.get('chunk_size', base.CHUNK_SIZE)
         if self.format not in [PLAINTEXT, PICKLE]:
             LOGGER.info('Overwriting unsupported protocol %s with %s',
                         self.format, PLAINTEXT)
@@ -95,9 +102,6 @@ class GraphiteBackend(base.Backend):
         """
         start_time = time.time()
 
-        # Calculate any timer values
-        timer_values = self.flatten(self.timer_values(timers))
-
         try:
             self.connect()
         except socket.error:
@@ -105,81 +109,75 @@ class GraphiteBackend(base.Backend):
             self.last_exception = int(time.time())
             return
 
-        if self.format == PLAINTEXT:
-            self.deliver_plaintext_values(timestamp,
-                                          counters,
-                                          self.counter_prefix)
-            self.deliver_plaintext_values(timestamp, gauges, self.gauge_prefix)
-            self.deliver_plaintext_values(timestamp,
-                                          timer_values,
-                                          self.timer_prefix)
-        else:
-            self.deliver_pickled_values(timestamp, counters,
-                                        self.counter_prefix)
-            self.deliver_pickled_values(timestamp, gauges, self.gauge_prefix)
-            self.deliver_pickled_values(timestamp,
-                                        timer_values,
-                                        self.timer_prefix)
-
-        # Get per-host timer values
-        timer_values = flatdict.FlatDict()
-        for key in int_timers:
-            timer_values[key] = flatdict.FlatDict()
-            for host in int_timers[key]:
-                timer_values[host] = self.timer_values(int_timers[key][host])
-
-        self.deliver_internal_stats(start_time,
-                                    int_counters,
-                                    int_gauges,
-                                    timer_values.as_dict())
+        # Stream the metrics using the output names cached per series
+        self.deliver_metrics(timestamp, itertools.chain(
+            self.metric_values(counters, self.counter_prefix),
+            self.metric_values(gauges, self.gauge_prefix),
+            self.timer_metric_values(timers, self.timer_prefix)))
+        self.deliver_internal_stats(start_time, int_counters, int_gauges,
+                                    int_timers)
 
         self.disconnect()
 
-    def flatten(self, values):
-        """Return a nested dict as a flat dict.
-
-        :param dict values: The nested dict to flatten
-        :rtype: dict
-
-        """
-        return flatdict.FlatDict(values).as_dict()
-
     def deliver_internal_stats(self, start_time, counters, gauges, timers):
         """Send the internal cardiff stats to Graphite. By default this will be
-        in the cardiff.graphite
+        in the cardiff.internal
 
-        :param start_time:
-        :param counters:
-        :param gauges:
-        :param timers:
+        :param float start_time: The time delivery started
+        :param dict counters: Internal counters
+        :param dict gauges: Internal gauges
+        :param dict timers: Internal timers
         :rtype: None
 
         """
         last_flush = int(time.time())
 
-        values = flatdict.FlatDict({GRAPHITE: {EXCEPTIONS: self.exceptions}})
-        counters[controller.METRICS_BACKEND][self.host] = values
-
-        values = flatdict.FlatDict({GRAPHITE: {
-            LAST_EXCEPTION: self.last_exception,
-            LAST_FLUSH: last_flush,
-            TIME_SPENT: (last_flush - start_time) * 1000
-        }})
-        gauges[controller.METRICS_BACKEND][self.host] = values
+        counters = dict(counters)
+        counters[self.internal_key(EXCEPTIONS)] = self.exceptions
 
-        stats = flatdict.FlatDict({
-            controller.METRICS_COUNTER: counters,
-            controller.METRICS_GAUGE: gauges
-        })
+        gauges = dict(gauges)
+        gauges[self.internal_key(LAST_EXCEPTION)] = self.last_exception
+        gauges[self.internal_key(LAST_FLUSH)] = last_flush
+        gauges[self.internal_key(TIME_SPENT)] = (last_flush -
+                                                 start_time) * 1000
 
-        if self.format == PLAINTEXT:
-            self.deliver_plaintext_values(start_time, stats.as_dict(),
-                                          controller.METRICS_INTERNAL)
-        else:
-            self.deliver_pickled_values(start_time, stats.as_dict(),
-                                        controller.METRICS_INTERNAL)
+        self.deliver_metrics(start_time, itertools.chain(
+            self.internal_values(counters, INTERNAL_COUNTERS),
+            self.internal_values(gauges, INTERNAL_GAUGES),
+            self.internal_timer_values(timers, INTERNAL_TIMERS)))
         self.exceptions = 0
 
+    def format_internal_name(self, prefix, key):
+        """Return the graphite path for an internal stat key
+
+        :param str prefix: The key prefix (internal data type)
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return self.key(prefix, '.'.join(key))
+
+    def internal_key(self, name):
+        """Return the internal stats key for a stat about this backend
+
+        :param str name: The stat name
+        :rtype: tuple
+
+        """
+        return controller.METRICS_BACKEND, self.host, '%s.%s' % (GRAPHITE,
+                                                                 name)
+
+    def format_name(self, prefix, key):
+        """Return the graphite path for the metric key, folding any tags into
+        the path since graphite has no tag support.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        return self.key(prefix, series.path(key))
+
     def key(self, prefix, key):
         """Return the properly formatted key for the given type prefix and
         main prefix.
@@ -191,58 +189,31 @@ class GraphiteBackend(base.Backend):
         """
         return '%s.%s.%s' % (self.prefix, prefix, key)
 
-    def deliver_plaintext_values(self, timestamp, values, prefix):
-        """Send plaintext formatted counter data to graphite.
+    def deliver_metrics(self, timestamp, metrics):
+        """Send (name, value) tuples to graphite in the configured format as
+        they are produced, plaintext lines in chunks of at most chunk_size
+        bytes and pickles in batches of batch_size metrics, so that only one
+        chunk or batch is held in memory at a time.
 
         :param int timestamp: The time for the metrics
-        :param dict values: The values to send
-        :param str prefix: The prefix for the key
+        :param iter metrics: The metric names and values to send
 
         """
-        flat_values = flatdict.FlatDict(values)
-        flat_values.DELIMITER = '.'
-        for key in flat_values.keys():
-            if flat_values[key] is None:
-                flat_values[key] = 0
-            self.send('%s %s %s' % (self.key(prefix, key),
-                                    flat_values[key],
-                                    int(timestamp)))
-
-    def deliver_pickled_values(self, timestamp, values, prefix):
-        """Deliver values in the Python pickle format
-
-        :param int timestamp: The time for the metrics
-        :param dict values: The values to send
-        :param str prefix: The prefix for the key
+        timestamp = int(timestamp)
+        if self.format == PLAINTEXT:
+            lines = ('%s %s %s\n' % (name, 0 if value is None else value,
+                                     timestamp)
+                     for name, value in metrics)
+            for chunk in base.chunks(lines, self.chunk_size, ''):
+                self.socket.sendall(chunk)
+            return
 
-        """
-        flat_values = flatdict.FlatDict(values)
-        flat_values.DELIMITER = '.'
-        metrics = list()
-        for key in flat_values.keys():
-            if flat_values[key] is None:
-                flat_values[key] = 0
-            metrics.append((self.key(prefix, key),
-                            (int(timestamp),
-                             flat_values[key])))
-
-        while metrics:
-            pickled = pickle.dumps(metrics[:self.batch_size], protocol=-1)
-            self.socket.send(struct.pack('!L', len(pickled)) + pickled)
-            if len(metrics) > self.batch_size:
-                metrics = metrics[self.batch_size:]
-            else:
-                break
+        for batch in base.batches(metrics, self.batch_size):
+            pickled = pickle.dumps([(name, (timestamp,
+                                            0 if value is None else value))
+                                    for name, value in batch], protocol=-1)
+            self.socket.sendall(struct.pack('!L', len(pickled)) + pickled)
 
     def disconnect(self):
         """Disconnect from the remote host"""
         self.socket.close()
-
-    def send(self, line):
-        """Send the line to the Graphite server
-
-        :param str line: The line to send to graphite
-
-        """
-        LOGGER.debug('Sending: %s', line)
-        self.socket.send('%s\n' % line)
@@ -0,0 +1,411 @@
+"""
+influxdb.py
+
+"""
+import httplib
+import itertools
+import logging
+import math
+import Queue
+import random
+import socket
+import threading
+import time
+import urllib
+import zlib
+
+from cardiff.backends import base
+from cardiff import controller
+from cardiff import series
+
+LOGGER = logging.getLogger(__name__)
+
+BACKOFF = 0.5
+BATCH_SIZE = 5000
+CONCURRENCY = 4
+DATABASE = 'cardiff'
+GZIP_LEVEL = 6
+MAX_BACKOFF = 10
+PATH = '/write'
+PORT = 8086
+RETRIES = 3
+TIMEOUT = 10
+
+BATCHES = 'batches'
+BATCH_SIZE_GAUGE = 'batch_size'
+BATCH_TIME = 'batch_time_ms'
+BYTES = 'bytes'
+CONCURRENCY_GAUGE = 'concurrency'
+FAILED = 'failed_batches'
+INFLUXDB = 'influxdb'
+LINES = 'lines'
+RETRIED = 'retries'
+
+FIELD = 'value'
+TIMER_FIELDS = ['count', 'count_ps', 'min', 'max', 'mean', 'total', 'median',
+                '90th', '95th']
+
+
+def escape_measurement(value):
+    """Return the measurement escaped for the line protocol
+
+    :param str value: The measurement
+    :rtype: str
+
+    """
+    return value.replace(',', r'\,').replace(' ', r'\ ')
+
+
+def escape_tag(value):
+    """Return a tag key or value escaped for the line protocol
+
+    :param str value: The tag key or value
+    :rtype: str
+
+    """
+    return value.replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def field_value(value):
+    """Return the line protocol float field value, or None if the value is
+    missing or not finite and can not be written.
+
+    :param int|float value: The value
+    :rtype: str
+
+    """
+    if value is None:
+        return None
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        return None
+    return repr(value)
+
+
+class InfluxDBBackend(base.Backend):
+    """Write the stats in the InfluxDB line protocol, as accepted by InfluxDB
+    and VictoriaMetrics, to an HTTP write endpoint. Each series is a
+    measurement with its tags, counters, gauges and set sizes have a single
+    value field and timers a field per calculated value, all with the flush
+    timestamp in seconds. Lines are posted in batches of batch_size by
+    concurrency writer threads, each keeping its own persistent connection,
+    with failed batches retried with exponential backoff.
+
+    """
+    name = 'influxdb'
+
+    def __init__(self, config, flush_interval):
+        """Create a new backend object to emit stats with
+
+        :param dict config: The backend specific configuration
+
+        """
+        super(InfluxDBBackend, self).__init__(config, flush_interval)
+        self.host = config.get('host', 'localhost')
+        self.port = config.get('port', PORT)
+        self.prefix = config.get('prefix')
+        self.batch_size = config.get('batch_size', BATCH_SIZE)
+        self.concurrency = max(1, config.get('concurrency', CONCURRENCY))
+        self.gzip = config.get('gzip', True)
+        self.gzip_level = config.get('gzip_level', GZIP_LEVEL)
+        self.retries = config.get('retries', RETRIES)
+        self.backoff = config.get('backoff', BACKOFF)
+        self.max_backoff = config.get('max_backoff', MAX_BACKOFF)
+        self.timeout = config.get('timeout', TIMEOUT)
+
+        arguments = [('db', config.get('database', DATABASE)),
+                     ('precision', 's')]
+        if config.get('user'):
+            arguments += [('u', config['user']),
+                          ('p', config.get('password', ''))]
+        self.url = '%s?%s' % (config.get('path', PATH),
+                              urllib.urlencode(arguments))
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+
+        self.connections = [None] * self.concurrency
+        self.lock = threading.Lock()
+        self.reset_stats()
+        LOGGER.info('Will write to InfluxDB at http://%s:%i%s in batches of '
+                    '%i lines over %i connections', self.host, self.port,
+                    self.url, self.batch_size, self.concurrency)
+
+    def close(self, index):
+        """Close the persistent connection of a writer thread
+
+        :param int index: The writer thread index
+
+        """
+        connection, self.connections[index] = self.connections[index], None
+        if connection is not None:
+            connection.close()
+
+    def compress(self, body):
+        """Return the body gzip compressed
+
+        :param str body: The batch body
+        :rtype: str
+
+        """
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def deliver(self, timestamp, counters, gauges, sets, timers,
+                int_counters, int_gauges, int_timers):
+        """Invoked by the core cardiff controller when there are stats to
+        publish.
+
+        :param int timestamp: The timestamp for the metrics
+        :param dict counters: Counters to report
+        :param dict gauges: Gauges to report
+        :param dict sets: Sets to report
+        :param dict timers: Timers to report
+        :param dict int_counters: Internal counters
+        :param dict int_gauges: Internal gauges
+        :param dict int_timers: Internal timers
+
+        """
+        # Batch stats are reported on the flush after they are measured
+        int_counters, int_gauges, int_timers = \
+            self.internal_stats(int_counters, int_gauges, int_timers)
+
+        suffix = ' %i' % int(timestamp)
+        lines = itertools.chain(
+            self.value_lines(self.metric_values(
+                counters, controller.METRICS_COUNTER), suffix),
+            self.value_lines(self.metric_values(
+                gauges, controller.METRICS_GAUGE), suffix),
+            self.value_lines(((self.metric_name(controller.METRICS_SET, key),
+                               len(values))
+                              for key, values in sets.iteritems()), suffix),
+            self.timer_lines(self.metric_values(
+                timers, controller.METRICS_TIMER), suffix),
+            self.value_lines(self.internal_values(
+                int_counters, controller.METRICS_COUNTER), suffix),
+            self.value_lines(self.internal_values(
+                int_gauges, controller.METRICS_GAUGE), suffix),
+            self.timer_lines(self.internal_values(
+                int_timers, controller.METRICS_TIMER), suffix))
+
+        # Hold at most two batches per writer so output is encoded as it is
+        # written rather than all at once
+        batches = Queue.Queue(self.concurrency * 2)
+        writers = list()
+        for index in xrange(self.concurrency):
+            writer = threading.Thread(target=self.writer,
+                                      args=(index, batches))
+            writer.daemon = True
+            writer.start()
+            writers.append(writer)
+        try:
+            for batch in base.batches(lines, self.batch_size):
+                batches.put(batch)
+        finally:
+            for writer in writers:
+                batches.put(None)
+            for writer in writers:
+                writer.join()
+
+    def format_internal_name(self, prefix, key):
+        """Return the measurement and host tag for an internal stat key
+
+        :param str prefix: The key prefix (internal data type)
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return '%s,host=%s' % (
+            escape_measurement(self.key('%s.%s.%s' % (
+                controller.METRICS_PREFIX, key[0], key[2]))),
+            escape_tag(key[1]))
+
+    def format_name(self, prefix, key):
+        """Return the measurement and tags for the metric key
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        return ''.join([escape_measurement(self.key(series.name(key)))] +
+                       [',%s=%s' % (escape_tag(name),
+                                    escape_tag(value or 'true'))
+                        for name, value in series.tags(key)])
+
+    def internal_key(self, name):
+        """Return the internal stats key for a stat about this backend
+
+        :param str name: The stat name
+        :rtype: tuple
+
+        """
+        return (controller.METRICS_BACKEND, self.hostname,
+                '%s.%s' % (INFLUXDB, name))
+
+    def internal_stats(self, counters, gauges, timers):
+        """Return copies of the internal stats with the batch stats measured
+        since the last flush added, resetting them.
+
+        :param dict counters: Internal counters
+        :param dict gauges: Internal gauges
+        :param dict timers: Internal timers
+        :rtype: tuple(dict, dict, dict)
+
+        """
+        with self.lock:
+            counters = dict(counters)
+            counters[self.internal_key(BATCHES)] = self.batch_count
+            counters[self.internal_key(BYTES)] = self.bytes
+            counters[self.internal_key(FAILED)] = self.failed
+            counters[self.internal_key(LINES)] = self.lines
+            counters[self.internal_key(RETRIED)] = self.retried
+
+            gauges = dict(gauges)
+            gauges[self.internal_key(BATCH_SIZE_GAUGE)] = self.batch_size
+            gauges[self.internal_key(CONCURRENCY_GAUGE)] = self.concurrency
+
+            timers = dict(timers)
+            if self.batch_times:
+                timers[self.internal_key(BATCH_TIME)] = self.batch_times
+            self.reset_stats()
+        return counters, gauges, timers
+
+    def key(self, name):
+        """Return the measurement name with the configured prefix
+
+        :param str name: The metric name
+        :rtype: str
+
+        """
+        return '%s.%s' % (self.prefix, name) if self.prefix else name
+
+    def post(self, index, body):
+        """Post the body over the persistent connection of the writer thread,
+        connecting if needed, and return the response status.
+
+        :param int index: The writer thread index
+        :param str body: The request body
+        :rtype: int
+        :raises: httplib.HTTPException, socket.error
+
+        """
+        if self.connections[index] is None:
+            self.connections[index] = \
+                httplib.HTTPConnection(self.host, self.port,
+                                       timeout=self.timeout)
+        connection = self.connections[index]
+        connection.request('POST', self.url, body, self.headers)
+        response = connection.getresponse()
+        response.read()
+        if response.getheader('connection', '').lower() == 'close':
+            self.close(index)
+        return response.status
+
+    def reset_stats(self):
+        """Reset the batch stats measured between flushes"""
+        self.batch_count = 0
+        self.batch_times = list()
+        self.bytes = 0
+        self.failed = 0
+        self.lines = 0
+        self.retried = 0
+
+    def timer_lines(self, metrics, suffix):
+        """Iterate over the lines for (name, timer values) pairs, with a
+        field for each calculated value.
+
+        :param iter metrics: The names and timer values
+        :param str suffix: The timestamp suffix of each line
+        :rtype: iter
+
+        """
+        for name, timer in metrics:
+            if not len(timer):
+                continue
+            values = self.calc_timer_values(timer)
+            fields = [(field, field_value(values[field]))
+                      for field in TIMER_FIELDS]
+            yield '%s %s%s' % (name, ','.join(['%s=%s' % (field, value)
+                                               for field, value in fields
+                                               if value is not None]),
+                               suffix)
+
+    @staticmethod
+    def value_lines(metrics, suffix):
+        """Iterate over the lines for (name, value) pairs, skipping values
+        that can not be written.
+
+        :param iter metrics: The names and values
+        :param str suffix: The timestamp suffix of each line
+        :rtype: iter
+
+        """
+        for name, value in metrics:
+            value = field_value(value)
+            if value is not None:
+                yield '%s %s=%s%s' % (name, FIELD, value, suffix)
+
+    def write(self, index, batch):
+        """Write a batch of lines, retrying failed writes with exponential
+        backoff and jitter. Batches rejected as invalid are not retried.
+
+        :param int index: The writer thread index
+        :param list batch: The lines to write
+        :rtype: bool
+
+        """
+        body = '\n'.join(batch)
+        if self.gzip:
+            body = self.compress(body)
+        start_time = time.time()
+        retried = 0
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                retried += 1
+                time.sleep(min(self.max_backoff,
+                               self.backoff * 2 ** (attempt - 1)) *
+                           random.uniform(0.5, 1.0))
+            try:
+                status = self.post(index, body)
+            except (httplib.HTTPException, socket.error) as error:
+                LOGGER.warning('Error writing a batch of %i lines to '
+                               'InfluxDB: %s', len(batch), error)
+                self.close(index)
+                continue
+            if status < 300:
+                break
+            LOGGER.warning('InfluxDB responded to a batch of %i lines with '
+                           '%i', len(batch), status)
+            if status < 500 and status != 429:
+                break
+        else:
+            status = None
+
+        with self.lock:
+            self.batch_count += 1
+            self.batch_times.append((time.time() - start_time) * 1000)
+            self.bytes += len(body)
+            self.lines += len(batch)
+            self.retried += retried
+            if status is None or status >= 300:
+                self.failed += 1
+        return status is not None and status < 300
+
+    def writer(self, index, batches):
+        """Write batches from the queue until None is received
+
+        :param int index: The writer thread index
+        :param Queue.Queue batches: The queue of batches to write
+
+        """
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                self.write(index, batch)
+            except Exception:
+                LOGGER.exception('Unexpected error writing to InfluxDB')
+                self.close(index)
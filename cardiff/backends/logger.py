@@ -37,15 +37,25 @@ class LoggerBackend(base.Backend):
         self.log_gauges(gauges)
         self.log_sets(self.set_values(sets))
         self.log_timers(self.timer_values(timers))
-        for key in int_counters.keys():
-            for host in int_counters[key].keys():
-                self.log_counters(int_counters[key][host], True)
-        for key in int_gauges.keys():
-            for host in int_gauges[key].keys():
-                self.log_gauges(int_gauges[key][host], True)
-        for key in int_timers.keys():
-            for host in int_timers[key].keys():
-                self.log_timers(self.timer_values(int_timers[key][host]), True)
+        for name, value in self.internal_values(int_counters, ''):
+            LOGGER.info('Internal Counter %s=%s', name, value)
+        for name, value in self.internal_values(int_gauges, ''):
+            LOGGER.info('Internal Gauge %s=%s', name, value)
+        for name, timer in self.internal_values(int_timers, ''):
+            values = self.calc_timer_values(timer)
+            for value in values:
+                LOGGER.info('Internal Timer %s %s=%s', name, value,
+                            values[value])
+
+    def format_internal_name(self, prefix, key):
+        """Return the name an internal stat key is logged with
+
+        :param str prefix: Unused
+        :param tuple key: The (metric type, host, name) key
+        :rtype: str
+
+        """
+        return key[2]
 
     def log_counters(self, counters, internal=False):
         value = 'Counter %s=%s' if not internal else 'Internal Counter %s=%s'
@@ -59,7 +69,7 @@ class LoggerBackend(base.Backend):
 
     def log_sets(self, sets):
         for key in sets:
-            for value in sets:
+            for value in sets[key]:
                 LOGGER.info('Set %s %s=%s', key, value, sets[key][value])
 
     def log_timers(self, timers, internal=False):
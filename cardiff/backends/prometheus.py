@@ -0,0 +1,379 @@
+"""
+prometheus.py
+
+"""
+import logging
+import re
+import time
+import zlib
+
+from tornado import ioloop
+from tornado import web
+
+from cardiff.backends import base
+from cardiff import controller
+from cardiff import series
+from cardiff import servers
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+GZIP_LEVEL = 6
+HOST = '0.0.0.0'
+PATH = '/metrics'
+PORT = 9102
+TTL = 3600
+
+BODY_SIZE = 'body_bytes'
+GZIP_SIZE = 'gzip_bytes'
+PROMETHEUS = 'prometheus'
+RENDER_TIME = 'render_ms'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+INVALID_NAME = re.compile(r'[^a-zA-Z0-9_:]')
+INVALID_LABEL = re.compile(r'[^a-zA-Z0-9_]')
+QUANTILES = [('0.5', 'median'), ('0.9', '90th'), ('0.95', '95th')]
+
+
+def escape(value):
+    """Return a label value escaped for the text exposition format
+
+    :param str value: The label value
+    :rtype: str
+
+    """
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def metric_name(name):
+    """Return the name with characters that are not valid in a Prometheus
+    metric name replaced by underscores.
+
+    :param str name: The name
+    :rtype: str
+
+    """
+    name = INVALID_NAME.sub('_', name)
+    return '_%s' % name if name[:1].isdigit() else name
+
+
+def label_name(name):
+    """Return the name with characters that are not valid in a Prometheus
+    label name replaced by underscores.
+
+    :param str name: The name
+    :rtype: str
+
+    """
+    name = INVALID_LABEL.sub('_', name)
+    return '_%s' % name if name[:1].isdigit() else name
+
+
+def labels(pairs):
+    """Return the comma joined name="value" labels for (name, value) pairs,
+    using true as the value of bare tags.
+
+    :param iter pairs: The label names and values
+    :rtype: str
+
+    """
+    return ','.join(['%s="%s"' % (label_name(name), escape(value or 'true'))
+                     for name, value in pairs])
+
+
+def sample(name, label_values, value, extra=None):
+    """Return a sample line of the exposition
+
+    :param str name: The metric name
+    :param str label_values: The joined labels of the series
+    :param float value: The sample value
+    :param str extra: A label to add, such as the quantile of a summary
+    :rtype: str
+
+    """
+    if extra:
+        label_values = '%s,%s' % (label_values, extra) if label_values \
+            else extra
+    if label_values:
+        return '%s{%s} %s' % (name, label_values, repr(float(value)))
+    return '%s %s' % (name, repr(float(value)))
+
+
+class ScrapeHandler(web.RequestHandler):
+    """Serve the exposition rendered on the last flush, gzip compressed when
+    the scraper accepts it and compression is enabled.
+
+    """
+    def initialize(self, backend):
+        self.backend = backend
+
+    def get(self):
+        body, compressed = self.backend.exposition
+        self.set_header('Content-Type', CONTENT_TYPE)
+        if compressed is not None and \
+                'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            body = compressed
+        self.write(body)
+
+
+class PrometheusBackend(base.Backend):
+    """Expose the stats to be scraped by Prometheus. The text exposition is
+    rendered once per flush and served from memory on the IOLoop, so the
+    backend is always delivered to in the main process. Counters are
+    exposed as monotonic totals and timers as summaries with the quantiles
+    of the last interval and cumulative sums and counts. Series that are not
+    updated for ttl seconds are removed from the exposition.
+
+    """
+    name = 'prometheus'
+    worker = False
+
+    def __init__(self, config, flush_interval):
+        """Create a new backend object to emit stats with
+
+        :param dict config: The backend specific configuration
+
+        """
+        super(PrometheusBackend, self).__init__(config, flush_interval)
+        self.gzip = config.get('gzip', True)
+        self.gzip_level = config.get('gzip_level', GZIP_LEVEL)
+        self.ttl = config.get('ttl', TTL)
+        self.counters = dict()
+        self.gauges = dict()
+        self.summaries = dict()
+        self.body_size = 0
+        self.gzip_size = 0
+        self.render_time = 0
+        self.exposition = '', None
+        self.conflicts = set()
+        self.server = None
+
+    def compress(self, body):
+        """Return the body gzip compressed
+
+        :param str body: The exposition body
+        :rtype: str
+
+        """
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def deliver(self, timestamp, counters, gauges, sets, timers,
+                int_counters, int_gauges, int_timers):
+        """Invoked by the core cardiff controller when there are stats to
+        publish.
+
+        :param float timestamp: The timestamp for the metrics
+        :param dict counters: Counters to report
+        :param dict gauges: Gauges to report
+        :param dict sets: Sets to report
+        :param dict timers: Timers to report
+        :param dict int_counters: Internal counters
+        :param dict int_gauges: Internal gauges
+        :param dict int_timers: Internal timers
+
+        """
+        start_time = time.time()
+        int_gauges = dict(int_gauges)
+        int_gauges[self.internal_key(BODY_SIZE)] = self.body_size
+        int_gauges[self.internal_key(GZIP_SIZE)] = self.gzip_size
+        int_gauges[self.internal_key(RENDER_TIME)] = self.render_time
+
+        self.update(self.counters, self.metric_values(
+            counters, controller.METRICS_COUNTER), timestamp, True)
+        self.update(self.counters, self.internal_values(
+            int_counters, controller.METRICS_COUNTER), timestamp, True)
+        self.update(self.gauges, self.metric_values(
+            gauges, controller.METRICS_GAUGE), timestamp)
+        self.update(self.gauges, self.internal_values(
+            int_gauges, controller.METRICS_GAUGE), timestamp)
+        self.update(self.gauges, ((self.metric_name(controller.METRICS_SET,
+                                                    key), len(values))
+                                  for key, values in sets.iteritems()),
+                    timestamp)
+        self.update_summaries(self.metric_values(
+            timers, controller.METRICS_TIMER), timestamp)
+        self.update_summaries(self.internal_values(
+            int_timers, controller.METRICS_TIMER), timestamp)
+
+        body = self.render(timestamp)
+        compressed = self.compress(body) if self.gzip else None
+        self.exposition = body, compressed
+        self.body_size = len(body)
+        self.gzip_size = len(compressed) if compressed is not None else 0
+        self.render_time = (time.time() - start_time) * 1000
+
+    def format_internal_name(self, prefix, key):
+        """Return the metric name and labels for an internal stat key,
+        carrying the host as a label.
+
+        :param str prefix: The key prefix (internal data type)
+        :param tuple key: The (metric type, host, name) key
+        :rtype: tuple(str, str)
+
+        """
+        name = metric_name('%s_%s_%s' % (controller.METRICS_PREFIX, key[0],
+                                         key[2]))
+        if prefix == controller.METRICS_COUNTER:
+            name = '%s_total' % name
+        return name, labels([('host', key[1])])
+
+    def format_name(self, prefix, key):
+        """Return the metric name and labels for the metric key, carrying
+        the tags as labels.
+
+        :param str prefix: The key prefix (data type)
+        :param str key: The metric key
+        :rtype: tuple(str, str)
+
+        """
+        name = metric_name(series.name(key))
+        if prefix == controller.METRICS_COUNTER:
+            name = '%s_total' % name
+        return name, labels(series.tags(key))
+
+    def internal_key(self, name):
+        """Return the internal stats key for a stat about this backend
+
+        :param str name: The stat name
+        :rtype: tuple
+
+        """
+        return (controller.METRICS_BACKEND, self.hostname,
+                '%s.%s' % (PROMETHEUS, name))
+
+    def render(self, timestamp):
+        """Return the text exposition of the current values, removing the
+        series that have not been updated within the ttl. Samples of a metric
+        whose name conflicts with a metric of another type are left out,
+        since the exposition would otherwise be invalid, and the conflicting
+        names are logged when they first conflict.
+
+        :param int timestamp: The flush timestamp
+        :rtype: str
+
+        """
+        expires = timestamp - self.ttl if self.ttl else None
+        families, owners, conflicts = dict(), dict(), set()
+        for values, metric_type in [(self.counters, COUNTER),
+                                    (self.gauges, GAUGE)]:
+            for key, (value, updated) in values.items():
+                if expires is not None and updated < expires:
+                    del values[key]
+                    continue
+                lines = self.family(families, owners, key[0], metric_type)
+                if lines is None:
+                    conflicts.add((key[0], metric_type))
+                    continue
+                lines.append(sample(key[0], key[1], value))
+
+        for key, (quantiles, total, count, updated) in \
+                self.summaries.items():
+            if expires is not None and updated < expires:
+                del self.summaries[key]
+                continue
+            name, label_values = key
+            lines = self.family(families, owners, name, SUMMARY)
+            if lines is None:
+                conflicts.add((name, SUMMARY))
+                continue
+            for quantile, value in quantiles:
+                lines.append(sample(name, label_values, value,
+                                    'quantile="%s"' % quantile))
+            lines.append(sample('%s_sum' % name, label_values, total))
+            lines.append(sample('%s_count' % name, label_values, count))
+
+        if conflicts - self.conflicts:
+            LOGGER.warning('Leaving out metrics whose names conflict with '
+                           'metrics of another type: %s',
+                           ', '.join(['%s (%s)' % value for value
+                                      in sorted(conflicts - self.conflicts)]))
+        self.conflicts = conflicts
+
+        output = list()
+        for name in sorted(families):
+            metric_type, lines = families[name]
+            output.append('# TYPE %s %s' % (name, metric_type))
+            output += lines
+        output.append('')
+        return '\n'.join(output)
+
+    def start(self):
+        """Listen for scrapes on the IOLoop"""
+        self.server = servers.HTTPServer(ioloop.IOLoop.instance(),
+                                         [(self.config.get('path', PATH),
+                                           ScrapeHandler, {'backend': self})])
+        self.server.listen(self.config.get('port', PORT),
+                           self.config.get('host', HOST))
+
+    @staticmethod
+    def family(families, owners, name, metric_type):
+        """Return the sample lines of the metric family, adding it if it is
+        new, or None if its name or the names of its samples, such as the
+        _sum and _count samples of a summary, are used by a family of another
+        type. The first family to use a name keeps it.
+
+        :param dict families: The families by name
+        :param dict owners: The family names by sample name
+        :param str name: The metric name
+        :param str metric_type: The metric type
+        :rtype: list or None
+
+        """
+        try:
+            family_type, lines = families[name]
+            return lines if family_type == metric_type else None
+        except KeyError:
+            pass
+        names = [name]
+        if metric_type == SUMMARY:
+            names += ['%s_sum' % name, '%s_count' % name]
+        if any([value in owners for value in names]):
+            return None
+        for value in names:
+            owners[value] = name
+        families[name] = metric_type, list()
+        return families[name][1]
+
+    @staticmethod
+    def update(values, metrics, timestamp, accumulate=False):
+        """Set or add the (name and labels, value) pairs to the values
+
+        :param dict values: The current values
+        :param iter metrics: The pairs to update the values with
+        :param int timestamp: The flush timestamp
+        :param bool accumulate: Add to the current value instead of setting
+
+        """
+        for key, value in metrics:
+            if accumulate and key in values:
+                value += values[key][0]
+            values[key] = [value, timestamp]
+
+    def update_summaries(self, metrics, timestamp):
+        """Set the quantiles of the (name and labels, timer values) pairs and
+        add their sums and counts to the cumulative totals.
+
+        :param iter metrics: The timer names and values
+        :param int timestamp: The flush timestamp
+
+        """
+        for key, timer in metrics:
+            if not len(timer):
+                continue
+            values = self.calc_timer_values(timer)
+            quantiles = [(quantile, values[stat])
+                         for quantile, stat in QUANTILES]
+            # Scale the sum of sampled timers up to the timings represented
+            count = values['count']
+            total = values['mean'] * count
+            if key in self.summaries:
+                total += self.summaries[key][1]
+                count += self.summaries[key][2]
+            self.summaries[key] = [quantiles, total, count, timestamp]
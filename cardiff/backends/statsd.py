@@ -1,9 +1,13 @@
+import itertools
 import logging
 import socket
 
 LOGGER = logging.getLogger(__name__)
 
 from cardiff.backends import base
+from cardiff import series
+
+PACKET_SIZE = 1432
 
 
 class StatsdBackend(base.Backend):
@@ -24,6 +28,7 @@ class StatsdBackend(base.Backend):
         # Connection info
         self.host = config.get('host')
         self.port = config.get('port', 8125)
+        self.packet_size = config.get('packet_size', PACKET_SIZE)
         self.hostname = socket.gethostname().split('.')[0]
 
     def connect(self):
@@ -47,16 +52,16 @@ class StatsdBackend(base.Backend):
         :param dict int_timers: Internal timers
 
         """
-        LOGGER.info('Compiling metrics in statsd format')
-        output = list()
-        output += self.format_counters(counters)
-        output += self.format_gauges(gauges)
-        output += self.format_sets(sets)
-        output += self.format_timers(timers)
+        lines = itertools.chain(self.counter_lines(counters),
+                                self.gauge_lines(gauges),
+                                self.set_lines(sets),
+                                self.timer_lines(timers))
         self.connect()
-        LOGGER.info('Sending %i metrics upstream', len(output))
-        for line in output:
-            self.send(line)
+        sent = 0
+        for packet in base.chunks(lines, self.packet_size):
+            self.send(packet)
+            sent += packet.count('\n') + 1
+        LOGGER.info('Sent %i metrics upstream', sent)
         self.disconnect()
 
     def disconnect(self):
@@ -64,36 +69,78 @@ class StatsdBackend(base.Backend):
         LOGGER.info('Disconnecting')
         self.socket.close()
 
-    def format_counters(self, counters):
-        return ['%s:%s|c' % (key, counters[key]) for key in counters.keys()]
+    def counter_lines(self, counters):
+        """Iterate over the statsd lines for the counters
+
+        :param dict counters: The counters
+        :rtype: iter
 
-    def format_timers(self, timers):
-        output = list()
-        for key in timers:
-            datapoints = len(timers[key])
-            mean_time = float(sum(timers[key])) / datapoints
-            output.append('%s:%0.3f|ms|%i' % (key, mean_time, datapoints))
-        return output
+        """
+        for key, value in counters.iteritems():
+            yield '%s:%s|c%s' % (series.name(key), value,
+                                 self.format_tags(key))
 
-    def format_gauges(self, gauges):
-        return ['%s:%s|g' % (key, gauges[key]) for key in gauges.keys()]
+    def gauge_lines(self, gauges):
+        """Iterate over the statsd lines for the gauges
 
-    def format_sets(self, sets):
-        output = list()
-        for key in sets:
-            for item in sets[key]:
-                output.append('%s:%s|s' % (key, item))
-        return output
+        :param dict gauges: The gauges
+        :rtype: iter
+
+        """
+        for key, value in gauges.iteritems():
+            yield '%s:%s|g%s' % (series.name(key), value,
+                                 self.format_tags(key))
+
+    def set_lines(self, sets):
+        """Iterate over the statsd lines for each member of the sets
+
+        :param dict sets: The sets
+        :rtype: iter
+
+        """
+        for key, members in sets.iteritems():
+            for item in members:
+                yield '%s:%s|s%s' % (series.name(key), item,
+                                     self.format_tags(key))
+
+    def timer_lines(self, timers):
+        """Iterate over the statsd lines for the timers, sending the mean and
+        the number of values of each.
+
+        :param dict timers: The timers
+        :rtype: iter
+
+        """
+        for key, values in timers.iteritems():
+            datapoints = len(values)
+            if not datapoints:
+                continue
+            mean_time = float(sum(values)) / datapoints
+            yield '%s:%0.3f|ms|%i%s' % (series.name(key), mean_time,
+                                        datapoints, self.format_tags(key))
+
+    def format_tags(self, key):
+        """Return the DogStatsD tag suffix for the metric key
+
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        tags = series.tags(key)
+        if not tags:
+            return ''
+        return '|#%s' % ','.join(['%s:%s' % tag if tag[1] else tag[0]
+                                  for tag in tags])
 
-    def send(self, line):
-        """Send the line to the Graphite server
+    def send(self, packet):
+        """Send a packet of newline delimited lines to the statsd server
 
-        :param str line: The line to send to graphite
+        :param str packet: The packet to send
 
         """
-        LOGGER.debug('Sending: %s', line)
+        LOGGER.debug('Sending: %s', packet)
         try:
-            self.socket.send('%s' % line)
+            self.socket.send(packet)
         except socket.error as error:
             LOGGER.error('Error sending stat: %s', error)
             self.disconnect()
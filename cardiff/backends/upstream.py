@@ -2,6 +2,7 @@
 upstream.py
 
 """
+import itertools
 import logging
 import pickle
 import socket
@@ -9,6 +10,7 @@ import time
 
 from cardiff.backends import base
 from cardiff import controller
+from cardiff import series
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,6 +20,7 @@ EXCEPTIONS = 'exceptions'
 LAST_EXCEPTION = 'last_exception_timestamp'
 LAST_FLUSH = 'flush_timestamp'
 UPSTREAM = 'upstream'
+FRAME_SIZE = 0
 
 
 class UpstreamBackend(base.Backend):
@@ -34,6 +37,8 @@ class UpstreamBackend(base.Backend):
         super(UpstreamBackend, self).__init__(config, flush_interval)
         self.host = config.get('host')
         self.port = config.get('port', 8127)
+        self.frame_size = config.get('frame_size', FRAME_SIZE)
+        self.legacy_format = config.get('legacy_format', True)
         LOGGER.info('Will push to a Cardiff Upstream at %s on port %i',
                     self.host, self.port)
 
@@ -58,9 +63,6 @@ class UpstreamBackend(base.Backend):
         :param dict int_timers: Internal timers
 
         """
-        metrics = self.get_metrics(timestamp, counters, gauges, sets, timers,
-                                   int_counters, int_gauges, int_timers)
-
         try:
             self.connect()
         except socket.error as error:
@@ -71,7 +73,9 @@ class UpstreamBackend(base.Backend):
 
         LOGGER.info('Sending metrics upstream to %s:%s', self.host, self.port)
         try:
-            self.socket.send(pickle.dumps(metrics) + chr(self.FRAME_END))
+            for frame in self.frames(timestamp, counters, gauges, sets, timers,
+                                     int_counters, int_gauges, int_timers):
+                self.socket.sendall(frame)
         except socket.error as error:
             LOGGER.error('Error sending stats upstream: %s', error)
             self.exceptions += 1
@@ -83,10 +87,14 @@ class UpstreamBackend(base.Backend):
         LOGGER.info('Disconnecting')
         self.socket.close()
 
-    def get_metrics(self, timestamp, counters, gauges, sets, timers,
-                    int_counters, int_gauges, int_timers):
-        """Return a dict containing the properly structured values for upstream
-        merging.
+    def frames(self, timestamp, counters, gauges, sets, timers,
+               int_counters, int_gauges, int_timers):
+        """Iterate over the pickled frames of the metrics. All of the metrics
+        are sent in a single frame unless frame_size is set, in which case
+        each frame carries at most frame_size series so only one frame is
+        held in memory at a time. Upstream servers older than framing only
+        read the first frame. The internal stats are carried by the first
+        frame.
 
         :param float timestamp: The timestamp for the metrics
         :param dict counters: Counters to report
@@ -96,22 +104,119 @@ class UpstreamBackend(base.Backend):
         :param dict int_counters: Internal counters
         :param dict int_gauges: Internal gauges
         :param dict int_timers: Internal timers
+        :rtype: iter
+
+        """
+        records = itertools.chain(
+            self.records(controller.METRICS_COUNTER, counters),
+            self.records(controller.METRICS_GAUGE, gauges),
+            self.records(controller.METRICS_SET, sets),
+            self.records(controller.METRICS_TIMER, timers))
+        internal = self.internal_metrics(timestamp, int_counters, int_gauges,
+                                         int_timers)
+        if not self.frame_size:
+            yield self.frame(records, internal)
+            return
+        for batch in base.batches(records, self.frame_size):
+            yield self.frame(batch, internal)
+            internal = dict()
+        if internal:
+            yield self.frame([], internal)
+
+    def frame(self, records, internal):
+        """Return a pickled frame of the (metric type, key, value) records
+        in the structure expected for upstream merging.
+
+        :param iter records: The records to include
+        :param dict internal: The internal stats to include
+        :rtype: str
+
+        """
+        metrics = {controller.METRICS_COUNTER: dict(),
+                   controller.METRICS_GAUGE: dict(),
+                   controller.METRICS_SET: dict(),
+                   controller.METRICS_TIMER: dict()}
+        for metric_type, key, value in records:
+            metrics[metric_type][key] = value
+        metrics[controller.METRICS_GAUGE] = \
+            self.sign_gauges(metrics[controller.METRICS_GAUGE])
+        metrics[controller.METRICS_HOST] = self.hostname
+        metrics[controller.METRICS_INTERNAL] = internal
+        return pickle.dumps(metrics) + chr(self.FRAME_END)
+
+    def records(self, metric_type, values):
+        """Iterate over (metric type, key, value) records for the values. In
+        the legacy format keys without tags are sent as plain strings and
+        timers as lists of values, which upstream servers older than tags and
+        weighted timer samples can unpickle. Those servers count each timer
+        value as a single timing.
+
+        :param str metric_type: The metric type
+        :param dict values: The values keyed by series
+        :rtype: iter
+
+        """
+        legacy = self.legacy_format
+        timers = metric_type == controller.METRICS_TIMER
+        for key, value in values.iteritems():
+            if legacy:
+                if not series.tags(key):
+                    key = str(key)
+                if timers:
+                    value = list(value)
+            yield metric_type, key, value
+
+    def internal_metrics(self, timestamp, int_counters, int_gauges,
+                         int_timers):
+        """Return the internal stats with the stats of this backend added, in
+        the structure expected for upstream merging. In the legacy format
+        they are nested as metric type -> host -> name dicts instead of
+        being keyed by (metric type, host, name) tuples.
+
+        :param float timestamp: The timestamp for the metrics
+        :param dict int_counters: Internal counters
+        :param dict int_gauges: Internal gauges
+        :param dict int_timers: Internal timers
         :rtype: dict
 
         """
-        values = {UPSTREAM: {EXCEPTIONS: self.exceptions}}
-        int_counters[controller.METRICS_BACKEND][self.hostname] = values
-        values = {UPSTREAM: {LAST_EXCEPTION: self.last_exception,
-                             LAST_FLUSH: timestamp}}
-        int_gauges[controller.METRICS_BACKEND][self.hostname] = values
-        return {controller.METRICS_HOST: self.hostname,
-                controller.METRICS_COUNTER: counters,
-                controller.METRICS_GAUGE: self.sign_gauges(gauges),
-                controller.METRICS_SET: sets,
-                controller.METRICS_TIMER: timers,
-                controller.METRICS_INTERNAL: {
-                    controller.METRICS_COUNTER: int_counters,
-                    controller.METRICS_GAUGE: int_gauges}}
+        int_counters = dict(int_counters)
+        int_counters[self.internal_key(EXCEPTIONS)] = self.exceptions
+        int_gauges = dict(int_gauges)
+        int_gauges[self.internal_key(LAST_EXCEPTION)] = self.last_exception
+        int_gauges[self.internal_key(LAST_FLUSH)] = timestamp
+        internal = {controller.METRICS_COUNTER: int_counters,
+                    controller.METRICS_GAUGE: int_gauges,
+                    controller.METRICS_TIMER: int_timers}
+        if self.legacy_format:
+            for metric_type in internal:
+                internal[metric_type] = self.nested(internal[metric_type])
+        return internal
+
+    def internal_key(self, name):
+        """Return the internal stats key for a stat about this backend
+
+        :param str name: The stat name
+        :rtype: tuple
+
+        """
+        return (controller.METRICS_BACKEND, self.hostname,
+                '%s.%s' % (UPSTREAM, name))
+
+    @staticmethod
+    def nested(values):
+        """Return internal stats keyed by (metric type, host, name) tuples as
+        nested metric type -> host -> name dicts.
+
+        :param dict values: The internal stats
+        :rtype: dict
+
+        """
+        output = dict()
+        for (metric_type, host, name), value in values.iteritems():
+            output.setdefault(metric_type, dict()).setdefault(
+                host, dict())[name] = value
+        return output
 
     def sign_gauges(self, values):
         """Sign the value and return it as a string.
@@ -123,7 +228,7 @@ class UpstreamBackend(base.Backend):
         output = dict()
         for key in values:
             if values[key] < 0:
-                output[key] = '-%s' % values[key]
+                output[key] = '%s' % values[key]
             elif values[key] > 0:
                 output[key] = '+%s' % values[key]
             else:
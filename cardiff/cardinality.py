@@ -0,0 +1,126 @@
+"""
+cardinality.py
+
+"""
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+OVERFLOW = '__overflow__'
+PREFIX_DEPTH = 1
+
+
+class Budget(object):
+    """Limit the number of distinct series aggregated per flush interval,
+    globally and per key prefix. Updates for new series over the limit are
+    folded into the __overflow__ series, and the number of folded updates is
+    tracked per prefix so the source can be found.
+
+    Series already admitted this interval cost a dict and a set lookup, and
+    new series over the limit are not registered so that the registry does
+    not grow with them.
+
+    """
+    def __init__(self, registry, config):
+        """Create a new budget
+
+        :param cardiff.series.Registry registry: The series registry
+        :param dict config: The cardinality configuration
+
+        """
+        self.registry = registry
+        self.max_keys = config.get('max_keys')
+        self.prefix_depth = config.get('prefix_depth', PREFIX_DEPTH)
+        self.prefix_limit = config.get('prefix_limit')
+        self.prefix_limits = config.get('prefixes') or dict()
+        self.overflow = registry.pin(OVERFLOW)
+        self.admitted = set()
+        self.prefix_counts = dict()
+        self.overflows = dict()
+
+    def admit(self, series, prefix=None):
+        """Return the id to aggregate a registered series under, admitting it
+        if it is within budget.
+
+        :param cardiff.series.Series series: The series to admit
+        :param str prefix: The prefix of the series if already known
+        :rtype: int
+
+        """
+        if series.id in self.admitted:
+            return series.id
+        if prefix is None:
+            prefix = self.prefix(series.name)
+        if self.over_limit(prefix):
+            return self.fold(prefix)
+        self.admitted.add(series.id)
+        self.prefix_counts[prefix] = self.prefix_counts.get(prefix, 0) + 1
+        return series.id
+
+    def fold(self, prefix):
+        """Count an update folded into the overflow series for the prefix,
+        returning the overflow series id.
+
+        :param str prefix: The prefix of the key that was folded
+        :rtype: int
+
+        """
+        self.overflows[prefix] = self.overflows.get(prefix, 0) + 1
+        return self.overflow.id
+
+    def over_limit(self, prefix):
+        """Return True if admitting a new series with the prefix would exceed
+        the global or prefix limit.
+
+        :param str prefix: The key prefix
+        :rtype: bool
+
+        """
+        if self.max_keys and len(self.admitted) >= self.max_keys:
+            return True
+        limit = self.prefix_limits.get(prefix, self.prefix_limit)
+        return bool(limit) and self.prefix_counts.get(prefix, 0) >= limit
+
+    def prefix(self, name):
+        """Return the first prefix_depth segments of the metric name
+
+        :param str name: The metric name
+        :rtype: str
+
+        """
+        return '.'.join(name.split('.', self.prefix_depth)[:self.prefix_depth])
+
+    def reset(self):
+        """Start a new interval, returning the number of series admitted and
+        the folded update counts by prefix for the interval that ended.
+
+        :rtype: tuple(int, dict)
+
+        """
+        admitted, overflows = len(self.admitted), self.overflows
+        if overflows:
+            LOGGER.warning('Folded updates into %s by prefix: %r',
+                           OVERFLOW, overflows)
+        self.admitted = set()
+        self.prefix_counts = dict()
+        self.overflows = dict()
+        return admitted, overflows
+
+    def series_id(self, key, tag_string=None):
+        """Return the id to aggregate the raw key and tag string under,
+        registering the series only if it is within budget.
+
+        :param str key: The raw metric key
+        :param str tag_string: The raw DogStatsD tag string
+        :rtype: int
+
+        """
+        series = self.registry.find(key, tag_string)
+        if series is not None:
+            if series.id in self.admitted:
+                return series.id
+            return self.admit(series)
+        prefix = self.prefix(key)
+        if self.over_limit(prefix):
+            return self.fold(prefix)
+        return self.admit(self.registry.register(key, tag_string), prefix)
@@ -0,0 +1,222 @@
+"""
+consumer.py
+
+"""
+import calendar
+import datetime
+import logging
+import Queue
+import rmqid
+from rmqid import exceptions
+from pamqp import specification
+import socket
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+PREFETCH = 100
+RECONNECT_DELAY = 5
+
+
+class AMQPConsumer(object):
+    """Consume statsd line bodies from a RabbitMQ queue in batches,
+    acknowledging each batch once its lines have been aggregated.
+
+    rmqid is a blocking client, so a thread reads the messages the broker
+    delivers into a local queue, which the prefetch count keeps bounded since
+    the broker stops delivering once prefetch messages are unacknowledged.
+    The IOLoop takes up to batch_size messages at a time from the local
+    queue, aggregates them and acknowledges the batch with a single multiple
+    ack. A message that can not be aggregated is rejected without being
+    requeued, dead-lettering it if the queue has a dead letter exchange.
+
+    """
+    def __init__(self, config, ioloop, on_message_callback):
+        """Create a new consumer
+
+        :param dict config: The AMQP input configuration
+        :param tornado.ioloop.IOLoop ioloop: The IOLoop to aggregate on
+        :param method on_message_callback: Called with the message body and
+            the message timestamp on the IOLoop
+
+        """
+        self.config = config
+        self.ioloop = ioloop
+        self.on_message_callback = on_message_callback
+        self.batch_size = config.get('batch_size', BATCH_SIZE)
+        self.prefetch = config.get('prefetch', PREFETCH)
+        self.queue_name = config.get('queue', 'cardiff')
+        self.channel = None
+        self.queue = None
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.messages = Queue.Queue()
+        self.running = False
+        self.scheduled = False
+        self.thread = None
+
+    @property
+    def amqp_uri(self):
+        virtual_host = self.config.get('virtual_host', '/')
+        if virtual_host == '/':
+            virtual_host = '%2F'
+        return 'amqp://%s:%s@%s:%s/%s' % (self.config.get('user', 'guest'),
+                                          self.config.get('password', 'guest'),
+                                          self.config.get('host', 'localhost'),
+                                          self.config.get('port', 5672),
+                                          virtual_host)
+
+    def start(self):
+        """Start the consumer thread"""
+        LOGGER.info('Consuming from %s on %s with a prefetch of %i in '
+                    'batches of %i', self.queue_name,
+                    self.config.get('host', 'localhost'), self.prefetch,
+                    self.batch_size)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop consuming, cancelling the consumer so a read blocked waiting
+        for the next message returns. Messages that have not been aggregated
+        are not acknowledged and are redelivered by the broker. Must be
+        invoked in the IOLoop thread, which acknowledges the batches.
+
+        """
+        self.running = False
+        channel, queue = self.channel, self.queue
+        if channel is None or queue is None or not queue.consuming:
+            return
+        try:
+            channel._write_frame(specification.Basic.Cancel(
+                consumer_tag=queue.consumer_tag))
+        except (exceptions.AMQPException, socket.error, TypeError) as error:
+            LOGGER.warning('Could not cancel the AMQP consumer: %s', error)
+
+    def run(self):
+        """Consume until stopped, reconnecting on connection failures"""
+        while self.running:
+            try:
+                self.consume()
+            except (exceptions.ChannelClosedException,
+                    exceptions.RemoteClosedChannelException,
+                    exceptions.RemoteClosedException,
+                    socket.error) as error:
+                # Messages read on the failed connection are redelivered
+                self.generation += 1
+                if not self.running:
+                    break
+                LOGGER.error('AMQP consumer error, reconnecting in %is: %s',
+                             RECONNECT_DELAY, error)
+                time.sleep(RECONNECT_DELAY)
+        LOGGER.info('AMQP consumer stopped')
+
+    def consume(self):
+        """Connect, set the prefetch count and read messages into the local
+        queue as they are delivered, until the consumer is cancelled.
+
+        """
+        with rmqid.Connection(self.amqp_uri) as conn:
+            with conn.channel() as channel:
+                channel.prefetch_count(self.prefetch)
+                queue = rmqid.Queue(channel, self.queue_name)
+                if self.config.get('exchange'):
+                    queue.declare()
+                    queue.bind(self.config['exchange'],
+                               self.config.get('routing_key', '#'))
+                with queue.consumer() as consumer:
+                    self.channel, self.queue = channel, queue
+                    try:
+                        for message in consumer.next_message():
+                            # The broker confirms a cancel with Basic.CancelOk
+                            if not isinstance(message, rmqid.Message):
+                                break
+                            self.messages.put((self.generation, message))
+                            self.schedule()
+                    finally:
+                        self.channel, self.queue = None, None
+
+    def schedule(self):
+        """Have the IOLoop process the local queue if it is not already
+        scheduled to.
+
+        """
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.ioloop.add_callback(self.process)
+
+    def process(self):
+        """Aggregate a batch of messages from the local queue on the IOLoop,
+        acknowledging them with one multiple ack, and schedule the next
+        batch if there are more messages waiting.
+
+        """
+        with self.lock:
+            self.scheduled = False
+        if not self.running:
+            return
+        batch = list()
+        while len(batch) < self.batch_size:
+            try:
+                generation, message = self.messages.get_nowait()
+            except Queue.Empty:
+                break
+            if generation == self.generation:
+                batch.append(message)
+
+        acknowledge = None
+        for message in batch:
+            try:
+                self.on_message_callback(message.body,
+                                         self.timestamp(message))
+            except Exception:
+                LOGGER.exception('Error processing an AMQP message, '
+                                 'rejecting it')
+                self.settle(message.reject)
+                continue
+            acknowledge = message
+
+        # Rejected messages are settled, so only the aggregated messages are
+        # acknowledged by acknowledging all up to the last one
+        if acknowledge:
+            self.settle(acknowledge.ack, all_previous=True)
+        if not self.messages.empty():
+            self.schedule()
+
+    @staticmethod
+    def settle(method, **kwargs):
+        """Acknowledge or reject a message, logging instead of raising if the
+        connection has failed, in which case the broker redelivers it.
+
+        :param method method: The message method to invoke
+        :param dict kwargs: The method arguments
+
+        """
+        try:
+            method(**kwargs)
+        except (exceptions.AMQPException, socket.error, TypeError) as error:
+            LOGGER.warning('Could not settle the AMQP message: %s', error)
+
+    @staticmethod
+    def timestamp(message):
+        """Return the message timestamp as a UNIX epoch value, or None if it
+        is not set. AMQP timestamps are UTC and whole seconds, while rmqid
+        sets the local time, with microseconds, on messages without one.
+
+        :param rmqid.Message message: The message
+        :rtype: float or None
+
+        """
+        value = message.properties.get('timestamp')
+        if isinstance(value, datetime.datetime):
+            if value.microsecond:
+                return None
+            return calendar.timegm(value.timetuple())
+        elif isinstance(value, time.struct_time):
+            return calendar.timegm(value)
+        return value
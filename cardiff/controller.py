@@ -1,6 +1,6 @@
 import helper
 import collections
-import copy
+import heapq
 from tornado import ioloop
 import logging
 from helper import parser
@@ -11,8 +11,23 @@ import socket
 import threading
 import time
 
+from cardiff import admin
 from cardiff import backends
+from cardiff import cardinality
+from cardiff import health
+from cardiff import history
+from cardiff import instruments
+from cardiff import profiling
+from cardiff import recording
+from cardiff import retention
+from cardiff import rollups
+from cardiff import rules
+from cardiff import samples
+from cardiff import series
 from cardiff import servers
+from cardiff import shedding
+from cardiff import topk
+from cardiff import workers
 from cardiff import __version__
 
 LOGGER = logging.getLogger(__name__)
@@ -22,27 +37,60 @@ BACKLOG = 1024
 HOST = '0.0.0.0'
 STATSD_PORT = 8125
 UPSTREAM_PORT = 8126
+HTTP_PORT = 8128
+ADMIN_HOST = '127.0.0.1'
+ADMIN_PORT = 8129
+UNIX_PATH = '/var/run/cardiff.sock'
+CAPTURE_PATH = '/var/tmp/cardiff.capture'
 FLUSH_INTERVAL = 300
 
 # Parsing stats
-SAMPLE_RATE = re.compile(u'/^@([\d\.]+)/')
-SIGNED_GAUGE = re.compile(u'/^[-+]/')
+SAMPLE_RATE = re.compile(r'^@(\d+\.?\d*|\.\d+)$')
+SHED_TYPES = ('c', 'ms')
+SIGNED_GAUGE = re.compile(r'^[-+]')
 
 # Internal Stats constants
+METRICS_AMQP_BYTES_RECEIVED = 'amqp_bytes_received'
+METRICS_AMQP_CONSUMER_LAG = 'amqp_consumer_lag'
+METRICS_AMQP_MESSAGES_RECEIVED = 'amqp_messages_received'
 METRICS_BAD_STATS_RECEIVED = 'bad_lines_seen'
+METRICS_CARDINALITY_KEYS = 'cardinality.keys'
+METRICS_CARDINALITY_OVERFLOW = 'cardinality.overflow.%s'
+METRICS_BULK_LINES_RECEIVED = 'bulk_lines_received'
+METRICS_BULK_PROCESSING_TIME = 'bulk_processing_time'
+METRICS_BULK_REQUESTS_RECEIVED = 'bulk_requests_received'
 METRICS_BACKEND = 'backend'
 METRICS_CONTROLLER = 'controller'
 METRICS_COUNTER = 'counters'
 METRICS_DELIVERY_TIME = 'delivery_time'
 METRICS_GAUGE = 'gauges'
+METRICS_HISTORY_BYTES = 'history.bytes'
+METRICS_HISTORY_DROPPED = 'history.dropped_series'
+METRICS_HISTORY_SERIES = 'history.series'
+METRICS_HISTORY_TIME = 'history_time'
 METRICS_HOST = 'host'
 METRICS_INTERNAL = 'internal'
 METRICS_PACKETS_RECEIVED = 'packets_received'
 METRICS_PREFIX = 'cardiff'
 METRICS_PROCESSING_TIME = 'processing_time'
+METRICS_ROLLUP_SERIES = 'rollup_series'
+METRICS_ROLLUP_TIME = 'rollup_time'
+METRICS_RULE_HITS = 'rules.%s.hits'
+METRICS_RETAINED_GAUGES = 'retention.gauges'
+METRICS_RETENTION_EXPIRED = 'retention.expired_series'
 METRICS_SET = 'sets'
+METRICS_SHEDDING_LAG = 'shedding.max_ioloop_lag'
+METRICS_SHEDDING_LINES = 'shedding.lines_shed'
+METRICS_SHEDDING_LOWEST_RATE = 'shedding.lowest_sample_rate'
+METRICS_SHEDDING_RATE = 'shedding.sample_rate'
 METRICS_SNAPSHOT_TIME = 'snapshot_time'
 METRICS_TIMER = 'timers'
+METRICS_TOPK_TIMER_BYTES = 'topk.timer_bytes.%i'
+METRICS_TOPK_TIMER_SAMPLES = 'topk.timer_samples.%i'
+METRICS_TOPK_UPDATES = 'topk.updates.%i'
+METRICS_WORKER_PENDING = 'workers.%s.pending'
+METRICS_WORKER_RESTARTS = 'workers.%s.restarts'
+METRICS_WORKER_SKIPPED = 'workers.%s.skipped'
 
 METRICS_DOWNSTREAM_PACKETS_RECEIVED = 'downstream_packets_received'
 METRICS_DOWNSTREAM_PAYLOADS_RECEIVED = 'downstream_payloads_received'
@@ -62,22 +110,54 @@ def hostname():
     return socket.gethostname().split('.')[0]
 
 
-def merge_dicts(d, u):
-    """Merge two nested dictionaries, stolen from
-            http://stackoverflow.com/questions/3232943
+def sanitize(key):
+    """Return the metric key with invalid characters replaced
 
-    :param dict d: First dict to merge
-    :param dict u: Second dict to merge
+    :param str key: The raw metric key
+    :rtype: str
+
+    """
+    for pattern, replacement in FIXUP:
+        key = pattern.sub(replacement, key)
+    return key
+
+
+def internal_items(values):
+    """Return internal stats received from a downstream cardiff keyed by
+    (metric type, host, name) tuples. Older versions send them nested as
+    type -> host -> name dicts, which are flattened with names below the host
+    joined by dots.
+
+    :param dict values: The internal stats
     :rtype: dict
 
     """
-    for k, v in u.iteritems():
-        if isinstance(v, collections.Mapping):
-            r = merge_dicts(d.get(k, {}), v)
-            d[k] = r
+    if not values or isinstance(next(iter(values)), tuple):
+        return values or dict()
+    items = dict()
+    for metric_type, hosts in values.iteritems():
+        for host, names in hosts.iteritems():
+            for name, value in nested_items(names):
+                items[(metric_type, host, name)] = value
+    return items
+
+
+def nested_items(values, prefix=None):
+    """Iterate over a nested dict yielding the dot joined path and value of
+    each leaf.
+
+    :param dict values: The nested dict
+    :param str prefix: The path of the parent dict
+    :rtype: iter
+
+    """
+    for key, value in values.iteritems():
+        name = '%s.%s' % (prefix, key) if prefix else key
+        if isinstance(value, collections.Mapping):
+            for item in nested_items(value, name):
+                yield item
         else:
-            d[k] = u[k]
-    return d
+            yield name, value
 
 
 class Cardiff(helper.Controller):
@@ -102,23 +182,190 @@ class Cardiff(helper.Controller):
         self.internal_gauge('memory_usage', ru_maxrss)
         self.internal_gauge('forced_context_switches', usage.ru_nivcsw)
 
+    def add_health_usage(self):
+        """Add the kernel socket, garbage collection, thread and file
+        descriptor stats to the stats to be reported.
+
+        """
+        gauges, counters = self.health.collect()
+        for name, value in gauges.iteritems():
+            self.internal_gauge(name, value)
+        for name, value in counters.iteritems():
+            self.internal_incr(name, value)
+
+    def add_history_usage(self):
+        """Add the number of series kept in the history, the memory used by
+        their values and the series dropped because the history is full to
+        the stats to be reported.
+
+        """
+        series_count, size, dropped = self.history.usage()
+        self.internal_gauge(METRICS_HISTORY_SERIES, series_count)
+        self.internal_gauge(METRICS_HISTORY_BYTES, size)
+        self.internal_incr(METRICS_HISTORY_DROPPED, dropped)
+
+    def add_cardinality_usage(self):
+        """Add the number of series aggregated in the interval and the
+        number of updates folded into the overflow series by prefix to the
+        stats to be reported, starting a new cardinality interval.
+
+        """
+        admitted, overflows = self.cardinality.reset()
+        self.internal_gauge(METRICS_CARDINALITY_KEYS, admitted)
+        for prefix, count in overflows.iteritems():
+            self.internal_incr(METRICS_CARDINALITY_OVERFLOW % prefix, count)
+
+    def add_topk_usage(self):
+        """Add the update counts of the most updated keys and the sizes of
+        the timers holding the most samples to the stats to be reported by
+        rank, logging the keys of each rank, and start a new heavy hitter
+        interval. Reporting by rank keeps the number of internal stats fixed
+        as the hot keys change.
+
+        """
+        lookup = self.registry.series
+        ranks = list()
+        for series_id, count, error in self.topk.top(self.topk_size):
+            if lookup[series_id] is not None:
+                ranks.append(lookup[series_id].path)
+                self.internal_gauge(METRICS_TOPK_UPDATES % len(ranks), count)
+        self.topk.reset()
+        if ranks:
+            LOGGER.info('Most updated keys: %s',
+                        ', '.join(['%i=%s' % (rank, path) for rank, path
+                                   in enumerate(ranks, 1)]))
+        ranks = list()
+        for series_id, values in heapq.nlargest(self.topk_size,
+                                                self.timers.iteritems(),
+                                                lambda item: len(item[1])):
+            ranks.append(lookup[series_id].path)
+            self.internal_gauge(METRICS_TOPK_TIMER_SAMPLES % len(ranks),
+                                len(values))
+            self.internal_gauge(METRICS_TOPK_TIMER_BYTES % len(ranks),
+                                len(values) * values.itemsize)
+        if ranks:
+            LOGGER.info('Largest timers: %s',
+                        ', '.join(['%i=%s' % (rank, path) for rank, path
+                                   in enumerate(ranks, 1)]))
+
+    def add_workers_usage(self):
+        """Add the snapshots pending, restarts and skipped deliveries of each
+        backend worker process to the stats to be reported.
+
+        """
+        for name, (pending, restarts, skipped) in \
+                self.workers.usage().iteritems():
+            self.internal_gauge(METRICS_WORKER_PENDING % name, pending)
+            self.internal_incr(METRICS_WORKER_RESTARTS % name, restarts)
+            self.internal_incr(METRICS_WORKER_SKIPPED % name, skipped)
+
+    def add_rules_usage(self):
+        """Add the number of keys each ingest rule matched in the interval to
+        the stats to be reported.
+
+        """
+        for name, hits in self.rules.reset_hits().iteritems():
+            self.internal_incr(METRICS_RULE_HITS % name, hits)
+
+    def apply_rollups(self, stats):
+        """Add the series derived by the rollups to the snapshot, timing
+        how long it takes. The internal stats in the snapshot have already
+        been taken, so the timing is reported in the next interval.
+
+        :param list stats: The snapshot values
+
+        """
+        start_time = time.time()
+        derived = self.rollups.apply(stats[1], stats[2], stats[4])
+        self.internal_gauge(METRICS_ROLLUP_SERIES, derived)
+        self.rollup_time.observe(start_time)
+
+    def add_shedding_usage(self):
+        """Add the effective sample rate, the lowest sample rate, the largest
+        IOLoop lag in the interval to the stats to be reported.
+
+        """
+        rate, lowest_rate, max_lag = self.shedder.reset()
+        self.internal_gauge(METRICS_SHEDDING_RATE, rate)
+        self.internal_gauge(METRICS_SHEDDING_LOWEST_RATE, lowest_rate)
+        self.internal_gauge(METRICS_SHEDDING_LAG, max_lag)
+
     def cleanup(self):
         """Invoked when Cardiff is shutting down"""
         self.set_state(self.STATE_STOPPING)
         self.timer.stop()
-        self.statsd_server.close()
+        if self.statsd_server:
+            self.statsd_server.close()
+        if self.unix_server:
+            self.unix_server.close()
+        if self.http_server:
+            self.http_server.stop()
+        if self.amqp_consumer:
+            self.amqp_consumer.stop()
+        if self.shedder:
+            self.shedder.stop()
+        if self.admin_server:
+            self.admin_server.stop()
+        if self.profiler.active:
+            self.profiler.stop()
+        if self.workers:
+            self.workers.stop()
         if self.ioloop._running:
             self.ioloop.stop()
 
     def create_empty_stat_attributes(self):
         """Create the attributes for carrying stats around"""
+        self.registry = series.Registry(sanitize)
+        self.cardinality = None
+        self.history = None
+        self.retention = None
+        self.rollups = None
+        self.rules = None
+        self.shedder = None
+        self.topk = None
+        self.topk_size = topk.SIZE
+        self.health = None
+        self.backend_health = dict()
         self.counters = dict()
         self.gauges = dict()
         self.sets = dict()
         self.timers = dict()
-        self.internal_counters = self.new_int_metric_dict()
-        self.internal_gauges = self.new_int_metric_dict()
-        self.internal_timers = self.new_int_metric_dict()
+        self.internal_counters = dict()
+        self.internal_gauges = dict()
+        self.internal_timers = dict()
+        self.create_instruments()
+
+    def create_instruments(self):
+        """Create the handles for the internal stats updated per packet or
+        line.
+
+        """
+        self.instruments = instruments.Instruments()
+        counter = self.instruments.counter
+        self.amqp_bytes = counter(METRICS_AMQP_BYTES_RECEIVED)
+        self.amqp_messages = counter(METRICS_AMQP_MESSAGES_RECEIVED)
+        self.bad_lines = counter(METRICS_BAD_STATS_RECEIVED)
+        self.bulk_lines = counter(METRICS_BULK_LINES_RECEIVED)
+        self.counter_updates = counter(METRICS_COUNTER)
+        self.downstream_packets = counter(METRICS_DOWNSTREAM_PACKETS_RECEIVED)
+        self.gauge_updates = counter(METRICS_GAUGE)
+        self.lines_shed = counter(METRICS_SHEDDING_LINES)
+        self.packets_received = counter(METRICS_PACKETS_RECEIVED)
+        self.set_updates = counter(METRICS_SET)
+        self.timer_updates = counter(METRICS_TIMER)
+        histogram = self.instruments.histogram
+        self.amqp_consumer_lag = histogram(METRICS_AMQP_CONSUMER_LAG)
+        self.bulk_processing_time = histogram(METRICS_BULK_PROCESSING_TIME)
+        self.delivery_time = histogram(METRICS_DELIVERY_TIME)
+        self.history_time = histogram(METRICS_HISTORY_TIME)
+        self.processing_time = histogram(METRICS_PROCESSING_TIME)
+        self.rollup_time = histogram(METRICS_ROLLUP_TIME)
+        self.snapshot_time = histogram(METRICS_SNAPSHOT_TIME)
+        self.delivery_times = dict()
+        for backend in getattr(self, 'backends', []):
+            self.delivery_times[backend.name] = \
+                histogram(METRICS_BACKEND_DELIVERY_DURATION % backend.name,
+                          metric_type=METRICS_BACKEND)
 
     def deliver_stats(self, backend, timestamp, counters, gauges, sets, timers,
                       int_counters, int_gauges, int_timers):
@@ -138,19 +385,60 @@ class Cardiff(helper.Controller):
         """
         backend_start_time = time.time()
         LOGGER.debug('Delivering metrics to %s', backend.name)
-        backend.deliver(timestamp,
-                        copy.deepcopy(counters),
-                        copy.deepcopy(gauges),
-                        copy.deepcopy(sets),
-                        copy.deepcopy(timers),
-                        copy.deepcopy(int_counters),
-                        copy.deepcopy(int_gauges),
-                        copy.deepcopy(int_timers))
-
-        self.internal_timer(METRICS_BACKEND_DELIVERY_DURATION %
-                            backend.name, backend_start_time, METRICS_BACKEND)
+        error = None
+        try:
+            backend.deliver(timestamp, counters, gauges, sets, timers,
+                            int_counters, int_gauges, int_timers)
+        except Exception as error:
+            LOGGER.exception('Error delivering metrics to %s', backend.name)
+            error = repr(error)
+        self.record_delivery(backend.name,
+                             (time.time() - backend_start_time) * 1000, error)
         LOGGER.debug('Metrics delivered')
 
+    def query_history(self, pattern, start=None, end=None, resolution=None):
+        """Invoked by the HTTP server to return the recent values of the
+        series matching the glob, or None if the history is not enabled.
+
+        :param str pattern: The glob
+        :param int start: The start of the time range
+        :param int end: The end of the time range
+        :param int resolution: The resolution to return values at
+        :rtype: dict or None
+        :raises: ValueError
+
+        """
+        if not self.history:
+            return None
+        return self.history.query(pattern, start, end, resolution)
+
+    def record_history(self, stats):
+        """Add the snapshot values to the in-memory history, timing how long
+        it takes.
+
+        :param list stats: The snapshot values
+
+        """
+        start_time = time.time()
+        self.history.record(*stats[:5])
+        self.history_time.observe(start_time)
+
+    def record_delivery(self, name, duration, error=None):
+        """Record the duration and any error of a delivery to a backend
+
+        :param str name: The backend name
+        :param float duration: The delivery duration in milliseconds
+        :param str error: The error if delivery failed
+
+        """
+        health = self.backend_health.setdefault(name, {'errors': 0})
+        if error:
+            health['errors'] += 1
+            health['last_error'] = error
+        self.delivery_times[name].record(duration)
+        health['duration'] = duration
+        health['last_flush'] = int(time.time())
+
     def downstream_data(self, host, counters, gauges, sets, timers, internal):
         """Process downstream data adding the metrics in to internal values
 
@@ -168,45 +456,59 @@ class Cardiff(helper.Controller):
         # Process counter values
         LOGGER.debug('Processing %i downstream counter values', len(counters))
         for key in counters.keys():
-            self.handle_counter(key, counters[key])
-            self.internal_incr(METRICS_DOWNSTREAM_PACKETS_RECEIVED)
+            self.handle_counter(self.downstream_series_id(key), counters[key])
+            self.downstream_packets.value += 1
 
-        # Process gauge values
+        # Process gauge values, which are signed but absolute
         LOGGER.debug('Processing %i downstream gauge values', len(gauges))
         for key in gauges.keys():
-            self.handle_gauge(key, gauges[key])
-            self.internal_incr(METRICS_DOWNSTREAM_PACKETS_RECEIVED)
+            self.handle_gauge(self.downstream_series_id(key),
+                              int(gauges[key]))
+            self.downstream_packets.value += 1
 
         # Process set values
         LOGGER.debug('Processing %i downstream set values', len(sets))
         for key in sets.keys():
-            self.handle_set(key, sets[key])
-            self.internal_incr(METRICS_DOWNSTREAM_PACKETS_RECEIVED)
+            series_id = self.downstream_series_id(key)
+            for value in sets[key]:
+                self.handle_set(series_id, value, sets[key][value])
+            self.downstream_packets.value += 1
 
         # Process timer values
         LOGGER.debug('Processing %i downstream timer values', len(timers))
         for key in timers.keys():
-            if key not in self.timers:
-                self.timers[key] = list()
-            self.timers[key] += timers[key]
-            self.internal_incr(METRICS_TIMER, len(timers[key]))
-            self.internal_incr(METRICS_DOWNSTREAM_PACKETS_RECEIVED)
+            series_id = self.downstream_series_id(key)
+            try:
+                self.timers[series_id].merge(timers[key])
+            except KeyError:
+                self.timers[series_id] = samples.Samples()
+                self.timers[series_id].merge(timers[key])
+            self.timer_updates.value += len(timers[key])
+            self.downstream_packets.value += 1
 
         # Set the internal metrics for the remote host
-        LOGGER.debug('Merging downstream internal counts with own')
-        self.internal_counters = merge_dicts(self.internal_counters,
-                                             internal[METRICS_COUNTER])
+        LOGGER.debug('Merging downstream internal stats with own')
+        self.internal_counters.update(
+            internal_items(internal.get(METRICS_COUNTER)))
+        self.internal_gauges.update(
+            internal_items(internal.get(METRICS_GAUGE)))
+        self.internal_timers.update(
+            internal_items(internal.get(METRICS_TIMER)))
 
-        LOGGER.debug('Merging downstream internal gauges with own')
-        self.internal_gauges = merge_dicts(self.internal_gauges,
-                                           internal[METRICS_GAUGE])
+        # Increment the processing time for metrics overall
+        self.processing_time.observe(start_time)
 
-        LOGGER.debug('Merging downstream internal timers with own')
-        self.internal_timers = merge_dicts(self.internal_timers,
-                                           internal[METRICS_TIMER])
+    def downstream_series_id(self, key):
+        """Return the id to aggregate a downstream metric key under
 
-        # Increment the processing time for metrics overall
-        self.internal_timer(METRICS_PROCESSING_TIME, start_time)
+        :param str key: The metric key
+        :rtype: int
+
+        """
+        value = self.registry.lookup(key)
+        if self.cardinality:
+            return self.cardinality.admit(value)
+        return value.id
 
     @property
     def flush_interval(self):
@@ -217,77 +519,79 @@ class Cardiff(helper.Controller):
         """
         return self.config.application.get('flush_interval') or FLUSH_INTERVAL
 
-    def handle_counter(self, key, value=1, sample_size=1):
+    def handle_counter(self, series_id, value=1, sample_size=1, weight=1):
         """Handle counter packet data, incrementing the value.
 
-        :param str key: The counter key
+        :param int series_id: The counter series id
         :param (int or float) value: The counter value
         :param float sample_size: The sample size for the count
+        :param int weight: The number of updates the update stands for
 
         """
-        self.incr(key, int(value) * (1 / sample_size))
-        self.internal_incr(METRICS_COUNTER)
+        self.incr(series_id, int(value) * weight * (1 / sample_size))
+        self.counter_updates.value += 1
 
-    def handle_gauge(self, key, value=1):
+    def handle_gauge(self, series_id, value=1):
         """Handle gauge packet data, incrementing the value if the value is
         signed, otherwise setting it to an absolute value.
 
-        :param str key: The gauge key
+        :param int series_id: The gauge series id
         :param int value: The gauge value
 
         """
-        if key not in self.gauges.keys():
-            self.gauges[key] = 0
-
-        if SIGNED_GAUGE.match(value):
-            self.gauges[key] += int(value)
+        if isinstance(value, basestring) and SIGNED_GAUGE.match(value):
+            try:
+                self.gauges[series_id] += int(value)
+            except KeyError:
+                retained = self.retention.gauge(series_id) \
+                    if self.retention else 0
+                self.gauges[series_id] = retained + int(value)
         else:
-            self.gauges[key] = int(value)
-        self.internal_incr(METRICS_GAUGE)
+            self.gauges[series_id] = int(value)
+        self.gauge_updates.value += 1
 
-    def handle_set(self, key, value=1):
+    def handle_set(self, series_id, value=1, count=1):
         """Increment the count of times this value has been added to the set
 
-        :param str key: The set key
+        :param int series_id: The set series id
         :param (int or float) value: The set value
+        :param int count: The number of times the value was added
 
         """
-        if key not in self.sets.keys():
-            self.sets[key] = dict()
         try:
-            self.sets[key][value] += 1
+            values = self.sets[series_id]
         except KeyError:
-            self.sets[key] = {value: 1}
-        self.internal_incr(METRICS_SET)
+            values = self.sets[series_id] = dict()
+        values[value] = values.get(value, 0) + count
+        self.set_updates.value += 1
 
-    def handle_timer(self, key, value=0, sample_size=1):
-        """Append the timer value up to the size of the sample.
+    def handle_timer(self, series_id, value=0, sample_size=1):
+        """Append the timer value, weighted by the inverse of the sample rate
+        so the timer count reflects the number of timings it represents.
 
-        :param str key: The timer key
+        :param int series_id: The timer series id
         :param (int or float) value: The timer value
-        :param float sample_size: The number of times the value was sampled
+        :param float sample_size: The rate the value was sampled at
 
         """
-        if sample_size < 1:
-            sample_size = 1
-        for iteration in range(0, int(sample_size)):
-            try:
-                self.timers[key].append(float(value))
-            except KeyError:
-                self.timers[key] = [float(value)]
-        self.internal_incr(METRICS_TIMER)
+        try:
+            self.timers[series_id].add(float(value), 1 / sample_size)
+        except KeyError:
+            self.timers[series_id] = samples.Samples([float(value)],
+                                                     1 / sample_size)
+        self.timer_updates.value += 1
 
-    def incr(self, key, value=1):
+    def incr(self, series_id, value=1):
         """Increment a counter by the value.
 
-        :param str key: The key to increment
+        :param int series_id: The series id to increment
         :param int value: The value to increment by
 
         """
         try:
-            self.counters[key] += value
+            self.counters[series_id] += value
         except KeyError:
-            self.counters[key] = value
+            self.counters[series_id] = value
 
     def internal_gauge(self, name, value, metric_type=METRICS_CONTROLLER):
         """Set an internal gauge specified by key
@@ -297,11 +601,7 @@ class Cardiff(helper.Controller):
         :param str metric_type: The metric type (controller, backend)
 
         """
-        try:
-            self.internal_gauges[metric_type][self.host][name] = value
-        except KeyError:
-            self.internal_gauges[metric_type][self.host] = dict()
-            self.internal_gauge(name, value)
+        self.internal_gauges[(metric_type, self.host, name)] = value
 
     def internal_incr(self, key, value=1, metric_type=METRICS_CONTROLLER):
         """Increment an internal counter specified by key
@@ -311,10 +611,11 @@ class Cardiff(helper.Controller):
         :param str metric_type: The metric type (controller, backend)
 
         """
+        key = metric_type, self.host, key
         try:
-            self.internal_counters[metric_type][self.host][key] += value
+            self.internal_counters[key] += value
         except KeyError:
-            self.internal_counters[metric_type][self.host][key] = value
+            self.internal_counters[key] = value
 
     def internal_timer(self, key, start_time, metric_type=METRICS_CONTROLLER):
         """Calculate the duration of now - start_time and append it to a timer
@@ -325,21 +626,56 @@ class Cardiff(helper.Controller):
         :param str metric_type: The metric type (controller, backend)
 
         """
+        duration = (time.time() - start_time) * 1000
+        key = metric_type, self.host, key
         try:
-            duration = (time.time() - start_time) * 1000
-            self.internal_timers[metric_type][self.host][key].append(duration)
+            self.internal_timers[key].append(duration)
         except KeyError:
-            self.internal_timers[metric_type][self.host][key] = list()
-            self.internal_timer(key, start_time, metric_type)
+            self.internal_timers[key] = [duration]
 
-    def new_int_metric_dict(self):
-        """Return a new internal metric data structure for the current host.
+    def memory_structures(self):
+        """Return the structures that grow with the number of keys by name,
+        for comparing memory between flushes.
 
         :rtype: dict
 
         """
-        return {METRICS_BACKEND: {self.host: {}},
-                METRICS_CONTROLLER: {self.host: {}}}
+        structures = {'counters': self.counters,
+                      'gauges': self.gauges,
+                      'sets': self.sets,
+                      'timers': self.timers,
+                      'internal_counters': self.internal_counters,
+                      'internal_gauges': self.internal_gauges,
+                      'internal_timers': self.internal_timers,
+                      'registry.raw': self.registry.raw,
+                      'registry.aliases': self.registry.aliases,
+                      'registry.canonical': self.registry.canonical,
+                      'registry.series': self.registry.series,
+                      'registry.free': self.registry.free}
+        if self.retention:
+            structures['retention.gauges'] = self.retention.gauge_values
+        if self.cardinality:
+            structures['cardinality.admitted'] = self.cardinality.admitted
+        if self.history:
+            structures['history.series'] = self.history.aggregates
+        for backend in self.backends:
+            for prefix, names in backend.names.iteritems():
+                structures['%s.names.%s' % (backend.name, prefix)] = names
+        return structures
+
+    def on_sigusr1(self, signum_unused, frame_unused):
+        """Start profiling for the configured duration or stop profiling
+        early, writing the pstats to the profiling directory.
+
+        """
+        self.ioloop.add_callback_from_signal(self.profiler.toggle)
+
+    def on_sigusr2(self, signum_unused, frame_unused):
+        """Start or stop comparing memory between flushes, writing a report
+        to the profiling directory on each flush.
+
+        """
+        self.ioloop.add_callback_from_signal(self.memory_tracer.toggle)
 
     def process_data(self, data):
         """Invoked by the UDP server to process an inbound UDP data packet,
@@ -348,64 +684,194 @@ class Cardiff(helper.Controller):
         :param str data: Raw UDP data
 
         """
-        start_time = time.time()
-        self.internal_incr(METRICS_PACKETS_RECEIVED)
+        # Only time a sample of packets
+        self.packets_received.value += 1
+        timed = not self.packets_received.value % \
+            self.instruments.sample_every
+        if timed:
+            start_time = time.time()
+
+        # Sample counter and timer updates when shedding load
+        shed = self.shedder is not None and self.shedder.rate < 1.0
 
         # Handle multi-line stats
         if '\n' in data:
             LOGGER.debug('Processing multi-line: %r', data)
-            return [self.process_data(value) for value in data.split('\n')]
+            for line in data.split('\n'):
+                if line:
+                    self.process_line(line, shed)
+        else:
+            self.process_line(data, shed)
+
+        if timed:
+            self.processing_time.observe(start_time)
 
+    def process_line(self, data, shed=False):
+        """Process a single statsd line, adding the value to the correct data
+        structure. Returns False if the line could not be parsed.
+
+        :param str data: The statsd line
+        :param bool shed: Sample counter and timer updates to shed load
+        :rtype: bool
+
+        """
         # Break apart the "frame"
         parts = data.split('|')
+        if len(parts) < 2:
+            LOGGER.warning('Bad line %r, missing metric type', data)
+            self.bad_lines.value += 1
+            return False
 
         # Break apart the
         bits = parts[0].split(':')
         key = bits.pop(0)
-        for pattern, replacement in FIXUP:
-            key = pattern.sub(replacement, key)
+
+        # Apply the ingest rules, dropping the line if the key is denied
+        if self.rules:
+            key = self.rules.apply(key)
+            if key is None:
+                return True
 
         # If there is no value with the key, default to 0
         if not bits:
             bits.append('1')
         value = bits[0] or 0
 
-        # Validate sample-rate if it is passed
+        # Validate the sample-rate and tags if they are passed
         sample = 1
-        if len(parts) == 3:
-            if not SAMPLE_RATE.match(parts[2]):
+        tags = None
+        for part in parts[2:]:
+            if part.startswith('#'):
+                tags = part[1:]
+                continue
+            match = SAMPLE_RATE.match(part)
+            if not match or not float(match.group(1)):
                 LOGGER.warning('Bad line %r in msg %r has invalid sample rate',
                                parts, data)
-                self.internal_timer(METRICS_PROCESSING_TIME, start_time)
-                return self.internal_incr(METRICS_BAD_STATS_RECEIVED)
-            sample = float(parts[2])
+                self.bad_lines.value += 1
+                return False
+            sample = float(match.group(1))
+
+        # Keep a sample of the counter and timer updates when shedding load,
+        # each kept update standing for weight updates. Gauges and sets can
+        # not be corrected for dropped updates so they are never shed.
+        weight = 1
+        if shed and parts[1] in SHED_TYPES:
+            weight = self.shedder.sample()
+            if not weight:
+                self.lines_shed.value += 1
+                return True
+
+        # Get the integer id for the key, registering it if it is new
+        if self.cardinality:
+            series_id = self.cardinality.series_id(key, tags)
+        else:
+            series_id = self.registry.get(key, tags).id
+
+        # Count the update for the heavy hitter sketch
+        if self.topk is not None:
+            self.topk.update(series_id)
 
         # Handle the various stat types
-        if parts[1] == 'c':
-            self.handle_counter(key, value, sample)
-        elif parts[1] == 'g':
-            self.handle_gauge(key, value)
-        elif parts[1] == 'ms':
-            self.handle_timer(key, value, sample)
-        elif parts[1] == 's':
-            self.handle_set(key, value)
-        else:
-            self.internal_incr(METRICS_BAD_STATS_RECEIVED)
-            LOGGER.warning('Bad line %r in msg %r', parts, data)
+        try:
+            if parts[1] == 'c':
+                self.handle_counter(series_id, value, sample, weight)
+            elif parts[1] == 'g':
+                self.handle_gauge(series_id, value)
+            elif parts[1] == 'ms':
+                self.handle_timer(series_id, value, float(sample) / weight)
+            elif parts[1] == 's':
+                self.handle_set(series_id, value)
+            else:
+                self.bad_lines.value += 1
+                LOGGER.warning('Bad line %r in msg %r', parts, data)
+                return False
+        except ValueError as error:
+            self.bad_lines.value += 1
+            LOGGER.warning('Bad line %r in msg %r: %s', parts, data, error)
+            return False
+        return True
+
+    def process_lines(self, lines):
+        """Process an iterator of statsd lines as submitted in bulk, returning
+        the number of lines that were accepted and rejected.
+
+        :param iter lines: The statsd lines to process
+        :rtype: tuple(int, int)
+
+        """
+        start_time = time.time()
+        accepted, rejected = 0, 0
+        for line in lines:
+            if self.process_line(line):
+                accepted += 1
+            else:
+                rejected += 1
+        self.bulk_lines.value += accepted + rejected
+        self.bulk_processing_time.observe(start_time)
+        return accepted, rejected
+
+    def process_bulk_request(self, lines):
+        """Invoked by the HTTP server to process the lines of a bulk ingest
+        request.
+
+        :param iter lines: The statsd lines to process
+        :rtype: tuple(int, int)
+
+        """
+        self.internal_incr(METRICS_BULK_REQUESTS_RECEIVED)
+        return self.process_lines(lines)
 
-        self.internal_timer(METRICS_PROCESSING_TIME, start_time)
+    def process_amqp_message(self, body, timestamp=None):
+        """Invoked by the AMQP consumer to process a message body of one or
+        more statsd lines.
+
+        :param str body: The message body
+        :param float timestamp: The time the message was published
+
+        """
+        self.amqp_messages.value += 1
+        self.amqp_bytes.value += len(body)
+        if timestamp:
+            self.amqp_consumer_lag.observe(timestamp)
+        self.process_lines(line for line in body.split('\n') if line)
 
     def process_stats(self):
         self.add_resource_usage()
+        if self.health:
+            self.add_health_usage()
+        if self.cardinality:
+            self.add_cardinality_usage()
+        if self.rules:
+            self.add_rules_usage()
+        if self.shedder:
+            self.add_shedding_usage()
+        if self.topk is not None:
+            self.add_topk_usage()
+        if self.workers:
+            self.add_workers_usage()
+        if self.history:
+            self.add_history_usage()
+        if self.statsd_server and self.statsd_server.recorder is not None:
+            self.statsd_server.recorder.flush()
+        if self.memory_tracer.active:
+            self.memory_tracer.flush(self.memory_structures())
         LOGGER.debug('Taking last interval snapshot')
         start_time = time.time()
         stats = self.snapshot()
-        LOGGER.debug('Starting backend delivery threads')
+        if self.rollups:
+            self.apply_rollups(stats)
+        if self.history:
+            self.record_history(stats)
+        # Hand the snapshot to the backend worker processes
+        if self.workers:
+            self.workers.deliver(stats)
 
+        LOGGER.debug('Starting backend delivery threads')
         threads = []
-        for backend in self.backends:
-            args = [backend] + stats
-            thread = threading.Thread(target=self.deliver_stats,
+        for backend in self.local_backends:
+            args = [self.deliver_stats, backend] + stats
+            thread = threading.Thread(target=self.profiler.call,
                                       args=tuple(args))
             thread.start()
             threads.append(thread)
@@ -415,7 +881,11 @@ class Cardiff(helper.Controller):
             time.sleep(0.25)
 
         LOGGER.info('Completed stat delivery')
-        self.internal_timer(METRICS_DELIVERY_TIME, start_time)
+        self.delivery_time.observe(start_time)
+
+        # Don't count the time blocked delivering stats as IOLoop lag
+        if self.shedder:
+            self.shedder.restart()
 
     def run(self):
         """Invoked by clihelper when the server is to start"""
@@ -437,17 +907,92 @@ class Cardiff(helper.Controller):
         # Set the host that cardiff is running on for reporting
         self.host = hostname()
 
+        # Run each backend in its own process, started by a spawner forked
+        # while the controller has no sockets, threads or IOLoop, so workers
+        # started or restarted later do not inherit any of them
+        config = self.config.application.get('workers', dict())
+        self.workers = None
+        self.local_backends = self.backends
+        spawner = None
+        if config.get('enabled', False) and \
+                any(backend.worker for backend in self.backends):
+            self.local_backends = [backend for backend in self.backends
+                                   if not backend.worker]
+            spawner = workers.Spawner([backend for backend in self.backends
+                                       if backend.worker])
+            spawner.start()
+
         # Setup the socket and listen
         self.ioloop = ioloop.IOLoop.instance()
 
+        if spawner:
+            self.workers = workers.Workers(spawner,
+                                           self.ioloop,
+                                           self.record_delivery,
+                                           config.get('directory'),
+                                           config.get('max_pending',
+                                                      workers.MAX_PENDING),
+                                           config.get('restart_delay',
+                                                      workers.RESTART_DELAY))
+            self.workers.start()
+
+        # Start the backends that serve requests in the main process
+        for backend in self.local_backends:
+            backend.start()
+
         # Run the statsd server
         config = self.config.application.get('statsd')
+        self.statsd_server = None
         if config.get('enabled', True):
             self.statsd_server = servers.UDPServer(config.get('host', HOST),
                                                    config.get('port',
                                                               STATSD_PORT),
                                                    self.ioloop,
-                                                   self.process_data)
+                                                   self.process_data,
+                                                   config.get('receive_buffer'))
+
+            # Capture the raw datagrams for replay
+            capture = config.get('capture', dict())
+            if capture.get('enabled', False):
+                self.statsd_server.recorder = recording.Recorder(
+                    capture.get('path', CAPTURE_PATH),
+                    capture.get('max_bytes', recording.MAX_BYTES),
+                    capture.get('max_files', recording.MAX_FILES))
+
+        # Run the unix domain datagram socket server
+        config = self.config.application.get('unix', dict())
+        self.unix_server = None
+        if config.get('enabled', False):
+            mode = config.get('mode')
+            if isinstance(mode, basestring):
+                mode = int(mode, 8)
+            self.unix_server = \
+                servers.UnixDatagramServer(config.get('path', UNIX_PATH),
+                                           self.ioloop,
+                                           self.process_data,
+                                           mode,
+                                           config.get('receive_buffer'))
+
+        # Run the HTTP server for bulk ingest
+        config = self.config.application.get('http', dict())
+        self.http_server = None
+        if config.get('enabled', False):
+            handlers = [(r'/metrics', servers.BulkIngestHandler,
+                         {'callback': self.process_bulk_request}),
+                        (r'/history', servers.HistoryHandler,
+                         {'callback': self.query_history})]
+            self.http_server = servers.HTTPServer(self.ioloop, handlers)
+            self.http_server.listen(config.get('port', HTTP_PORT),
+                                    config.get('host', HOST))
+
+        # Consume statsd lines from RabbitMQ
+        config = self.config.application.get('amqp', dict())
+        self.amqp_consumer = None
+        if config.get('enabled', False):
+            from cardiff import consumer
+            self.amqp_consumer = consumer.AMQPConsumer(config, self.ioloop,
+                                                       self.process_amqp_message)
+            self.amqp_consumer.start()
 
         # Run the upstream server
         config = self.config.application.get('upstream')
@@ -461,6 +1006,79 @@ class Cardiff(helper.Controller):
         # Default counters, gauges, sets and timers
         self.create_empty_stat_attributes()
 
+        # Compile the allow, deny and rewrite rules applied at ingest
+        config = self.config.application.get('rules')
+        if config:
+            self.rules = rules.Rules(config)
+
+        # Compile the rollups applied to the snapshot at flush time
+        config = self.config.application.get('rollups')
+        if config:
+            self.rollups = rollups.Rollups(self.registry, config)
+
+        # Keep the values of recent flushes in memory to be queried
+        config = self.config.application.get('history', dict())
+        if config.get('enabled', False):
+            self.history = history.History(config, self.flush_interval)
+
+        # Limit the number of distinct series aggregated per interval
+        config = self.config.application.get('cardinality', dict())
+        if config.get('enabled', False):
+            self.cardinality = cardinality.Budget(self.registry, config)
+
+        # Set the ratio of packets that have their processing time recorded
+        config = self.config.application.get('instrumentation', dict())
+        self.instruments.set_sample_rate(config.get('sample_rate',
+                                                    instruments.SAMPLE_RATE))
+
+        # Keep reporting gauges and counters until they expire
+        config = self.config.application.get('retention', dict())
+        if config.get('enabled', True):
+            self.retention = retention.Retention(self.registry, config,
+                                                 self.flush_interval)
+
+        # Sample inbound datagrams when the IOLoop falls behind
+        config = self.config.application.get('shedding', dict())
+        if config.get('enabled', False):
+            self.shedder = shedding.LoadShedder(self.ioloop, config)
+            self.shedder.start()
+
+        # Track the most updated keys in a fixed size sketch
+        config = self.config.application.get('topk', dict())
+        if config.get('enabled', False):
+            self.topk = topk.SpaceSaving(config.get('capacity', topk.CAPACITY))
+            self.topk_size = config.get('size', topk.SIZE)
+
+        # Profile and trace memory on demand, toggled by SIGUSR1 and SIGUSR2
+        config = self.config.application.get('profiling', dict())
+        directory = config.get('directory', profiling.DIRECTORY)
+        self.profiler = profiling.Profiler(self.ioloop, directory,
+                                           config.get('duration',
+                                                      profiling.DURATION))
+        self.memory_tracer = profiling.MemoryTracer(directory,
+                                                    config.get('top',
+                                                               profiling.TOP),
+                                                    config.get('frames',
+                                                               profiling.FRAMES))
+
+        # Report kernel drops, queue depth, GC, thread CPU and open fds
+        config = self.config.application.get('health', dict())
+        if config.get('enabled', True):
+            sockets = dict()
+            if self.statsd_server:
+                sockets['statsd'] = self.statsd_server.socket
+            self.health = health.Health(sockets)
+
+        # Run the admin server for inspecting live state
+        config = self.config.application.get('admin', dict())
+        self.admin_server = None
+        if config.get('enabled', False):
+            commands = admin.Admin(self)
+            self.admin_server = servers.AdminServer(self.ioloop,
+                                                    commands.execute)
+            self.admin_server.listen(config.get('port', ADMIN_PORT),
+                                     config.get('host', ADMIN_HOST))
+
         # Set the state
         self.set_state(self.STATE_ACTIVE)
 
@@ -481,37 +1099,42 @@ class Cardiff(helper.Controller):
         """
         start_time = time.time()
 
-        counters = dict()
-        for key in self.counters.keys():
-            counters[key] = self.counters.get(key)
-            del self.counters[key]
-
-        gauges = dict()
-        for key in self.gauges.keys():
-            gauges[key] = self.gauges.get(key)
-            del self.gauges[key]
-
-        sets = dict()
-        for key in self.sets.keys():
-            sets[key] = copy.deepcopy(self.sets[key])
-            del self.sets[key]
-
-        timers = dict()
-        for key in self.timers.keys():
-            timers[key] = copy.deepcopy(self.timers[key])
-            del self.timers[key]
-
-        int_counters = copy.deepcopy(self.internal_counters)
-        self.internal_counters = self.new_int_metric_dict()
-
-        int_gauges = copy.deepcopy(self.internal_gauges)
-        self.internal_gauges = self.new_int_metric_dict()
+        # Swap out the id keyed aggregation dicts
+        counters, self.counters = self.counters, dict()
+        gauges, self.gauges = self.gauges, dict()
+        sets, self.sets = self.sets, dict()
+        timers, self.timers = self.timers, dict()
+
+        # Add the retained counters and gauges, expiring idle series
+        if self.retention:
+            counters, gauges = self.retention.flush(counters, gauges,
+                                                    sets, timers)
+            self.internal_gauge(METRICS_RETAINED_GAUGES,
+                                len(self.retention.gauge_values))
+            self.internal_incr(METRICS_RETENTION_EXPIRED,
+                               self.retention.reset_expired())
+
+        # Publish the per-packet internal stats
+        self.instruments.publish(self.internal_incr, self.internal_gauge)
+
+        # Key the values by series for the backends
+        lookup = self.registry.series
+        counters = dict([(lookup[series_id], value)
+                         for series_id, value in counters.iteritems()])
+        gauges = dict([(lookup[series_id], value)
+                       for series_id, value in gauges.iteritems()])
+        sets = dict([(lookup[series_id], value)
+                     for series_id, value in sets.iteritems()])
+        timers = dict([(lookup[series_id], value)
+                       for series_id, value in timers.iteritems()])
+
+        int_counters, self.internal_counters = self.internal_counters, dict()
+        int_gauges, self.internal_gauges = self.internal_gauges, dict()
 
         # Can't include the cost of snapshot timers if taking snapshot
-        self.internal_timer(METRICS_SNAPSHOT_TIME, start_time)
+        self.snapshot_time.observe(start_time)
 
-        int_timers = copy.deepcopy(self.internal_timers)
-        self.internal_timers = self.new_int_metric_dict()
+        int_timers, self.internal_timers = self.internal_timers, dict()
 
         return [int(time.time()), counters, gauges, sets, timers,
                 int_counters, int_gauges, int_timers]
@@ -522,6 +1145,44 @@ class Cardiff(helper.Controller):
         self.timer.start()
 
 
+class Settings(object):
+    """Stands in for the helper configuration object of a controller that is
+    not run as a daemon.
+
+    """
+    def __init__(self, application):
+        self.application = application
+
+
+def standalone(flush_interval=FLUSH_INTERVAL, application=None):
+    """Return a controller set up to process stats without the IOLoop, the
+    servers or the flush timer, for the benchmark and replay scripts and the
+    tests. Gauges are retained and the ingest rules and rollups are applied
+    as configured in the application config.
+
+    :param int flush_interval: The flush interval
+    :param dict application: The application configuration
+    :rtype: Cardiff
+
+    """
+    application = dict(application or dict(), flush_interval=flush_interval)
+    cardiff = Cardiff.__new__(Cardiff)
+    cardiff.config = Settings(application)
+    cardiff.backends = list()
+    cardiff.host = hostname()
+    cardiff.create_empty_stat_attributes()
+    config = application.get('retention', dict())
+    if config.get('enabled', True):
+        cardiff.retention = retention.Retention(cardiff.registry, config,
+                                                flush_interval)
+    if application.get('rules'):
+        cardiff.rules = rules.Rules(application['rules'])
+    if application.get('rollups'):
+        cardiff.rollups = rollups.Rollups(cardiff.registry,
+                                          application['rollups'])
+    return cardiff
+
+
 def main():
     parser.description('A python statsd clone')
     helper.start(Cardiff)
@@ -0,0 +1,163 @@
+"""
+health.py
+
+"""
+import gc
+import logging
+import os
+import socket
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+FD_PATH = '/proc/self/fd'
+TASK_PATH = '/proc/self/task'
+UDP_TABLES = ['/proc/net/udp', '/proc/net/udp6']
+
+
+class Health(object):
+    """Collect the operating system and interpreter numbers that show when
+    ingest is falling behind: kernel drops and the receive queue depth of
+    the UDP sockets, garbage collection per generation, CPU time per thread
+    and open file descriptors. Everything is read once per flush, and the
+    /proc files are only read on Linux.
+
+    """
+    def __init__(self, sockets):
+        """Create a new health collector
+
+        :param dict sockets: The UDP sockets to report on, keyed by name
+
+        """
+        self.sockets = sockets
+        self.drops = dict()
+        self.proc = os.path.isdir(TASK_PATH)
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if self.proc else 100
+        self.gc_collections = [0] * len(gc.get_count())
+        self.gc_pauses = [0.0] * len(gc.get_count())
+        self.gc_started = None
+        if hasattr(gc, 'callbacks'):
+            gc.callbacks.append(self.on_gc)
+
+    def collect(self):
+        """Return the gauges and the counters for the interval
+
+        :rtype: tuple(dict, dict)
+
+        """
+        gauges, counters = dict(), dict()
+        self.collect_gc(gauges, counters)
+        if self.proc:
+            self.collect_sockets(gauges, counters)
+            self.collect_threads(gauges)
+            gauges['open_fds'] = len(os.listdir(FD_PATH))
+        return gauges, counters
+
+    def collect_gc(self, gauges, counters):
+        """Add the collection threshold counts of each generation, and the
+        number of collections and time paused per generation where the
+        interpreter reports them.
+
+        :param dict gauges: The gauges to add to
+        :param dict counters: The counters to add to
+
+        """
+        for generation, count in enumerate(gc.get_count()):
+            gauges['gc.generation%i.count' % generation] = count
+        if not hasattr(gc, 'callbacks'):
+            return
+        for generation in xrange(len(self.gc_collections)):
+            counters['gc.generation%i.collections' % generation] = \
+                self.gc_collections[generation]
+            gauges['gc.generation%i.pause_ms' % generation] = \
+                self.gc_pauses[generation]
+        self.gc_collections = [0] * len(self.gc_collections)
+        self.gc_pauses = [0.0] * len(self.gc_pauses)
+
+    def collect_sockets(self, gauges, counters):
+        """Add the receive queue depth, receive buffer size and kernel drops
+        in the interval for each socket.
+
+        :param dict gauges: The gauges to add to
+        :param dict counters: The counters to add to
+
+        """
+        stats = self.udp_stats()
+        for name, sock in self.sockets.iteritems():
+            try:
+                inode = os.fstat(sock.fileno()).st_ino
+            except (OSError, IOError, ValueError):
+                continue
+            if inode not in stats:
+                continue
+            queue, drops = stats[inode]
+            gauges['%s.receive_queue' % name] = queue
+            gauges['%s.receive_buffer' % name] = \
+                sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            counters['%s.drops' % name] = drops - self.drops.get(name, drops)
+            self.drops[name] = drops
+
+    def collect_threads(self, gauges):
+        """Add the CPU time used by the IOLoop thread, the CPU time used by
+        all other threads and the number of threads.
+
+        :param dict gauges: The gauges to add to
+
+        """
+        main, other, threads = 0.0, 0.0, 0
+        pid = str(os.getpid())
+        for tid in os.listdir(TASK_PATH):
+            try:
+                with open(os.path.join(TASK_PATH, tid, 'stat')) as handle:
+                    fields = handle.read().rsplit(')', 1)[1].split()
+            except (IOError, IndexError):
+                continue
+            cpu_time = (int(fields[11]) + int(fields[12])) / \
+                float(self.clock_ticks)
+            if tid == pid:
+                main = cpu_time
+            else:
+                other += cpu_time
+            threads += 1
+        gauges['threads'] = threads
+        gauges['threads.ioloop.cpu_time'] = main
+        gauges['threads.other.cpu_time'] = other
+
+    def on_gc(self, phase, info):
+        """Invoked by the interpreter before and after each collection
+
+        :param str phase: start or stop
+        :param dict info: The collection info, including the generation
+
+        """
+        if phase == 'start':
+            self.gc_started = time.time()
+        elif self.gc_started is not None:
+            generation = info['generation']
+            self.gc_collections[generation] += 1
+            self.gc_pauses[generation] += (time.time() - self.gc_started) * 1000
+            self.gc_started = None
+
+    @staticmethod
+    def udp_stats():
+        """Return the receive queue depth in bytes and the total number of
+        kernel drops of each UDP socket, keyed by inode.
+
+        :rtype: dict
+
+        """
+        stats = dict()
+        for path in UDP_TABLES:
+            try:
+                with open(path) as handle:
+                    lines = handle.readlines()[1:]
+            except IOError:
+                continue
+            for line in lines:
+                fields = line.split()
+                try:
+                    stats[int(fields[9])] = (int(fields[4].split(':')[1], 16),
+                                             int(fields[12]))
+                except (IndexError, ValueError):
+                    LOGGER.debug('Could not parse %s line: %r', path, line)
+        return stats
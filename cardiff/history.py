@@ -0,0 +1,372 @@
+"""
+history.py
+
+"""
+import array
+import logging
+import math
+import re
+import time
+
+from cardiff import rules
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTERS = 'counters'
+GAUGES = 'gauges'
+SETS = 'sets'
+TIMERS = 'timers'
+TYPES = [COUNTERS, GAUGES, SETS, TIMERS]
+
+LAST = 'last'
+MAX = 'max'
+MEAN = 'mean'
+MIN = 'min'
+SUM = 'sum'
+
+MAX_SERIES = 100000
+NAN = float('nan')
+
+# Tiers without a resolution use the flush interval
+TIERS = [{'retention': 3600},
+         {'resolution': 300, 'retention': 86400}]
+
+
+class Tier(object):
+    """The values of each series at one resolution, kept in a ring of
+    retention / resolution doubles per series indexed by period. The flush
+    values of a period are combined as they arrive and written to the ring
+    when the period is complete. Slots of the periods a series was not
+    written in are cleared the next time it is written, so a flush only
+    touches the series it contains.
+
+    """
+    def __init__(self, resolution, retention):
+        """Create a new tier
+
+        :param int resolution: The seconds per period
+        :param int retention: The seconds of periods to keep
+
+        """
+        self.resolution = resolution
+        self.retention = retention
+        self.slots = max(1, retention // resolution)
+        self.values = dict()
+        self.written = dict()
+        self.pending = dict()
+        self.committed = None
+        self.period = None
+        self.swept = None
+
+    def add(self, name, aggregate, value):
+        """Combine a flush value of the series into the current period
+
+        :param str name: The series name
+        :param str aggregate: How values are combined within a period
+        :param float value: The flush value
+
+        """
+        try:
+            entry = self.pending[name]
+        except KeyError:
+            self.pending[name] = [aggregate, value, 1]
+            return
+        if aggregate in (SUM, MEAN):
+            entry[1] += value
+        elif aggregate == MAX:
+            entry[1] = max(entry[1], value)
+        elif aggregate == MIN:
+            entry[1] = min(entry[1], value)
+        else:
+            entry[1] = value
+        entry[2] += 1
+
+    def commit(self, period):
+        """Write the combined values of the period to the rings, returning
+        the names of the series that no longer have a value in the ring.
+
+        :param int period: The period the values were combined for
+        :rtype: list
+
+        """
+        for name, (aggregate, value, count) in self.pending.iteritems():
+            self.write(name, period, value / count if aggregate == MEAN
+                       else value)
+        self.pending = dict()
+        self.committed = period
+        if self.swept is None:
+            self.swept = period
+        if period - self.swept < self.slots:
+            return []
+        self.swept = period
+        expired = [name for name, written in self.written.iteritems()
+                   if written <= period - self.slots]
+        for name in expired:
+            del self.values[name]
+            del self.written[name]
+        return expired
+
+    def points(self, name, start, end):
+        """Return the [timestamp, value] points of the series for the periods
+        between start and end, with None for periods without a value.
+
+        :param str name: The series name
+        :param int start: The start of the time range
+        :param int end: The end of the time range
+        :rtype: list
+
+        """
+        if self.committed is None:
+            return []
+        newest = self.committed
+        first = max(start // self.resolution, newest - self.slots + 1)
+        values = self.values.get(name)
+        written = self.written.get(name)
+        points = list()
+        for period in xrange(first, min(end // self.resolution, newest) + 1):
+            if values is None or not written - self.slots < period <= written:
+                value = None
+            else:
+                value = values[period % self.slots]
+                if math.isnan(value):
+                    value = None
+            points.append([period * self.resolution, value])
+        return points
+
+    def start(self, timestamp):
+        """Start combining the values of a flush, setting the period it
+        belongs to.
+
+        :param int timestamp: The flush timestamp
+
+        """
+        self.period = timestamp // self.resolution
+
+    def write(self, name, period, value):
+        """Write the value of the series for the period to its ring
+
+        :param str name: The series name
+        :param int period: The period
+        :param float value: The value
+
+        """
+        try:
+            values = self.values[name]
+        except KeyError:
+            values = self.values[name] = array.array('d', [NAN]) * self.slots
+        else:
+            written = self.written[name]
+            for gap in xrange(written + 1,
+                              min(period, written + 1 + self.slots)):
+                values[gap % self.slots] = NAN
+        values[period % self.slots] = value
+        self.written[name] = period
+
+
+class History(object):
+    """Keep the values of each flush in memory at one or more resolutions,
+    so that recent values can be queried when backends are lagging or down.
+    Counters are summed, gauges keep their last value and sets their
+    largest member count within a period. Timers are kept as count, max,
+    mean and min series. Series are named by their type and key, such as
+    counters.api.requests or timers.api.latency.mean, and indexed by their
+    type and first key segment for glob queries.
+
+    """
+    def __init__(self, config, flush_interval):
+        """Create the history tiers from the configuration
+
+        :param dict config: The history configuration
+        :param int flush_interval: The flush interval in seconds
+        :raises: ValueError
+
+        """
+        self.flush_interval = flush_interval
+        self.max_series = config.get('max_series', MAX_SERIES)
+        retentions = dict()
+        for index, tier in enumerate(config.get('tiers', TIERS)):
+            resolution = tier.get('resolution', flush_interval)
+            if resolution % flush_interval:
+                resolution = max(1, int(round(float(resolution) /
+                                              flush_interval))) * \
+                    flush_interval
+                LOGGER.warning('Rounded history tier %i resolution to %is, '
+                               'a multiple of the flush interval', index,
+                               resolution)
+            if not tier.get('retention'):
+                raise ValueError('History tier %i has no retention' % index)
+            retentions[resolution] = max(tier['retention'],
+                                         retentions.get(resolution, 0))
+        if not retentions:
+            raise ValueError('No history tiers are configured')
+        self.tiers = [Tier(resolution, retentions[resolution])
+                      for resolution in sorted(retentions)]
+        self.aggregates = dict()
+        self.index = dict()
+        self.dropped = set()
+        LOGGER.info('Keeping history at %s', ', '.join(
+            ['%is for %is' % (tier.resolution, tier.retention)
+             for tier in self.tiers]))
+
+    def add(self, name, aggregate, value, key=None):
+        """Add a flush value of a series to each tier, registering the
+        series if it is new and there is room for it. Otherwise the key the
+        series is recorded for, such as the timer of its timer stat series,
+        is added to the keys dropped since the last usage, which are bounded
+        to max_series keys.
+
+        :param str name: The series name
+        :param str aggregate: How values are combined within a period
+        :param float value: The flush value
+        :param str key: The key the series is recorded for, if not the name
+
+        """
+        if name not in self.aggregates:
+            if len(self.aggregates) >= self.max_series:
+                if len(self.dropped) < self.max_series:
+                    self.dropped.add(key or name)
+                return
+            self.aggregates[name] = aggregate
+            self.index.setdefault(self.segment(name), set()).add(name)
+        for tier in self.tiers:
+            tier.add(name, aggregate, value)
+
+    def expire(self, names):
+        """Unregister the series that no tier has a value for
+
+        :param list names: The names expired from a tier
+
+        """
+        for name in names:
+            if any(name in tier.values or name in tier.pending
+                   for tier in self.tiers):
+                continue
+            self.aggregates.pop(name, None)
+            bucket = self.index.get(self.segment(name))
+            if bucket is not None:
+                bucket.discard(name)
+                if not bucket:
+                    del self.index[self.segment(name)]
+
+    def match(self, pattern):
+        """Return the names of the series matching the graphite style glob,
+        only scanning the series with the same type and first segment when
+        they are not wildcards.
+
+        :param str pattern: The glob
+        :rtype: list
+
+        """
+        regex = re.compile(rules.Rule.translate(pattern))
+        segment = self.segment(pattern)
+        if '*' in segment or '?' in segment or '[' in segment:
+            buckets = self.index.values()
+        else:
+            buckets = [self.index.get(segment, ())]
+        return sorted([name for bucket in buckets for name in bucket
+                       if regex.match(name)])
+
+    def query(self, pattern, start=None, end=None, resolution=None):
+        """Return the points of each series matching the glob between start
+        and end, from the tier with the resolution or the finest tier that
+        holds the start. Negative times are relative to now, and the start
+        defaults to the retention of the finest tier.
+
+        :param str pattern: The glob
+        :param int start: The start of the time range
+        :param int end: The end of the time range
+        :param int resolution: The resolution of the tier to read
+        :rtype: dict
+        :raises: ValueError
+
+        """
+        now = int(time.time())
+        end = now + end if end is not None and end <= 0 else end or now
+        if start is None:
+            start = end - self.tiers[0].retention
+        elif start < 0:
+            start += now
+        tier = self.tier(start, now, resolution)
+        return dict([(name, tier.points(name, start, end))
+                     for name in self.match(pattern)])
+
+    def record(self, timestamp, counters, gauges, sets, timers):
+        """Add the values of a flush snapshot, writing each tier whose period
+        ends with this flush. Flushes are assigned to the nearest period so
+        that jitter in the flush timer does not put two flushes in one
+        period of the finest tier.
+
+        :param int timestamp: The flush timestamp
+        :param dict counters: The counter values
+        :param dict gauges: The gauge values
+        :param dict sets: The set values
+        :param dict timers: The timer values
+
+        """
+        timestamp += self.flush_interval // 2
+        for tier in self.tiers:
+            tier.start(timestamp)
+        for key, value in counters.iteritems():
+            self.add('%s.%s' % (COUNTERS, key), SUM, value)
+        for key, value in gauges.iteritems():
+            self.add('%s.%s' % (GAUGES, key), LAST, value)
+        for key, value in sets.iteritems():
+            self.add('%s.%s' % (SETS, key), MAX, len(value))
+        for key, values in timers.iteritems():
+            if not len(values):
+                continue
+            name = '%s.%s' % (TIMERS, key)
+            self.add('%s.count' % name, SUM,
+                     getattr(values, 'weight', len(values)), name)
+            self.add('%s.max' % name, MAX, max(values), name)
+            self.add('%s.mean' % name, MEAN, sum(values) / len(values), name)
+            self.add('%s.min' % name, MIN, min(values), name)
+        for tier in self.tiers:
+            if (timestamp + self.flush_interval) // tier.resolution != \
+                    tier.period:
+                self.expire(tier.commit(tier.period))
+
+    @staticmethod
+    def segment(name):
+        """Return the type and first key segment of a series name or glob
+
+        :param str name: The series name or glob
+        :rtype: str
+
+        """
+        return '.'.join(name.split('.', 2)[:2])
+
+    def tier(self, start, now, resolution=None):
+        """Return the tier with the resolution, or the finest tier whose
+        retention reaches back to the start, or the tier that reaches back
+        the furthest.
+
+        :param int start: The start of the time range
+        :param int now: The current time
+        :param int resolution: The resolution of the tier to return
+        :rtype: Tier
+        :raises: ValueError
+
+        """
+        if resolution:
+            for tier in self.tiers:
+                if tier.resolution == resolution:
+                    return tier
+            raise ValueError('No history is kept at a %is resolution' %
+                             resolution)
+        for tier in self.tiers:
+            if now - tier.retention <= start:
+                return tier
+        return max(self.tiers, key=lambda tier: tier.retention)
+
+    def usage(self):
+        """Return the number of series, the bytes used by their rings and the
+        number of distinct keys, counting each timer once, that were not
+        kept since the last call because max_series was reached.
+
+        :rtype: tuple(int, int, int)
+
+        """
+        size = sum([len(tier.values) * tier.slots * 8 for tier in self.tiers])
+        dropped, self.dropped = len(self.dropped), set()
+        return len(self.aggregates), size, dropped
@@ -0,0 +1,228 @@
+"""
+instruments.py
+
+"""
+import bisect
+import time
+
+BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100,
+          250, 500, 1000, 2500, 5000, 10000)
+PERCENTILES = (50, 90, 99)
+SAMPLE_RATE = 0.01
+
+
+def percentile(bounds, buckets, count, maximum, value):
+    """Return the upper bound of the bucket the percentile falls in, or the
+    largest duration recorded if it is in the overflow bucket.
+
+    :param tuple bounds: The bucket upper bounds
+    :param list buckets: The count in each bucket
+    :param int count: The total count
+    :param float maximum: The largest duration recorded
+    :param int value: The percentile to return
+    :rtype: float
+
+    """
+    rank = count * value / 100.0
+    seen = 0
+    for index, bucket in enumerate(buckets):
+        seen += bucket
+        if seen >= rank and bucket:
+            if index < len(bounds):
+                return min(bounds[index], maximum)
+            break
+    return maximum
+
+
+def summarize(bounds, buckets, count, total, maximum):
+    """Return the count, max, mean and percentiles of histogram buckets
+
+    :param tuple bounds: The bucket upper bounds
+    :param list buckets: The count in each bucket
+    :param int count: The total count
+    :param float total: The sum of the durations
+    :param float maximum: The largest duration recorded
+    :rtype: dict
+
+    """
+    values = {'count': count,
+              'max': maximum,
+              'mean': total / count if count else 0}
+    for value in PERCENTILES:
+        values['p%i' % value] = percentile(bounds, buckets, count, maximum,
+                                           value)
+    return values
+
+
+class Counter(object):
+    """A pre-registered internal counter, incremented in place by adding to
+    its value attribute.
+
+    """
+    __slots__ = ['name', 'value']
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def reset(self):
+        """Return the value, resetting it to 0
+
+        :rtype: int
+
+        """
+        value, self.value = self.value, 0
+        return value
+
+
+class Histogram(object):
+    """A pre-registered internal duration histogram with fixed millisecond
+    buckets, recording a duration with one bisect and a few additions rather
+    than appending to a list that grows with the number of observations.
+    The buckets of each interval are added to lifetime totals when reset.
+
+    """
+    __slots__ = ['name', 'bounds', 'metric_type', 'buckets', 'count',
+                 'total', 'max', 'last', 'lifetime', 'lifetime_count',
+                 'lifetime_total', 'lifetime_max']
+
+    def __init__(self, name, bounds=BOUNDS, metric_type=None):
+        self.name = name
+        self.bounds = bounds
+        self.metric_type = metric_type
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+        self.lifetime = [0] * (len(bounds) + 1)
+        self.lifetime_count = 0
+        self.lifetime_total = 0.0
+        self.lifetime_max = 0.0
+
+    def lifetime_summary(self):
+        """Return the summary values by name for every duration recorded
+        before the last reset.
+
+        :rtype: dict
+
+        """
+        return summarize(self.bounds, self.lifetime, self.lifetime_count,
+                         self.lifetime_total, self.lifetime_max)
+
+    def observe(self, start_time):
+        """Record the duration in milliseconds since the start time
+
+        :param float start_time: The start of the duration
+
+        """
+        self.record((time.time() - start_time) * 1000)
+
+    def record(self, duration):
+        """Record a duration
+
+        :param float duration: The duration in milliseconds
+
+        """
+        self.buckets[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def reset(self):
+        """Return the summary values by name, adding the interval to the
+        lifetime totals and resetting the histogram.
+
+        :rtype: dict
+
+        """
+        values = self.last = self.summary()
+        for index, count in enumerate(self.buckets):
+            self.lifetime[index] += count
+        self.lifetime_count += self.count
+        self.lifetime_total += self.total
+        self.lifetime_max = max(self.lifetime_max, self.max)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        return values
+
+    def summary(self):
+        """Return the summary values by name for the current interval
+
+        :rtype: dict
+
+        """
+        return summarize(self.bounds, self.buckets, self.count, self.total,
+                         self.max)
+
+
+class Instruments(object):
+    """The internal counters and histograms updated for every packet or line.
+    Handles are created once and updated through attribute access, and their
+    values are published through the internal stats when stats are flushed.
+    Per-packet durations are only timed for one in every sample_every
+    packets.
+
+    """
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        """Create a new set of instruments
+
+        :param float sample_rate: The ratio of packets to time
+
+        """
+        self.counters = list()
+        self.histograms = list()
+        self.sample_every = 1
+        self.set_sample_rate(sample_rate)
+
+    def counter(self, name):
+        """Return a new counter handle
+
+        :param str name: The internal metric name
+        :rtype: Counter
+
+        """
+        value = Counter(name)
+        self.counters.append(value)
+        return value
+
+    def histogram(self, name, bounds=BOUNDS, metric_type=None):
+        """Return a new histogram handle
+
+        :param str name: The internal metric name
+        :param tuple bounds: The sorted bucket upper bounds in milliseconds
+        :param str metric_type: The internal metric type if not the default
+        :rtype: Histogram
+
+        """
+        value = Histogram(name, bounds, metric_type)
+        self.histograms.append(value)
+        return value
+
+    def publish(self, incr, gauge):
+        """Publish and reset the counters and histograms
+
+        :param method incr: Called with the name and value of each counter
+        :param method gauge: Called with the name, value and metric type if
+            set of each histogram summary value
+
+        """
+        for counter in self.counters:
+            if counter.value:
+                incr(counter.name, counter.reset())
+        for histogram in self.histograms:
+            if histogram.count:
+                args = (histogram.metric_type,) if histogram.metric_type else ()
+                for suffix, value in histogram.reset().iteritems():
+                    gauge('%s.%s' % (histogram.name, suffix), value, *args)
+
+    def set_sample_rate(self, sample_rate):
+        """Set the ratio of packets to time
+
+        :param float sample_rate: The ratio of packets to time
+
+        """
+        self.sample_every = max(1, int(round(1 / float(sample_rate))))
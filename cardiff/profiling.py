@@ -0,0 +1,223 @@
+"""
+profiling.py
+
+"""
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DIRECTORY = '/var/tmp'
+DURATION = 30
+FRAMES = 1
+TOP = 25
+
+
+def filename(directory, kind, extension):
+    """Return a path in the directory for an output file of this process
+
+    :param str directory: The output directory
+    :param str kind: The kind of output
+    :param str extension: The file extension
+    :rtype: str
+
+    """
+    return os.path.join(directory, 'cardiff-%i-%s-%s.%s' %
+                        (os.getpid(), kind,
+                         time.strftime('%Y%m%d%H%M%S'), extension))
+
+
+class Profiler(object):
+    """Run cProfile in the IOLoop thread and in each backend delivery thread
+    for a number of seconds, writing the combined pstats to the output
+    directory. Nothing is profiled or checked per packet while it is off.
+
+    """
+    def __init__(self, ioloop, directory=DIRECTORY, duration=DURATION):
+        """Create a new profiler
+
+        :param tornado.ioloop.IOLoop ioloop: The IOLoop to profile
+        :param str directory: The directory to write pstats files to
+        :param int duration: The default number of seconds to profile for
+
+        """
+        self.ioloop = ioloop
+        self.directory = directory
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.profile = None
+        self.profiles = list()
+        self.timeout = None
+
+    @property
+    def active(self):
+        """Return True if a profile is being taken
+
+        :rtype: bool
+
+        """
+        return self.profile is not None
+
+    def call(self, method, *args):
+        """Invoke the method, profiling it if a profile is being taken. Used
+        to profile the backend delivery threads.
+
+        :param method method: The method to invoke
+        :param list args: The method arguments
+
+        """
+        if not self.active:
+            return method(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(method, *args)
+        finally:
+            with self.lock:
+                self.profiles.append(profile)
+
+    def start(self, duration=None):
+        """Start profiling the IOLoop thread, stopping after the duration.
+        Must be invoked in the IOLoop thread.
+
+        :param int duration: The number of seconds to profile for
+        :rtype: bool
+
+        """
+        if self.active:
+            return False
+        duration = duration or self.duration
+        LOGGER.info('Profiling for %i seconds', duration)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.timeout = self.ioloop.add_timeout(time.time() + duration,
+                                               self.stop)
+        return True
+
+    def stop(self):
+        """Stop profiling and write the pstats of the IOLoop thread and the
+        delivery threads, returning the path written to. Must be invoked in
+        the IOLoop thread.
+
+        :rtype: str
+
+        """
+        if not self.active:
+            return None
+        self.profile.disable()
+        self.ioloop.remove_timeout(self.timeout)
+        with self.lock:
+            profiles, self.profiles = self.profiles, list()
+        stats = pstats.Stats(self.profile)
+        for profile in profiles:
+            stats.add(profile)
+        self.profile, self.timeout = None, None
+        path = filename(self.directory, 'profile', 'pstats')
+        try:
+            stats.dump_stats(path)
+        except IOError as error:
+            LOGGER.error('Could not write the profile to %s: %s', path, error)
+            return None
+        LOGGER.info('Wrote the profile to %s', path)
+        return path
+
+    def toggle(self):
+        """Start profiling for the default duration or stop profiling early"""
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+
+class MemoryTracer(object):
+    """Compare memory between flushes while active, writing a report to the
+    output directory on each flush. The report lists the entries and
+    container size of each aggregation structure and their growth since the
+    previous flush, and when the tracemalloc module is available the source
+    lines that allocated the most memory since the previous flush.
+
+    """
+    def __init__(self, directory=DIRECTORY, top=TOP, frames=FRAMES):
+        """Create a new memory tracer
+
+        :param str directory: The directory to write reports to
+        :param int top: The number of allocation sites to report
+        :param int frames: The traceback depth tracemalloc records
+
+        """
+        self.directory = directory
+        self.top = top
+        self.frames = frames
+        self.active = False
+        self.census = None
+        self.snapshot = None
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+
+    def flush(self, structures):
+        """Write a report comparing the structures and, if available, the
+        allocations with the previous flush, returning the path written to.
+
+        :param dict structures: The aggregation structures by name
+        :rtype: str
+
+        """
+        census = dict([(name, (len(value), sys.getsizeof(value)))
+                       for name, value in structures.iteritems()])
+        previous, self.census = self.census or census, census
+        lines = ['%-24s %12s %12s %14s %14s' % ('structure', 'entries',
+                                                 'growth', 'bytes', 'growth')]
+        for name in sorted(census):
+            entries, size = census[name]
+            lines.append('%-24s %12i %+12i %14i %+14i' % (
+                name, entries, entries - previous.get(name, census[name])[0],
+                size, size - previous.get(name, census[name])[1]))
+
+        if self.tracemalloc:
+            snapshot = self.tracemalloc.take_snapshot()
+            if self.snapshot:
+                lines.append('')
+                lines += [str(stat) for stat in
+                          snapshot.compare_to(self.snapshot,
+                                              'lineno')[:self.top]]
+            self.snapshot = snapshot
+
+        path = filename(self.directory, 'memory', 'txt')
+        try:
+            with open(path, 'w') as handle:
+                handle.write('%s\n' % '\n'.join(lines))
+        except IOError as error:
+            LOGGER.error('Could not write the memory report to %s: %s',
+                         path, error)
+            return None
+        LOGGER.info('Wrote the memory report to %s', path)
+        return path
+
+    def start(self):
+        """Start comparing memory between flushes"""
+        LOGGER.info('Tracing memory between flushes')
+        if self.tracemalloc:
+            self.tracemalloc.start(self.frames)
+        self.active = True
+
+    def stop(self):
+        """Stop comparing memory between flushes"""
+        LOGGER.info('Stopped tracing memory')
+        if self.tracemalloc:
+            self.tracemalloc.stop()
+        self.active = False
+        self.census, self.snapshot = None, None
+
+    def toggle(self):
+        """Start or stop comparing memory between flushes"""
+        if self.active:
+            self.stop()
+        else:
+            self.start()
@@ -0,0 +1,160 @@
+"""
+recording.py
+
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = 'CARDIFF1'
+HEADER = struct.Struct('!dH')
+BUFFER_SIZE = 65536
+MAX_BYTES = 104857600
+MAX_FILES = 5
+
+
+def files(path):
+    """Return the paths of a capture and the files it was rotated to that
+    exist, oldest first.
+
+    :param str path: The capture path
+    :rtype: list
+
+    """
+    paths = list()
+    index = 1
+    while os.path.exists('%s.%i' % (path, index)):
+        paths.insert(0, '%s.%i' % (path, index))
+        index += 1
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read(path):
+    """Iterate over the (receive timestamp, datagram) records of a capture
+    file, reading it through a memory map.
+
+    :param str path: The capture file
+    :rtype: iter
+    :raises: ValueError
+
+    """
+    with open(path, 'rb') as handle:
+        if not os.fstat(handle.fileno()).st_size:
+            return
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a cardiff capture' % path)
+        offset, size = len(MAGIC), len(data)
+        while offset + HEADER.size <= size:
+            timestamp, length = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            if offset + length > size:
+                LOGGER.warning('Truncated record at the end of %s', path)
+                break
+            yield timestamp, data[offset:offset + length]
+            offset += length
+    finally:
+        data.close()
+
+
+def replay(records, callback, speed=1.0):
+    """Invoke the callback with each datagram, spacing them by their receive
+    timestamps divided by the speed, or as fast as possible if the speed is
+    0. Returns the number of datagrams replayed.
+
+    :param iter records: The (receive timestamp, datagram) records
+    :param method callback: Invoked with each datagram
+    :param float speed: The multiple of the captured rate to replay at
+    :rtype: int
+
+    """
+    count = 0
+    first, start_time = None, time.time()
+    for timestamp, data in records:
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = start_time + (timestamp - first) / speed - time.time()
+            if delay > 0.001:
+                time.sleep(delay)
+        callback(data)
+        count += 1
+    return count
+
+
+class Recorder(object):
+    """Append raw datagrams with their receive timestamp to a compact binary
+    capture file, a header of the timestamp and length followed by the
+    datagram. When the file reaches max_bytes it is rotated like a log file,
+    keeping at most max_files old captures.
+
+    """
+    def __init__(self, path, max_bytes=MAX_BYTES, max_files=MAX_FILES):
+        """Create a new recorder, appending to an existing capture
+
+        :param str path: The capture file
+        :param int max_bytes: The size to rotate the file at
+        :param int max_files: The number of rotated files to keep
+
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.datagrams = 0
+        self.handle = None
+        self.size = 0
+        self.open()
+
+    def close(self):
+        """Close the capture file"""
+        self.handle.close()
+
+    def flush(self):
+        """Flush the buffered records to the capture file"""
+        self.handle.flush()
+
+    def open(self):
+        """Open the capture file for appending, writing the file header if
+        it is new.
+
+        """
+        self.handle = open(self.path, 'ab', BUFFER_SIZE)
+        self.size = self.handle.tell()
+        if not self.size:
+            self.handle.write(MAGIC)
+            self.size = len(MAGIC)
+        LOGGER.info('Capturing datagrams to %s', self.path)
+
+    def record(self, data, timestamp=None):
+        """Append a datagram to the capture
+
+        :param str data: The datagram
+        :param float timestamp: The receive time, defaults to now
+
+        """
+        self.handle.write(HEADER.pack(timestamp or time.time(), len(data)))
+        self.handle.write(data)
+        self.size += HEADER.size + len(data)
+        self.datagrams += 1
+        if self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Rotate the capture file, removing the oldest capture"""
+        self.handle.close()
+        for index in xrange(self.max_files - 1, 0, -1):
+            source = '%s.%i' % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, '%s.%i' % (self.path, index + 1))
+        if self.max_files:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.unlink(self.path)
+        self.open()
@@ -0,0 +1,192 @@
+"""
+retention.py
+
+"""
+import logging
+import math
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTER_TTL = 0
+GAUGE_TTL = 3600
+SERIES_TTL = 0
+
+
+class LastSeen(object):
+    """Index of the flush interval each series id was last updated in. Ids
+    are kept in one bucket per interval and moving an id to a newer bucket
+    leaves a stale entry behind that is skipped on expiry, so that expiring
+    costs O(ids in the oldest bucket) instead of a scan of every id.
+
+    """
+    def __init__(self, ttl):
+        """Create a new index
+
+        :param int ttl: The number of idle intervals before an id expires
+
+        """
+        self.ttl = ttl
+        self.interval = 0
+        self.seen = dict()
+        self.buckets = dict()
+
+    def __contains__(self, series_id):
+        return series_id in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def expire(self):
+        """Remove and return the ids that have not been updated in the last
+        ttl intervals, ending the current interval.
+
+        :rtype: list
+
+        """
+        expired = list()
+        interval = self.interval - self.ttl
+        for series_id in self.buckets.pop(interval, ()):
+            if self.seen.get(series_id) == interval:
+                del self.seen[series_id]
+                expired.append(series_id)
+        self.interval += 1
+        return expired
+
+    def touch(self, series_ids):
+        """Mark the ids as updated in the current interval
+
+        :param iter series_ids: The updated series ids
+
+        """
+        bucket = self.buckets.setdefault(self.interval, set())
+        for series_id in series_ids:
+            self.seen[series_id] = self.interval
+            bucket.add(series_id)
+
+
+class Retention(object):
+    """Keep gauges and optionally counters reported across flushes until they
+    have been idle for their TTL, and release idle series from the registry
+    so that state does not grow with every key ever seen. Updated ids are
+    indexed once per flush, so ingest is not slowed down.
+
+    """
+    def __init__(self, registry, config, flush_interval):
+        """Create the retention indexes
+
+        :param cardiff.series.Registry registry: The series registry
+        :param dict config: The retention configuration
+        :param int flush_interval: The flush interval in seconds
+
+        """
+        self.registry = registry
+        self.flush_interval = flush_interval
+        self.counters = self.index(config.get('counters', COUNTER_TTL))
+        self.gauges = self.index(config.get('gauges', GAUGE_TTL))
+        self.gauge_values = dict()
+        ttl = config.get('series', SERIES_TTL)
+        if ttl:
+            ttl = max(ttl, config.get('counters', COUNTER_TTL),
+                      config.get('gauges', GAUGE_TTL))
+        self.series = self.index(ttl)
+        self.expired = 0
+
+    def flush(self, counters, gauges, sets, timers):
+        """Index the series updated in the interval that ended, expiring idle
+        ones, and return the counters and gauges to report, keyed by id.
+
+        :param dict counters: The counter values updated in the interval
+        :param dict gauges: The gauge values updated in the interval
+        :param dict sets: The set values updated in the interval
+        :param dict timers: The timer values updated in the interval
+        :rtype: tuple(dict, dict)
+
+        """
+        if self.series is not None:
+            for values in [counters, gauges, sets, timers]:
+                self.series.touch(values)
+
+        if self.counters is not None:
+            self.counters.touch(counters)
+            self.counters.expire()
+            values = dict.fromkeys(self.counters.seen, 0)
+            values.update(counters)
+            counters = values
+
+        if self.gauges is not None:
+            self.gauges.touch(gauges)
+            self.gauge_values.update(gauges)
+            for series_id in self.gauges.expire():
+                self.gauge_values.pop(series_id, None)
+            gauges = dict(self.gauge_values)
+
+        if self.series is not None:
+            for series_id in self.series.expire():
+                if not self.retained(series_id):
+                    self.registry.release(series_id)
+                    self.expired += 1
+        return counters, gauges
+
+    def discard_counter(self, series_id):
+        """Stop reporting a counter, returning True if it was retained
+
+        :param int series_id: The counter series id
+        :rtype: bool
+
+        """
+        if self.counters is None:
+            return False
+        return self.counters.seen.pop(series_id, None) is not None
+
+    def discard_gauge(self, series_id):
+        """Stop reporting a gauge, returning True if it was retained
+
+        :param int series_id: The gauge series id
+        :rtype: bool
+
+        """
+        return self.gauge_values.pop(series_id, None) is not None
+
+    def gauge(self, series_id):
+        """Return the retained value of a gauge, or 0 if it has none
+
+        :param int series_id: The gauge series id
+        :rtype: int
+
+        """
+        return self.gauge_values.get(series_id, 0)
+
+    def index(self, ttl):
+        """Return a last seen index for the TTL in seconds, or None if the
+        TTL is 0.
+
+        :param int ttl: The TTL in seconds
+        :rtype: LastSeen or None
+
+        """
+        if not ttl:
+            return None
+        return LastSeen(max(1, int(math.ceil(float(ttl) /
+                                             self.flush_interval))))
+
+    def reset_expired(self):
+        """Return the number of series released since the last reset
+
+        :rtype: int
+
+        """
+        expired, self.expired = self.expired, 0
+        if expired:
+            LOGGER.info('Released %i idle series', expired)
+        return expired
+
+    def retained(self, series_id):
+        """Return True if the series is still being reported as a counter or
+        gauge.
+
+        :param int series_id: The series id
+        :rtype: bool
+
+        """
+        return ((self.counters is not None and series_id in self.counters) or
+                series_id in self.gauge_values)
@@ -0,0 +1,203 @@
+"""
+rollups.py
+
+"""
+import logging
+import re
+
+from cardiff import rules
+from cardiff import samples
+
+LOGGER = logging.getLogger(__name__)
+
+COUNTERS = 'counters'
+GAUGES = 'gauges'
+TIMERS = 'timers'
+
+MAX = 'max'
+MERGE = 'merge'
+MIN = 'min'
+SUM = 'sum'
+
+FUNCTIONS = {COUNTERS: [SUM, MAX, MIN],
+             GAUGES: [SUM, MAX, MIN],
+             TIMERS: [MERGE]}
+
+
+class Rollup(object):
+    """A rule deriving a series from the snapshot values of every series
+    matching a glob or regex, grouped by the output name.
+
+    """
+    def __init__(self, index, config):
+        """Create a new rollup from its configuration
+
+        :param int index: The position of the rollup in the configuration
+        :param dict config: The rollup configuration
+        :raises: ValueError
+
+        """
+        self.index = index
+        self.name = config.get('name')
+        if not self.name:
+            raise ValueError('Rollup %i has no name' % index)
+        self.metric_type = config.get('type', COUNTERS)
+        if self.metric_type not in FUNCTIONS:
+            raise ValueError('Invalid type for rollup %s: %s' %
+                             (self.name, self.metric_type))
+        self.function = config.get('function',
+                                   FUNCTIONS[self.metric_type][0])
+        if self.function not in FUNCTIONS[self.metric_type]:
+            raise ValueError('Invalid function for %s rollup %s: %s' %
+                             (self.metric_type, self.name, self.function))
+        self.glob = config.get('glob')
+        if self.glob is not None:
+            self.regex = re.compile(rules.Rule.translate(self.glob))
+        elif config.get('regex') is not None:
+            self.regex = re.compile(config['regex'])
+        else:
+            raise ValueError('Rollup %s has no glob or regex' % self.name)
+        self.keep = config.get('keep', True)
+
+    @property
+    def literal_prefix(self):
+        """Return the first dot delimited segment of the glob if it has no
+        wildcards, used to index the rollups.
+
+        :rtype: str or None
+
+        """
+        if self.glob is not None:
+            segment = self.glob.split('.', 1)[0]
+            if '*' not in segment and '?' not in segment:
+                return segment
+        return None
+
+    def output_name(self, name):
+        """Return the derived series name for a matching series name, or None
+        if it does not match.
+
+        :param str name: The series name
+        :rtype: str or None
+
+        """
+        match = self.regex.match(name)
+        if match:
+            return match.expand(self.name)
+        return None
+
+
+class Rollups(object):
+    """Derive aggregate series from the snapshot at flush time. Rollups are
+    indexed by the literal first segment of their glob, and the rollups each
+    series matches are cached by series id, so a series is matched against
+    the rollups once in its lifetime rather than once per rollup per flush.
+
+    """
+    def __init__(self, registry, config):
+        """Compile the rollups
+
+        :param cardiff.series.Registry registry: The series registry
+        :param list config: The rollup configurations
+
+        """
+        self.registry = registry
+        self.rollups = [Rollup(index, value)
+                        for index, value in enumerate(config)]
+        self.by_prefix = dict()
+        self.unindexed = list()
+        for rollup in self.rollups:
+            prefix = rollup.literal_prefix
+            if prefix is None:
+                self.unindexed.append(rollup)
+            else:
+                self.by_prefix.setdefault(prefix, list()).append(rollup)
+        self.matches = dict()
+        LOGGER.info('Compiled %i rollups', len(self.rollups))
+
+    def apply(self, counters, gauges, timers):
+        """Add the derived series to the snapshot values, removing the raw
+        series matched by rollups that do not keep them. A derived series is
+        skipped if a raw series of the same type with the same name is
+        reported, rather than overwriting it.
+
+        :param dict counters: The counter values keyed by series
+        :param dict gauges: The gauge values keyed by series
+        :param dict timers: The timer values keyed by series
+        :rtype: int
+
+        """
+        derived = 0
+        for metric_type, values in [(COUNTERS, counters),
+                                    (GAUGES, gauges),
+                                    (TIMERS, timers)]:
+            output = dict()
+            for key in values.keys():
+                drop = False
+                for rollup, name in self.match(key):
+                    if rollup.metric_type != metric_type:
+                        continue
+                    self.combine(rollup, output, name, values[key])
+                    drop = drop or not rollup.keep
+                if drop:
+                    del values[key]
+            collisions = [name for name in output if name in values]
+            if collisions:
+                LOGGER.warning('Skipped %i derived %s that have the same name '
+                               'as a raw series: %s', len(collisions),
+                               metric_type, ', '.join(sorted(collisions)[:10]))
+                for name in collisions:
+                    del output[name]
+            values.update(output)
+            derived += len(output)
+        return derived
+
+    @staticmethod
+    def combine(rollup, output, name, value):
+        """Combine the value into the derived series using the rollup
+        function.
+
+        :param Rollup rollup: The rollup
+        :param dict output: The derived values keyed by series
+        :param cardiff.series.Series name: The derived series
+        :param value: The value to combine
+
+        """
+        if name not in output:
+            if rollup.function == MERGE:
+                output[name] = samples.Samples()
+                output[name].merge(value)
+            else:
+                output[name] = value
+        elif rollup.function == SUM:
+            output[name] += value
+        elif rollup.function == MAX:
+            output[name] = max(output[name], value)
+        elif rollup.function == MIN:
+            output[name] = min(output[name], value)
+        elif rollup.function == MERGE:
+            output[name].merge(value)
+
+    def match(self, key):
+        """Return the list of (rollup, derived series) pairs for the series,
+        caching it by series id.
+
+        :param cardiff.series.Series key: The series
+        :rtype: list
+
+        """
+        try:
+            cached_key, matches = self.matches[key.id]
+            if cached_key is key:
+                return matches
+        except KeyError:
+            pass
+        matches = list()
+        candidates = self.by_prefix.get(key.name.split('.', 1)[0], [])
+        for rollup in sorted(candidates + self.unindexed,
+                             key=lambda value: value.index):
+            name = rollup.output_name(key.name)
+            if name is not None:
+                matches.append((rollup, self.registry.add(name)))
+        self.matches[key.id] = key, matches
+        return matches
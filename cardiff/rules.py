@@ -0,0 +1,201 @@
+"""
+rules.py
+
+"""
+import logging
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+ALLOW = 'allow'
+DENY = 'deny'
+REWRITE = 'rewrite'
+ACTIONS = [ALLOW, DENY, REWRITE]
+
+CACHE_SIZE = 100000
+TERMINAL = None
+
+
+class Rule(object):
+    """A single allow, deny or rewrite rule matching metric keys by prefix,
+    glob or regular expression.
+
+    """
+    def __init__(self, index, config):
+        """Create a new rule from its configuration
+
+        :param int index: The position of the rule in the configuration
+        :param dict config: The rule configuration
+        :raises: ValueError
+
+        """
+        self.index = index
+        self.action = config.get('action', ALLOW)
+        if self.action not in ACTIONS:
+            raise ValueError('Invalid action for rule %i: %s' %
+                             (index, self.action))
+        self.name = config.get('name', 'rule_%i' % index)
+        self.replace = config.get('replace')
+        if self.action == REWRITE and self.replace is None:
+            raise ValueError('Rewrite rule %s has no replace value' %
+                             self.name)
+        self.prefix = config.get('prefix')
+        if self.prefix is not None:
+            self.regex = None
+        elif config.get('glob') is not None:
+            self.regex = re.compile(self.translate(config['glob']))
+        elif config.get('regex') is not None:
+            try:
+                self.regex = re.compile(config['regex'])
+            except re.error as error:
+                raise ValueError('Invalid regex for rule %s: %s' %
+                                 (self.name, error))
+        else:
+            raise ValueError('Rule %s has no prefix, glob or regex' %
+                             self.name)
+
+    def rewrite(self, key):
+        """Return the rewritten key
+
+        :param str key: The metric key
+        :rtype: str
+
+        """
+        if self.prefix is not None:
+            return self.replace + key[len(self.prefix):]
+        return self.regex.match(key).expand(self.replace)
+
+    @staticmethod
+    def translate(glob):
+        """Translate a graphite style glob into a regular expression, where *
+        and ? do not match across dots. Each wildcard is a group so rewrite
+        rules can refer to them.
+
+        :param str glob: The glob pattern
+        :rtype: str
+
+        """
+        pattern = list()
+        for char in glob:
+            if char == '*':
+                pattern.append(r'([^.]*)')
+            elif char == '?':
+                pattern.append(r'([^.])')
+            else:
+                pattern.append(re.escape(char))
+        return '%s$' % ''.join(pattern)
+
+
+class Rules(object):
+    """Allow, deny and rewrite rules applied to metric keys at ingest. The
+    first matching rule in configuration order wins and rules with enabled
+    set to false are skipped. Prefix rules are compiled into a trie so that a
+    key is matched against all of them in one pass. Glob and regex rules are
+    compiled separately, since patterns with their own groups and
+    backreferences can not be combined into one alternation, and are only
+    tried up to the first matching prefix rule. The decision for each raw key
+    is cached so that repeat keys cost a single dict lookup.
+
+    """
+    def __init__(self, config):
+        """Compile the rules
+
+        :param list config: The rule configurations
+
+        """
+        config = [value for value in config if value.get('enabled', True)]
+        self.rules = [Rule(index, value) for index, value in enumerate(config)]
+        self.trie = dict()
+        for rule in self.rules:
+            if rule.prefix is not None:
+                self.add_prefix(rule)
+        self.patterns = [rule for rule in self.rules if rule.regex]
+        self.cache = dict()
+        self.hits = [0] * len(self.rules)
+        LOGGER.info('Compiled %i ingest rules', len(self.rules))
+
+    def add_prefix(self, rule):
+        """Add a prefix rule to the trie, keeping the first rule if more than
+        one has the same prefix.
+
+        :param Rule rule: The prefix rule
+
+        """
+        node = self.trie
+        for char in rule.prefix:
+            node = node.setdefault(char, dict())
+        node.setdefault(TERMINAL, rule.index)
+
+    def apply(self, key):
+        """Return the key to aggregate the metric under, or None if the key is
+        denied.
+
+        :param str key: The raw metric key
+        :rtype: str or None
+
+        """
+        try:
+            index, value = self.cache[key]
+        except KeyError:
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache = dict()
+            index, value = self.cache[key] = self.evaluate(key)
+        if index is not None:
+            self.hits[index] += 1
+        return value
+
+    def evaluate(self, key):
+        """Find the first rule that matches the key and return its index and
+        the resulting key.
+
+        :param str key: The raw metric key
+        :rtype: tuple(int, str or None)
+
+        """
+        index = self.match(key)
+        if index is None:
+            return None, key
+        rule = self.rules[index]
+        if rule.action == DENY:
+            return index, None
+        elif rule.action == REWRITE:
+            return index, rule.rewrite(key)
+        return index, key
+
+    def match(self, key):
+        """Return the index of the first rule matching the key, or None
+
+        :param str key: The raw metric key
+        :rtype: int or None
+
+        """
+        index = None
+        node = self.trie
+        for char in key:
+            if TERMINAL in node and (index is None or node[TERMINAL] < index):
+                index = node[TERMINAL]
+            try:
+                node = node[char]
+            except KeyError:
+                break
+        else:
+            if TERMINAL in node and (index is None or node[TERMINAL] < index):
+                index = node[TERMINAL]
+
+        for rule in self.patterns:
+            if index is not None and rule.index > index:
+                break
+            if rule.regex.match(key):
+                return rule.index
+        return index
+
+    def reset_hits(self):
+        """Return the hit count for each rule name since the last reset
+
+        :rtype: dict
+
+        """
+        hits = dict([(rule.name, self.hits[rule.index])
+                     for rule in self.rules if self.hits[rule.index]])
+        self.hits = [0] * len(self.rules)
+        return hits
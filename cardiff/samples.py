@@ -0,0 +1,44 @@
+"""
+samples.py
+
+"""
+import array
+
+
+class Samples(array.array):
+    """The values recorded for a timer in an interval, stored as doubles.
+    The weight is the number of timings the values represent, which is
+    larger than the number of values when they were sampled by the client
+    or while shedding load.
+
+    """
+    def __new__(cls, values=(), weight=None):
+        obj = array.array.__new__(cls, 'd', values)
+        obj.weight = float(len(obj) if weight is None else weight)
+        return obj
+
+    def __deepcopy__(self, memo):
+        return Samples(self, self.weight)
+
+    def __reduce__(self):
+        return Samples, (list(self), self.weight)
+
+    def add(self, value, weight=1.0):
+        """Append a value that represents weight timings
+
+        :param float value: The timer value
+        :param float weight: The number of timings the value represents
+
+        """
+        self.append(value)
+        self.weight += weight
+
+    def merge(self, values):
+        """Extend the samples with another set of samples, adding their
+        weight.
+
+        :param iter values: The samples or values to merge
+
+        """
+        self.extend(values)
+        self.weight += getattr(values, 'weight', len(values))
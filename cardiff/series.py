@@ -0,0 +1,230 @@
+"""
+series.py
+
+"""
+
+
+class Series(str):
+    """A metric key with a set of DogStatsD style tags. The string value is
+    the canonical form of the name and sorted tags so that the series can be
+    used as a key by backends that are not tag aware, while name and tags
+    give tag aware backends a structured view. The id is the index of the
+    series in the Registry that created it and is not carried when pickled.
+
+    """
+    def __new__(cls, name, tags=(), series_id=None):
+        if tags:
+            value = '%s;%s' % (name, ';'.join(['%s=%s' % tag if tag[1]
+                                               else tag[0] for tag in tags]))
+        else:
+            value = name
+        obj = str.__new__(cls, value)
+        obj.id = series_id
+        obj.name = name
+        obj.tags = tags
+        return obj
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Series, (self.name, self.tags)
+
+    @property
+    def path(self):
+        """Return the name with the tags folded into it as path segments, for
+        backends such as Graphite that have no native tag support.
+
+        :rtype: str
+
+        """
+        if not self.tags:
+            return self.name
+        return '.'.join([self.name] +
+                        [('%s_%s' % tag if tag[1] else tag[0]).replace('.', '_')
+                         for tag in self.tags])
+
+
+def name(key):
+    """Return the name for a metric key that may or may not be tagged
+
+    :param str key: The metric key
+    :rtype: str
+
+    """
+    return getattr(key, 'name', key)
+
+
+def path(key):
+    """Return the tag folded path for a metric key that may or may not be
+    tagged.
+
+    :param str key: The metric key
+    :rtype: str
+
+    """
+    return getattr(key, 'path', key)
+
+
+def tags(key):
+    """Return the tags for a metric key that may or may not be tagged
+
+    :param str key: The metric key
+    :rtype: tuple
+
+    """
+    return getattr(key, 'tags', ())
+
+
+def parse_tags(value):
+    """Parse a DogStatsD tag string such as "env:prod,role" into a sorted
+    tuple of (tag, value) pairs, using an empty value for bare tags.
+
+    :param str value: The comma delimited tag string
+    :rtype: tuple
+
+    """
+    parsed = set()
+    for tag in value.split(','):
+        if tag:
+            tag_name, _, tag_value = tag.partition(':')
+            parsed.add((tag_name, tag_value))
+    return tuple(sorted(parsed))
+
+
+class Registry(object):
+    """Map each metric key to a Series with a small integer id the first time
+    it is seen. Aggregation is keyed by the id and backends cache formatted
+    output names by it. Keys are sanitized only when first registered, so
+    lookups for a raw key and tag string that have been seen before cost a
+    single dict lookup. The ids of released series are reused.
+
+    """
+    def __init__(self, sanitize=None):
+        """Create a new registry
+
+        :param method sanitize: Called to sanitize new metric names
+
+        """
+        self.sanitize = sanitize
+        self.raw = dict()
+        self.aliases = dict()
+        self.canonical = dict()
+        self.series = list()
+        self.free = list()
+        self.pinned = set()
+
+    def __len__(self):
+        return len(self.canonical)
+
+    def add(self, name, tags=()):
+        """Return the series for the sanitized name and sorted tags,
+        registering it if it has not been seen before.
+
+        :param str name: The sanitized metric name
+        :param tuple tags: The sorted (tag, value) pairs
+        :rtype: Series
+
+        """
+        try:
+            return self.canonical[(name, tags)]
+        except KeyError:
+            if self.free:
+                value = Series(name, tags, self.free.pop())
+                self.series[value.id] = value
+            else:
+                value = Series(name, tags, len(self.series))
+                self.series.append(value)
+            self.canonical[(name, tags)] = value
+            return value
+
+    def find(self, key, tag_string=None):
+        """Return the series for the raw key and DogStatsD tag string if it
+        has been registered, otherwise None.
+
+        :param str key: The raw metric key
+        :param str tag_string: The raw DogStatsD tag string
+        :rtype: Series or None
+
+        """
+        if tag_string is None:
+            return self.raw.get(key)
+        return self.raw.get((key, tag_string))
+
+    def get(self, key, tag_string=None):
+        """Return the series for the raw key and DogStatsD tag string
+
+        :param str key: The raw metric key
+        :param str tag_string: The raw DogStatsD tag string
+        :rtype: Series
+
+        """
+        try:
+            if tag_string is None:
+                return self.raw[key]
+            return self.raw[(key, tag_string)]
+        except KeyError:
+            return self.register(key, tag_string)
+
+    def lookup(self, key):
+        """Return the series for a key received from elsewhere, such as an
+        unpickled Series from a downstream cardiff.
+
+        :param str key: The metric key
+        :rtype: Series
+
+        """
+        if isinstance(key, Series):
+            return self.add(key.name, key.tags)
+        return self.get(key)
+
+    def pin(self, name):
+        """Return the series for the sanitized name, registering it and
+        preventing it from being released.
+
+        :param str name: The sanitized metric name
+        :rtype: Series
+
+        """
+        value = self.add(name)
+        self.pinned.add(value.id)
+        return value
+
+    def register(self, key, tag_string):
+        """Sanitize the key, parse the tag string and register the series,
+        sharing it between raw keys and tag strings that sanitize to the same
+        name and tag set.
+
+        :param str key: The raw metric key
+        :param str tag_string: The raw DogStatsD tag string
+        :rtype: Series
+
+        """
+        name = self.sanitize(key) if self.sanitize else key
+        if tag_string is None:
+            value = self.raw[key] = self.add(name)
+        else:
+            value = self.add(name, parse_tags(tag_string))
+            key = key, tag_string
+            self.raw[key] = value
+        self.aliases.setdefault(value.id, list()).append(key)
+        return value
+
+    def release(self, series_id):
+        """Remove an idle series and the raw keys that map to it, freeing its
+        id for reuse.
+
+        :param int series_id: The id of the series to release
+
+        """
+        value = self.series[series_id]
+        if value is None or series_id in self.pinned:
+            return
+        del self.canonical[(value.name, value.tags)]
+        for key in self.aliases.pop(series_id, []):
+            del self.raw[key]
+        self.series[series_id] = None
+        self.free.append(series_id)
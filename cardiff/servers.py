@@ -1,29 +1,70 @@
+import errno
+import itertools
 import logging
+import os
 import socket
+import stat
 import pickle
+import zlib
+from tornado import httpserver
 from tornado import iostream
 from tornado import stack_context
 from tornado import tcpserver
+from tornado import web
 
 
 LOGGER = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536
+
 
 class UDPServer(object):
+    """Listen for statsd datagrams on a UDP socket, handing each datagram
+    read to the on_read_callback. When a recorder is set, each datagram is
+    also appended to its capture file.
+
+    """
+    MAX_DATAGRAM = 8192
+    MAX_READS = 64
+
+    recorder = None
 
-    def __init__(self, host, port, ioloop, on_read_callback):
+    def __init__(self, host, port, ioloop, on_read_callback,
+                 receive_buffer=None):
         self.ioloop = ioloop
+        self.receive_buffer = receive_buffer
         self.listen(host, port)
         self.on_read_callback = on_read_callback
 
     def close(self):
-        self.ioloop.remove_handler(self.socket)
+        self.ioloop.remove_handler(self.socket.fileno())
         self.socket.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def create_socket(self):
+        """Return a new socket object for the server to listen on
+
+        :rtype: socket.socket
+
+        """
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def listen(self, host, port):
         LOGGER.info('Listening on %s:%i UDP', host, port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket = self.create_socket()
         self.socket.bind((host, port))
+        self.add_to_ioloop()
+
+    def add_to_ioloop(self):
+        """Set the socket options common to all datagram listeners and add
+        the socket to the IOLoop.
+
+        """
+        self.socket.setblocking(0)
+        if self.receive_buffer:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self.receive_buffer)
         self.ioloop.add_handler(self.socket.fileno(),
                                 self.on_ioloop_events,
                                 self.ioloop.READ | self.ioloop.ERROR)
@@ -55,19 +96,84 @@ class UDPServer(object):
         LOGGER.error('Socket error: %s', error[0], error[1])
 
     def read_from_socket(self):
+        """Read up to MAX_READS datagrams that are waiting on the socket
+        before returning control to the IOLoop, avoiding a trip through the
+        poller for every datagram when under load.
+
+        """
+        for iteration in xrange(self.MAX_READS):
+            try:
+                data = self.socket.recv(self.MAX_DATAGRAM)
+            except socket.timeout:
+                LOGGER.error('Socket timeout, dying')
+                return self.ioloop.stop()
+            except socket.error as error:
+                if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                return self.on_socket_error(error)
+            if data:
+                if self.recorder is not None:
+                    self.recorder.record(data)
+                self.on_read_callback(data)
+
+
+class UnixDatagramServer(UDPServer):
+    """Listen for statsd datagrams on a unix domain socket. Local senders
+    avoid the UDP/IP stack and block or receive EAGAIN when the receive
+    queue is full instead of having the datagram silently dropped.
+
+    """
+    def __init__(self, path, ioloop, on_read_callback, mode=None,
+                 receive_buffer=None):
+        self.ioloop = ioloop
+        self.receive_buffer = receive_buffer
+        self.path = path
+        self.mode = mode
+        self.listen_unix(path)
+        self.on_read_callback = on_read_callback
+
+    def close(self):
+        super(UnixDatagramServer, self).close()
+        self.remove_socket_file()
+
+    def create_socket(self):
+        """Return a new unix domain datagram socket
+
+        :rtype: socket.socket
+
+        """
+        return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def listen_unix(self, path):
+        """Bind to the socket path, removing a stale socket file left behind
+        by a previous run.
+
+        :param str path: The socket path
+
+        """
+        LOGGER.info('Listening on %s UNIX datagram socket', path)
+        self.remove_socket_file()
+        self.socket = self.create_socket()
+        self.socket.bind(path)
+        if self.mode is not None:
+            os.chmod(path, self.mode)
+        self.add_to_ioloop()
+
+    def remove_socket_file(self):
+        """Remove the socket file if it exists"""
         try:
-            data = self.socket.recv(8192)
-        except socket.timeout:
-            LOGGER.error('Socket timeout, dying')
-            return self.ioloop.stop()
-        except socket.error, error:
-            return self.on_socket_error(error)
-        if data:
-            self.on_read_callback(data)
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
 
 
 class UpstreamConnection(object):
+    """Read pickled frames from a downstream cardiff until it closes the
+    connection, processing each frame as it arrives.
 
+    """
     FRAME_END = 206
 
     def __init__(self, stream, address, request_callback):
@@ -75,18 +181,21 @@ class UpstreamConnection(object):
         self.address = address
         self.request_callback = request_callback
         self.on_data_context = stack_context.wrap(self.on_data)
-        try:
-            self.stream.read_until(chr(self.FRAME_END), self.on_data_context)
-        except iostream.StreamClosedError:
-            self.close()
+        self.read()
 
     def close(self):
         self.stream.close()
 
     def on_data(self, data):
         LOGGER.info('Received %i bytes from %s', len(data), self.address)
-        self.close()
         self.request_callback(**pickle.loads(data))
+        self.read()
+
+    def read(self):
+        try:
+            self.stream.read_until(chr(self.FRAME_END), self.on_data_context)
+        except iostream.StreamClosedError:
+            self.close()
 
 
 class UpstreamServer(tcpserver.TCPServer):
@@ -106,3 +215,188 @@ class UpstreamServer(tcpserver.TCPServer):
     def listen(self, port, address=""):
         LOGGER.info('Listening on %s:%i TCP', address, port)
         super(UpstreamServer, self).listen(port, address)
+
+
+class AdminConnection(object):
+    """Read newline terminated admin commands, writing the output of each
+    in batches so that large dumps do not block the IOLoop.
+
+    """
+    BATCH_SIZE = 1000
+    END = 'END\n\n'
+
+    def __init__(self, stream, address, command_callback):
+        self.stream = stream
+        self.address = address
+        self.command_callback = command_callback
+        self.read()
+
+    def close(self):
+        self.stream.close()
+
+    def on_command(self, data):
+        command = data.strip()
+        if command in ('exit', 'quit'):
+            self.close()
+            return
+        LOGGER.debug('Admin command from %s: %r', self.address, command)
+        self.write(iter(self.command_callback(command)))
+
+    def read(self):
+        try:
+            self.stream.read_until('\n', self.on_command)
+        except iostream.StreamClosedError:
+            self.close()
+
+    def write(self, lines):
+        try:
+            batch = list(itertools.islice(lines, self.BATCH_SIZE))
+        except Exception as error:
+            LOGGER.exception('Error running admin command')
+            batch, lines = ['ERROR: %s' % error], iter(())
+        try:
+            if batch:
+                self.stream.write('%s\n' % '\n'.join(batch),
+                                  lambda: self.write(lines))
+            else:
+                self.stream.write(self.END, self.read)
+        except iostream.StreamClosedError:
+            self.close()
+
+
+class AdminServer(tcpserver.TCPServer):
+    """A TCP server for inspecting and modifying a running cardiff, modeled
+    on the statsd management interface.
+
+    """
+    def __init__(self, ioloop, command_callback):
+        self.command_callback = command_callback
+        super(AdminServer, self).__init__(io_loop=ioloop)
+
+    def handle_stream(self, stream, address):
+        AdminConnection(stream, address, self.command_callback)
+
+    def listen(self, port, address=""):
+        LOGGER.info('Listening on %s:%i TCP for admin commands', address, port)
+        super(AdminServer, self).listen(port, address)
+
+
+def iter_chunks(body, encoding=None, chunk_size=CHUNK_SIZE):
+    """Yield the request body in chunks of at most chunk_size bytes,
+    incrementally decompressing it if it is gzip or deflate encoded.
+
+    :param str body: The request body
+    :param str encoding: The Content-Encoding of the body
+    :param int chunk_size: The maximum chunk size to yield
+    :raises: zlib.error
+
+    """
+    if encoding not in ('gzip', 'deflate'):
+        for offset in xrange(0, len(body), chunk_size):
+            yield body[offset:offset + chunk_size]
+        return
+
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    for offset in xrange(0, len(body), chunk_size):
+        data = body[offset:offset + chunk_size]
+        while data:
+            chunk = decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+            data = decompressor.unconsumed_tail
+    # Input after the end of a complete stream is left unused, so a
+    # truncated stream is detected by feeding it one more byte
+    if not decompressor.unused_data:
+        chunk = decompressor.decompress('\0')
+        if not decompressor.unused_data:
+            raise zlib.error('Truncated %s stream' % encoding)
+        if chunk:
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def iter_lines(chunks):
+    """Yield each non-empty line from an iterator of chunks, carrying partial
+    lines over to the next chunk.
+
+    :param iter chunks: The chunks to split into lines
+    :rtype: iter
+
+    """
+    remainder = ''
+    for chunk in chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if remainder:
+        yield remainder
+
+
+class BulkIngestHandler(web.RequestHandler):
+    """Accept a POST body of newline delimited statsd lines, optionally gzip
+    compressed, returning the number of lines accepted and rejected. A
+    compressed body is decompressed once to validate it before any of its
+    lines are aggregated, discarding the output so that the decompressed
+    body is never held in memory, so a corrupt body is rejected as a whole.
+
+    """
+    def initialize(self, callback):
+        self.callback = callback
+
+    def post(self):
+        encoding = self.request.headers.get('Content-Encoding')
+        try:
+            if encoding in ('gzip', 'deflate'):
+                for chunk in iter_chunks(self.request.body, encoding):
+                    pass
+        except zlib.error as error:
+            LOGGER.warning('Error decompressing bulk request from %s: %s',
+                           self.request.remote_ip, error)
+            raise web.HTTPError(400, 'Invalid %s body' % encoding)
+        lines = iter_lines(iter_chunks(self.request.body, encoding))
+        accepted, rejected = self.callback(lines)
+        LOGGER.debug('Bulk request from %s: %i accepted, %i rejected',
+                     self.request.remote_ip, accepted, rejected)
+        self.write({'accepted': accepted, 'rejected': rejected})
+
+
+class HistoryHandler(web.RequestHandler):
+    """Return the recent values of the series matching the target glob as
+    JSON, from the in-memory history. The from and until arguments are
+    unix timestamps or, when negative, seconds relative to now.
+
+    """
+    def initialize(self, callback):
+        self.callback = callback
+
+    def get(self):
+        try:
+            values = self.callback(self.get_argument('target'),
+                                   self.int_argument('from'),
+                                   self.int_argument('until'),
+                                   self.int_argument('resolution'))
+        except ValueError as error:
+            raise web.HTTPError(400, str(error))
+        if values is None:
+            raise web.HTTPError(404, 'History is not enabled')
+        self.write(values)
+
+    def int_argument(self, name):
+        value = self.get_argument(name, None)
+        return int(value) if value else None
+
+
+class HTTPServer(httpserver.HTTPServer):
+
+    def __init__(self, ioloop, handlers):
+        self.application = web.Application(handlers)
+        super(HTTPServer, self).__init__(self.application, io_loop=ioloop)
+
+    def listen(self, port, address=""):
+        LOGGER.info('Listening on %s:%i HTTP', address, port)
+        super(HTTPServer, self).listen(port, address)
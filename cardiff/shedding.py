@@ -0,0 +1,138 @@
+"""
+shedding.py
+
+"""
+import logging
+import random
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_LAG = 50
+MIN_RATE = 0.01
+PROBE_INTERVAL = 100
+RECOVERY = 1.25
+
+
+class LoadShedder(object):
+    """Measure how late the IOLoop runs a periodic probe and compute the rate
+    to sample inbound datagram lines at. When the lag passes max_lag the
+    rate is cut in proportion to how far over it is, and once the lag falls
+    below half of max_lag the rate recovers gradually back to 1.
+
+    Counter and timer updates are sampled with the rate rounded to the
+    inverse of a whole number of updates, the step, each update being kept
+    with a probability of one in step and standing for step updates. Kept
+    counter values are multiplied by the step, so they stay integral and
+    their expected total is the total of the updates received, and kept
+    timer values are weighted by it. This makes shedding deliberate and
+    correctable instead of leaving the kernel to drop datagrams at random.
+    Gauges and sets can not be corrected for dropped updates and are never
+    sampled.
+
+    """
+    def __init__(self, ioloop, config):
+        """Create a new load shedder
+
+        :param tornado.ioloop.IOLoop ioloop: The IOLoop to measure
+        :param dict config: The load shedding configuration
+
+        """
+        self.ioloop = ioloop
+        self.max_lag = config.get('max_lag', MAX_LAG)
+        self.min_rate = config.get('min_rate', MIN_RATE)
+        self.probe_interval = config.get('probe_interval', PROBE_INTERVAL)
+        self.rate = 1.0
+        self.lowest_rate = 1.0
+        self.max_seen_lag = 0
+        self.expected = None
+        self.timeout = None
+
+    def adjust(self, lag):
+        """Adjust the sample rate for the measured lag
+
+        :param float lag: The IOLoop lag in milliseconds
+
+        """
+        self.max_seen_lag = max(self.max_seen_lag, lag)
+        if lag > self.max_lag:
+            rate = max(self.min_rate, self.rate * self.max_lag / lag)
+            if rate < self.rate:
+                LOGGER.warning('IOLoop lag of %.1fms, sampling at %.3f',
+                               lag, rate)
+                self.rate = rate
+        elif lag < self.max_lag / 2.0 and self.rate < 1.0:
+            self.rate = min(1.0, self.rate * RECOVERY)
+            if self.rate == 1.0:
+                LOGGER.info('IOLoop lag recovered, no longer sampling')
+        self.lowest_rate = min(self.lowest_rate, self.rate)
+
+    def on_probe(self):
+        """Invoked by the IOLoop, measuring how late it ran"""
+        now = time.time()
+        self.adjust(max(0.0, (now - self.expected) * 1000))
+        self.schedule(now)
+
+    def reset(self):
+        """Return the effective and lowest sample rate and the largest lag
+        seen since the last reset.
+
+        :rtype: tuple(float, float, float)
+
+        """
+        values = 1.0 / self.step, self.lowest_rate, self.max_seen_lag
+        self.lowest_rate = self.rate
+        self.max_seen_lag = 0
+        return values
+
+    def restart(self):
+        """Restart the probe, ignoring the time the IOLoop was knowingly
+        blocked such as while delivering stats.
+
+        """
+        if self.timeout:
+            self.ioloop.remove_timeout(self.timeout)
+        self.schedule(time.time())
+
+    def sample(self):
+        """Return the number of updates a kept update stands for, or 0 if
+        the update is dropped.
+
+        :rtype: int
+
+        """
+        step = self.step
+        if step == 1 or random.random() * step < 1:
+            return step
+        return 0
+
+    def schedule(self, now):
+        """Schedule the next probe
+
+        :param float now: The current time
+
+        """
+        self.expected = now + self.probe_interval / 1000.0
+        self.timeout = self.ioloop.add_timeout(self.expected, self.on_probe)
+
+    @property
+    def step(self):
+        """Return the number of updates each kept update stands for at the
+        current rate.
+
+        :rtype: int
+
+        """
+        return max(1, int(round(1.0 / self.rate)))
+
+    def start(self):
+        """Start probing the IOLoop"""
+        LOGGER.info('Shedding load when IOLoop lag exceeds %ims',
+                    self.max_lag)
+        self.schedule(time.time())
+
+    def stop(self):
+        """Stop probing the IOLoop"""
+        if self.timeout:
+            self.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
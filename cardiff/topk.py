@@ -0,0 +1,92 @@
+"""
+topk.py
+
+"""
+import heapq
+import operator
+
+CAPACITY = 1000
+SIZE = 10
+
+
+class SpaceSaving(object):
+    """Track the most frequently updated keys in a fixed amount of memory
+    with the Space-Saving algorithm. At most capacity keys are counted, and
+    a new key replaces one of the keys with the lowest count, inheriting
+    that count as its possible overestimate. Keys are grouped in buckets by
+    count so that an update is a handful of dict and set operations and
+    never a scan.
+
+    """
+    def __init__(self, capacity=CAPACITY):
+        """Create a new sketch
+
+        :param int capacity: The maximum number of keys to count
+
+        """
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+        self.buckets = dict()
+        self.minimum = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def reset(self):
+        """Forget all of the keys and counts"""
+        self.counts = dict()
+        self.errors = dict()
+        self.buckets = dict()
+        self.minimum = 0
+
+    def top(self, size=SIZE):
+        """Return the (key, count, error) of the most updated keys, where the
+        true count is between count - error and count.
+
+        :param int size: The number of keys to return
+        :rtype: list
+
+        """
+        return [(key, count, self.errors[key])
+                for key, count in heapq.nlargest(size,
+                                                 self.counts.iteritems(),
+                                                 operator.itemgetter(1))]
+
+    def update(self, key):
+        """Count an update of the key
+
+        :param key: The key that was updated
+
+        """
+        counts, buckets = self.counts, self.buckets
+        try:
+            count = counts[key]
+        except KeyError:
+            if len(counts) < self.capacity:
+                count = 0
+                self.errors[key] = 0
+            else:
+                count = self.minimum
+                victim = buckets[count].pop()
+                del counts[victim]
+                del self.errors[victim]
+                self.errors[key] = count
+                if not buckets[count]:
+                    del buckets[count]
+        else:
+            bucket = buckets[count]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[count]
+
+        counts[key] = count + 1
+        try:
+            buckets[count + 1].add(key)
+        except KeyError:
+            buckets[count + 1] = set([key])
+
+        if not count:
+            self.minimum = 1
+        elif count == self.minimum and count not in buckets:
+            self.minimum = count + 1
@@ -0,0 +1,731 @@
+"""
+workers.py
+
+"""
+import _multiprocessing
+import array
+import errno
+import functools
+import logging
+import mmap
+import multiprocessing
+from multiprocessing import reduction
+import os
+import signal
+import struct
+import tempfile
+import time
+
+from cardiff import samples
+from cardiff import series
+
+LOGGER = logging.getLogger(__name__)
+
+DIRECTORY = '/dev/shm'
+MAX_PENDING = 3
+REAP_INTERVAL = 1
+RESTART_DELAY = 5
+
+MAGIC = 'CDFSNAP1'
+HEADER = struct.Struct('=8sdI')
+SECTION = struct.Struct('=I')
+
+FLOAT, INT, NONE = 0, 1, 2
+NO_ID = 0xFFFFFFFF
+
+NUMBERS, SETS, TIMERS = 0, 1, 2
+
+# The kind of values and whether the keys are internal stat tuples for each
+# of the value dicts in a snapshot, in order
+SECTIONS = [(NUMBERS, False), (NUMBERS, False), (SETS, False),
+            (TIMERS, False), (NUMBERS, True), (NUMBERS, True), (TIMERS, True)]
+
+
+def pack_strings(values):
+    """Return the chunks of a column of strings, their lengths followed by
+    their concatenated values.
+
+    :param list values: The strings
+    :rtype: list
+
+    """
+    return [array.array('I', [len(value) for value in values]).tostring(),
+            ''.join(values)]
+
+
+def encode_numbers(values, keys):
+    """Return the chunks of a column of numbers, a type flag for each value
+    so that ints, floats and None are restored as they were, followed by
+    the values as doubles.
+
+    :param dict values: The values
+    :param list keys: The keys in column order
+    :rtype: list
+
+    """
+    flags, numbers = array.array('b'), array.array('d')
+    for key in keys:
+        value = values[key]
+        if value is None:
+            flags.append(NONE)
+            numbers.append(0)
+        else:
+            flags.append(INT if isinstance(value, (int, long)) else FLOAT)
+            numbers.append(value)
+    return [flags.tostring(), numbers.tostring()]
+
+
+def encode_sets(values, keys):
+    """Return the chunks of a column of sets, the number of members of each
+    set, the members and the number of times each member was added.
+
+    :param dict values: The sets
+    :param list keys: The keys in column order
+    :rtype: list
+
+    """
+    members, counts = list(), array.array('d')
+    for key in keys:
+        for member, count in values[key].iteritems():
+            members.append(str(member))
+            counts.append(count)
+    sizes = array.array('I', [len(values[key]) for key in keys])
+    return [sizes.tostring()] + pack_strings(members) + [counts.tostring()]
+
+
+def encode_timers(values, keys):
+    """Return the chunks of a column of timers, the number of samples and
+    the weight of each timer, followed by all of the samples.
+
+    :param dict values: The timers
+    :param list keys: The keys in column order
+    :rtype: list
+
+    """
+    sizes, weights, timings = array.array('I'), array.array('d'), \
+        array.array('d')
+    for key in keys:
+        value = values[key]
+        sizes.append(len(value))
+        weights.append(getattr(value, 'weight', len(value)))
+        timings.extend(value)
+    return [sizes.tostring(), weights.tostring(), timings.tostring()]
+
+
+ENCODERS = {NUMBERS: encode_numbers, SETS: encode_sets, TIMERS: encode_timers}
+
+
+def encode(stats):
+    """Return a snapshot as a string in the columnar layout, each dict of
+    values as a section of the number of keys, the key column and the value
+    columns.
+
+    :param list stats: The snapshot values
+    :rtype: str
+
+    """
+    chunks = [HEADER.pack(MAGIC, stats[0], len(SECTIONS))]
+    for (kind, internal), values in zip(SECTIONS, stats[1:]):
+        keys = list(values)
+        chunks.append(SECTION.pack(len(keys)))
+        if internal:
+            chunks += pack_strings(['\t'.join(key) for key in keys])
+        else:
+            ids = [getattr(key, 'id', None) for key in keys]
+            chunks.append(array.array('I', [NO_ID if value is None else value
+                                            for value in ids]).tostring())
+            chunks += pack_strings(keys)
+        chunks += ENCODERS[kind](values, keys)
+    return ''.join(chunks)
+
+
+def write(directory, sequence, stats):
+    """Write the snapshot to a file in the directory, returning its path
+
+    :param str directory: The directory to write to
+    :param int sequence: The snapshot sequence number
+    :param list stats: The snapshot values
+    :rtype: str
+
+    """
+    path = os.path.join(directory, 'cardiff-%i-%i.snapshot' %
+                        (os.getpid(), sequence))
+    with open(path, 'wb') as handle:
+        handle.write(encode(stats))
+    return path
+
+
+class Reader(object):
+    """Read the columns of a snapshot from a buffer"""
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def array(self, typecode, count):
+        """Return the next column of count values of the array type
+
+        :param str typecode: The array type code
+        :param int count: The number of values
+        :rtype: array.array
+
+        """
+        values = array.array(typecode)
+        end = self.offset + values.itemsize * count
+        values.fromstring(self.data[self.offset:end])
+        self.offset = end
+        return values
+
+    def strings(self, count):
+        """Return the next column of count strings
+
+        :param int count: The number of strings
+        :rtype: list
+
+        """
+        values = list()
+        for length in self.array('I', count):
+            offset = self.offset
+            values.append(self.data[offset:offset + length])
+            self.offset = offset + length
+        return values
+
+    def unpack(self, structure):
+        """Return the values of the next struct
+
+        :param struct.Struct structure: The struct
+        :rtype: tuple
+
+        """
+        values = structure.unpack_from(self.data, self.offset)
+        self.offset += structure.size
+        return values
+
+
+class Decoder(object):
+    """Decode snapshots in a worker, keeping the series objects of the last
+    snapshot so that the same object is passed to the backend for a series
+    id each flush and the backend output name caches keep working.
+
+    """
+    def __init__(self):
+        self.series = dict()
+
+    def decode(self, data):
+        """Return the snapshot values from a buffer
+
+        :param buffer data: The columnar snapshot
+        :rtype: list
+        :raises: ValueError
+
+        """
+        reader = Reader(data)
+        magic, timestamp, sections = reader.unpack(HEADER)
+        if magic != MAGIC or sections != len(SECTIONS):
+            raise ValueError('Not a cardiff snapshot')
+        stats = [int(timestamp)]
+        known, self.series = self.series, dict()
+        for kind, internal in SECTIONS:
+            count = reader.unpack(SECTION)[0]
+            if internal:
+                keys = [tuple(key.split('\t'))
+                        for key in reader.strings(count)]
+            else:
+                keys = self.keys(reader.array('I', count),
+                                 reader.strings(count), known)
+            if kind == NUMBERS:
+                values = self.numbers(reader, count)
+            elif kind == SETS:
+                values = self.sets(reader, count)
+            else:
+                values = self.timers(reader, count)
+            stats.append(dict(zip(keys, values)))
+        return stats
+
+    def keys(self, ids, names, known):
+        """Return the series for the ids and canonical names, reusing the
+        series from the last snapshot if the id still has the same name.
+
+        :param array.array ids: The series ids
+        :param list names: The canonical series names
+        :param dict known: The series of the last snapshot by id
+        :rtype: list
+
+        """
+        keys = list()
+        for series_id, name in zip(ids, names):
+            if series_id == NO_ID:
+                keys.append(name)
+                continue
+            value = self.series.get(series_id) or known.get(series_id)
+            if value is None or value != name:
+                parts = name.split(';')
+                tags = tuple([tuple(tag.split('=', 1)) if '=' in tag
+                              else (tag, '') for tag in parts[1:]])
+                value = series.Series(parts[0], tags, series_id)
+            self.series[series_id] = value
+            keys.append(value)
+        return keys
+
+    @staticmethod
+    def numbers(reader, count):
+        """Return the next column of numbers
+
+        :param Reader reader: The snapshot reader
+        :param int count: The number of values
+        :rtype: list
+
+        """
+        flags = reader.array('b', count)
+        values = reader.array('d', count)
+        return [None if flag == NONE else int(value) if flag == INT
+                else value for flag, value in zip(flags, values)]
+
+    @staticmethod
+    def sets(reader, count):
+        """Return the next column of sets
+
+        :param Reader reader: The snapshot reader
+        :param int count: The number of sets
+        :rtype: list
+
+        """
+        sizes = reader.array('I', count)
+        members = reader.strings(sum(sizes))
+        counts = reader.array('d', len(members))
+        values, offset = list(), 0
+        for size in sizes:
+            values.append(dict(zip(members[offset:offset + size],
+                                   [int(value) for value in
+                                    counts[offset:offset + size]])))
+            offset += size
+        return values
+
+    @staticmethod
+    def timers(reader, count):
+        """Return the next column of timers
+
+        :param Reader reader: The snapshot reader
+        :param int count: The number of timers
+        :rtype: list
+
+        """
+        sizes = reader.array('I', count)
+        weights = reader.array('d', count)
+        timings = reader.array('d', sum(sizes))
+        values, offset = list(), 0
+        for size, weight in zip(sizes, weights):
+            values.append(samples.Samples(timings[offset:offset + size],
+                                          weight))
+            offset += size
+        return values
+
+
+def run(backend, connection, inherited):
+    """The main loop of a worker process, delivering each snapshot it is
+    sent to the backend and replying with the sequence number, the delivery
+    duration and the error if delivery failed.
+
+    :param cardiff.backends.base.Backend backend: The backend to deliver to
+    :param multiprocessing.Connection connection: The worker end of the pipe
+    :param list inherited: Connections of the spawner to close
+
+    """
+    for value in inherited:
+        value.close()
+    for signum in [signal.SIGHUP, signal.SIGINT, signal.SIGUSR1,
+                   signal.SIGUSR2]:
+        signal.signal(signum, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    decoder = Decoder()
+    LOGGER.info('Worker for %s started', backend.name)
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, IOError):
+            break
+        if message is None:
+            break
+        sequence, path = message
+        start_time, error = time.time(), None
+        try:
+            with open(path, 'rb') as handle:
+                data = mmap.mmap(handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            try:
+                stats = decoder.decode(data)
+            finally:
+                data.close()
+            backend.deliver(*stats)
+        except Exception as error:
+            LOGGER.exception('Error delivering metrics to %s', backend.name)
+            error = repr(error)
+        connection.send((sequence, (time.time() - start_time) * 1000, error))
+    LOGGER.info('Worker for %s stopped', backend.name)
+
+
+def spawn(backends, connection, parent):
+    """The main loop of the spawner process, starting a worker process for
+    each backend name it is sent and replying with the worker pid followed
+    by the file descriptor of the controller end of the worker pipe.
+
+    :param dict backends: The backends by name
+    :param multiprocessing.Connection connection: The spawner end of the pipe
+    :param multiprocessing.Connection parent: The controller end of the pipe
+
+    """
+    parent.close()
+    for signum in [signal.SIGHUP, signal.SIGINT, signal.SIGUSR1,
+                   signal.SIGUSR2]:
+        signal.signal(signum, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        reap()
+        try:
+            if not connection.poll(REAP_INTERVAL):
+                continue
+            name = connection.recv()
+        except (EOFError, IOError):
+            break
+        if name is None:
+            break
+        worker, child = multiprocessing.Pipe()
+        try:
+            pid = os.fork()
+        except OSError as error:
+            LOGGER.error('Could not start the worker for %s: %s', name, error)
+            worker.close()
+            child.close()
+            connection.send(None)
+            continue
+        if not pid:
+            multiprocessing.current_process().name = 'cardiff-%s' % name
+            status = 0
+            try:
+                run(backends[name], child, [worker, connection])
+            except Exception:
+                LOGGER.exception('Worker for %s failed', name)
+                status = 1
+            finally:
+                os._exit(status)
+        child.close()
+        connection.send(pid)
+        reduction.send_handle(connection, worker.fileno(), None)
+        worker.close()
+
+
+def reap():
+    """Wait for the worker processes of the spawner that have exited"""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as error:
+            if error.errno != errno.ECHILD:
+                raise
+            return
+        if not pid:
+            return
+        LOGGER.info('Worker pid %i exited with status %i', pid,
+                    os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                    else -os.WTERMSIG(status))
+
+
+class Spawner(object):
+    """A process forked when the controller starts, before it opens any
+    sockets or starts any threads, that forks the worker processes on its
+    behalf. Workers, including those restarted after exiting, do not inherit
+    the listening sockets, the IOLoop or locks held by other threads of the
+    controller.
+
+    """
+    def __init__(self, backends):
+        """Create the spawner
+
+        :param list backends: The backends to run in worker processes
+
+        """
+        self.backends = dict([(backend.name, backend)
+                              for backend in backends])
+        self.connection = None
+        self.process = None
+
+    @property
+    def names(self):
+        """Return the names of the backends workers are spawned for
+
+        :rtype: list
+
+        """
+        return list(self.backends)
+
+    def spawn(self, name):
+        """Start a worker process for the backend, returning its pid and the
+        controller end of its pipe, or None if it could not be started.
+
+        :param str name: The backend name
+        :rtype: tuple(int, multiprocessing.Connection) or None
+
+        """
+        try:
+            self.connection.send(name)
+            pid = self.connection.recv()
+            if pid is None:
+                return None
+            fd = reduction.recv_handle(self.connection)
+        except (EOFError, IOError, OSError) as error:
+            LOGGER.error('Could not reach the worker spawner: %s', error)
+            return None
+        return pid, _multiprocessing.Connection(fd)
+
+    def start(self):
+        """Start the spawner process"""
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=spawn, args=(self.backends, child, parent),
+            name='cardiff-spawner')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.connection = parent
+
+    def stop(self):
+        """Stop the spawner process"""
+        try:
+            self.connection.send(None)
+        except IOError:
+            pass
+        self.process.join(REAP_INTERVAL)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+class Worker(object):
+    """A backend delivering in its own process"""
+    def __init__(self, name):
+        self.name = name
+        self.connection = None
+        self.pid = None
+        self.pending = set()
+        self.exits = 0
+        self.last_exit = 0
+        self.restarts = 0
+        self.skipped = 0
+
+    @property
+    def alive(self):
+        """Return True if the worker process is running
+
+        :rtype: bool
+
+        """
+        return self.connection is not None
+
+    def join(self, timeout):
+        """Wait for the worker process to exit, discarding any replies,
+        returning True if it exited within the timeout.
+
+        :param float timeout: The seconds to wait
+        :rtype: bool
+
+        """
+        deadline = time.time() + timeout
+        try:
+            while self.connection.poll(max(0, deadline - time.time())):
+                self.connection.recv()
+        except (EOFError, IOError):
+            return True
+        return False
+
+    def terminate(self):
+        """Terminate the worker process"""
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                LOGGER.error('Could not terminate the worker for %s: %s',
+                             self.name, error)
+
+
+class Workers(object):
+    """Run each backend in its own process so that formatting and sending
+    does not compete with ingest for the GIL. Each snapshot is encoded once
+    into a columnar file in shared memory that the workers map read-only,
+    and is removed once every worker has replied. Workers that exit are
+    restarted after a delay, and a worker still busy with max_pending
+    snapshots is skipped for the flush.
+
+    """
+    def __init__(self, spawner, ioloop, on_delivered, directory=None,
+                 max_pending=MAX_PENDING, restart_delay=RESTART_DELAY):
+        """Create the workers
+
+        :param Spawner spawner: The started spawner to fork workers with
+        :param tornado.ioloop.IOLoop ioloop: The IOLoop to watch pipes on
+        :param method on_delivered: Invoked with the backend name, delivery
+            duration and error when a worker replies
+        :param str directory: The directory to write snapshots to
+        :param int max_pending: The snapshots a worker may have queued
+        :param int restart_delay: Seconds to wait before restarting
+
+        """
+        self.spawner = spawner
+        self.ioloop = ioloop
+        self.on_delivered = on_delivered
+        if directory is None:
+            directory = DIRECTORY if os.path.isdir(DIRECTORY) \
+                else tempfile.gettempdir()
+        self.directory = directory
+        self.max_pending = max_pending
+        self.restart_delay = restart_delay
+        self.sequence = 0
+        self.files = dict()
+        self.workers = dict([(name, Worker(name)) for name in spawner.names])
+
+    def deliver(self, stats):
+        """Write the snapshot and send it to each worker
+
+        :param list stats: The snapshot values
+
+        """
+        self.sequence += 1
+        path = write(self.directory, self.sequence, stats)
+        names = set()
+        for name, worker in self.workers.iteritems():
+            if not worker.alive:
+                continue
+            if len(worker.pending) >= self.max_pending:
+                LOGGER.warning('Skipping delivery to %s, %i snapshots are '
+                               'pending', name, len(worker.pending))
+                worker.skipped += 1
+                continue
+            try:
+                worker.connection.send((self.sequence, path))
+            except IOError as error:
+                LOGGER.error('Could not send to the %s worker: %s', name,
+                             error)
+                continue
+            worker.pending.add(self.sequence)
+            names.add(name)
+        self.files[self.sequence] = path, names
+        if not names:
+            self.release(None, self.sequence)
+
+    def on_events(self, name, fd_unused, events_unused):
+        """Read the replies of a worker, restarting it if it has exited
+
+        :param str name: The backend name
+
+        """
+        worker = self.workers[name]
+        try:
+            while worker.connection.poll():
+                sequence, duration, error = worker.connection.recv()
+                self.on_delivered(name, duration, error)
+                self.release(name, sequence)
+        except (EOFError, IOError):
+            self.on_exit(name)
+
+    def on_exit(self, name):
+        """Clean up after a worker that exited and schedule its restart
+
+        :param str name: The backend name
+
+        """
+        worker = self.workers[name]
+        self.ioloop.remove_handler(worker.connection.fileno())
+        worker.connection.close()
+        worker.connection = None
+        LOGGER.error('Worker for %s (pid %i) exited, restarting in %i '
+                     'seconds', name, worker.pid, self.restart_delay)
+        for sequence in list(worker.pending):
+            self.release(name, sequence)
+        worker.exits += 1
+        worker.last_exit = int(time.time())
+        worker.restarts += 1
+        self.restart(name)
+
+    def release(self, name, sequence):
+        """Mark a snapshot as done for a worker, removing the file once all
+        of the workers are done with it.
+
+        :param str name: The backend name or None
+        :param int sequence: The snapshot sequence number
+
+        """
+        if name:
+            self.workers[name].pending.discard(sequence)
+        path, names = self.files.get(sequence, (None, set()))
+        names.discard(name)
+        if path and not names:
+            del self.files[sequence]
+            try:
+                os.unlink(path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    LOGGER.error('Could not remove %s: %s', path, error)
+
+    def restart(self, name):
+        """Start the worker again after the restart delay
+
+        :param str name: The backend name
+
+        """
+        self.ioloop.add_timeout(time.time() + self.restart_delay,
+                                functools.partial(self.start_worker, name))
+
+    def start(self):
+        """Start all of the workers"""
+        for name in self.workers:
+            self.start_worker(name)
+
+    def start_worker(self, name):
+        """Have the spawner start a worker and watch its pipe for replies
+
+        :param str name: The backend name
+
+        """
+        worker = self.workers[name]
+        result = self.spawner.spawn(name)
+        if result is None:
+            LOGGER.error('Could not start the worker for %s, retrying in %i '
+                         'seconds', name, self.restart_delay)
+            self.restart(name)
+            return
+        worker.pid, worker.connection = result
+        self.ioloop.add_handler(worker.connection.fileno(),
+                                functools.partial(self.on_events, name),
+                                self.ioloop.READ | self.ioloop.ERROR)
+        LOGGER.info('Started the worker for %s as pid %i', name, worker.pid)
+
+    def stop(self):
+        """Stop the workers and remove the snapshots they were sent"""
+        for worker in self.workers.itervalues():
+            if not worker.alive:
+                continue
+            self.ioloop.remove_handler(worker.connection.fileno())
+            try:
+                worker.connection.send(None)
+            except IOError:
+                pass
+            if not worker.join(self.restart_delay):
+                worker.terminate()
+            worker.connection.close()
+            worker.connection = None
+        self.spawner.stop()
+        for sequence in list(self.files):
+            self.files[sequence][1].clear()
+            self.release(None, sequence)
+
+    def usage(self):
+        """Return the pending snapshots, restarts and skipped deliveries of
+        each worker since the last call.
+
+        :rtype: dict
+
+        """
+        values = dict()
+        for name, worker in self.workers.iteritems():
+            values[name] = (len(worker.pending), worker.restarts,
+                            worker.skipped)
+            worker.restarts, worker.skipped = 0, 0
+        return values
@@ -0,0 +1,115 @@
+"""
+replay.py
+
+Replay datagrams captured by the statsd server, oldest rotated capture
+first. Datagrams are sent to a cardiff instance at the captured rate, a
+multiple of it or as fast as possible, or fed directly to
+Cardiff.process_data in this process, taking a snapshot for each flush
+interval of capture time, for deterministic profiling runs.
+
+"""
+import argparse
+import cProfile
+import itertools
+import socket
+import time
+
+from cardiff import controller
+from cardiff import recording
+
+
+def records(path, single):
+    """Iterate over the records of the capture and, unless single is set,
+    the files it was rotated to.
+
+    :param str path: The capture file
+    :param bool single: Only read the capture file
+    :rtype: iter
+
+    """
+    paths = [path] if single else recording.files(path)
+    return itertools.chain(*[recording.read(value) for value in paths])
+
+
+def in_process(captured, flush_interval):
+    """Feed the datagrams to a controller, taking a snapshot whenever a
+    flush interval of capture time has passed. Returns the number of
+    datagrams and snapshots.
+
+    :param iter captured: The (receive timestamp, datagram) records
+    :param int flush_interval: The flush interval in seconds
+    :rtype: tuple(int, int)
+
+    """
+    cardiff = controller.standalone(flush_interval)
+    datagrams, snapshots, flushed = 0, 0, None
+    for timestamp, data in captured:
+        if flushed is None:
+            flushed = timestamp
+        elif timestamp - flushed >= flush_interval:
+            cardiff.snapshot()
+            flushed, snapshots = timestamp, snapshots + 1
+        cardiff.process_data(data)
+        datagrams += 1
+    cardiff.snapshot()
+    return datagrams, snapshots + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('path', help='The capture file')
+    parser.add_argument('--single', action='store_true',
+                        help='Do not replay the rotated capture files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=controller.STATSD_PORT)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='The multiple of the captured rate to send at, '
+                             '0 to send as fast as possible')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Feed process_data instead of sending')
+    parser.add_argument('--flush-interval', type=int,
+                        default=controller.FLUSH_INTERVAL,
+                        help='Seconds of capture time between snapshots '
+                             'when replaying in process')
+    parser.add_argument('--profile',
+                        help='Write the pstats of the replay to this file')
+    args = parser.parse_args()
+
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    errors = list()
+    start_time = time.time()
+    if args.in_process:
+        datagrams, snapshots = in_process(records(args.path, args.single),
+                                          args.flush_interval)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((args.host, args.port))
+
+        def send(data):
+            try:
+                sock.send(data)
+            except socket.error as error:
+                errors.append(error)
+
+        datagrams = recording.replay(records(args.path, args.single), send,
+                                     args.speed)
+        sock.close()
+    elapsed = time.time() - start_time
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+
+    print 'Datagrams replayed: %i' % datagrams
+    if args.in_process:
+        print 'Snapshots taken:    %i' % snapshots
+    else:
+        print 'Send errors:        %i' % len(errors)
+    print 'Elapsed:            %.3f seconds' % elapsed
+    print 'Rate:               %.1f datagrams/sec' % (datagrams / elapsed
+                                                      if elapsed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,317 @@
 """
 send-stats.py
 
+A rate controlled statsd load generator. Several sender processes share the
+target packet rate, choosing keys from a uniform or Zipf distribution over a
+fixed key cardinality and packing several lines into each datagram. With
+--verify, the counter totals sent are tracked and compared with the totals
+that cardiff delivered to the capture backend, reporting the end to end loss
+and accuracy.
+
 """
-import logging
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
 import random
 import socket
+import sys
 import time
-LOGGER = logging.getLogger(__name__)
 
+DISTRIBUTIONS = ['uniform', 'zipf']
+VALUES = ['constant', 'uniform', 'lognormal']
+MAX_SIZE = 1432
+
+
+def parse_mix(value):
+    """Return the weight of each metric type from a string such as
+    c=4,g=2,s=1,ms=3
+
+    :param str value: The metric type weights
+    :rtype: dict
+
+    """
+    mix = dict()
+    for part in value.split(','):
+        metric_type, weight = part.split('=')
+        if metric_type not in ['c', 'g', 's', 'ms']:
+            raise argparse.ArgumentTypeError('Unknown metric type %s' %
+                                             metric_type)
+        mix[metric_type] = int(weight)
+    return mix
+
+
+class Sender(object):
+    """Send packets at a fixed rate from a single process"""
+    def __init__(self, args, index):
+        self.args = args
+        self.rng = random.Random(args.seed + index)
+        self.rate = args.rate / float(args.processes)
+        self.types = list()
+        for metric_type, weight in sorted(args.mix.items()):
+            self.types += [metric_type] * weight
+        self.weights = None
+        if args.distribution == 'zipf':
+            total, self.weights = 0.0, list()
+            for rank in xrange(1, args.keys + 1):
+                total += 1 / rank ** args.skew
+                self.weights.append(total)
+        self.pending = None
+        self.totals = dict()
+
+    def count(self, data):
+        """Add the counter values in a packet that was sent to the totals
+
+        :param str data: The packet
+
+        """
+        for line in data.split('\n'):
+            if line.endswith('|c'):
+                key, value = line[:-2].split(':')
+                self.totals[key] = self.totals.get(key, 0) + int(value)
+
+    def key(self, metric_type):
+        """Return a key for the metric type from the key distribution
+
+        :param str metric_type: The metric type
+        :rtype: str
+
+        """
+        if self.weights:
+            index = bisect.bisect(self.weights,
+                                  self.rng.random() * self.weights[-1])
+        else:
+            index = self.rng.randrange(self.args.keys)
+        if self.args.verify and metric_type == 'c':
+            return '%s.verify.%s.key_%i' % (self.args.prefix,
+                                            self.args.run_id, index)
+        return '%s.%s.key_%i' % (self.args.prefix, metric_type, index)
+
+    def line(self):
+        """Return a line with a random metric type, key and value
+
+        :rtype: str
+
+        """
+        metric_type = self.rng.choice(self.types)
+        key = self.key(metric_type)
+        values = self.args.values
+        if values == 'constant':
+            value = 1
+        elif values == 'uniform':
+            value = self.rng.randint(1, 1000)
+        else:
+            value = max(1, int(self.rng.lognormvariate(3, 1)))
+        if metric_type == 'ms':
+            value = '%.3f' % (value * self.rng.random())
+        return '%s:%s|%s' % (key, value, metric_type)
+
+    def packet(self):
+        """Return a packet of up to packing lines within the maximum size,
+        and the number of lines in it.
+
+        :rtype: tuple(str, int)
+
+        """
+        line, self.pending = self.pending or self.line(), None
+        lines, size = [line], len(line)
+        while len(lines) < self.args.packing:
+            line = self.line()
+            if size + len(line) + 1 > self.args.max_size:
+                self.pending = line
+                break
+            lines.append(line)
+            size += len(line) + 1
+        return '\n'.join(lines), len(lines)
+
+    def run(self):
+        """Send packets at the target rate until the duration has elapsed,
+        returning the stats of the run.
+
+        :rtype: dict
+
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((self.args.host, self.args.port))
+        packets, lines, size, errors = 0, 0, 0, 0
+        start_time = time.time()
+        end_time = start_time + self.args.duration
+        now = start_time
+        while now < end_time:
+            # Sleep when ahead of the schedule for the target rate
+            delay = start_time + packets / self.rate - now
+            if delay > 0.001:
+                time.sleep(delay)
+            data, count = self.packet()
+            try:
+                sock.send(data)
+            except socket.error:
+                errors += 1
+            else:
+                lines += count
+                size += len(data)
+                if self.args.verify:
+                    self.count(data)
+            packets += 1
+            now = time.time()
+        sock.close()
+        return {'packets': packets - errors,
+                'lines': lines,
+                'bytes': size,
+                'errors': errors,
+                'elapsed': now - start_time,
+                'totals': self.totals}
+
+
+def send(args, index, queue):
+    """Run a sender in a child process, putting its stats on the queue
+
+    :param argparse.Namespace args: The command line arguments
+    :param int index: The sender number
+    :param multiprocessing.Queue queue: The queue to put the stats on
+
+    """
+    queue.put(Sender(args, index).run())
+
+
+def received(path, run_id, start_time):
+    """Return the counter totals for the run, and the packets received and
+    dropped by the kernel in the flushes captured since the start time.
+
+    :param str path: The capture backend file
+    :param str run_id: The run id embedded in the verify keys
+    :param float start_time: The time the run started
+    :rtype: tuple(dict, int, int)
+
+    """
+    totals, packets, drops = dict(), 0, 0
+    marker = '.verify.%s.' % run_id
+    try:
+        handle = open(path)
+    except IOError:
+        return totals, packets, drops
+    with handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['timestamp'] < int(start_time):
+                continue
+            for key, value in record['counters'].iteritems():
+                if marker in key:
+                    totals[key] = totals.get(key, 0) + value
+            for key, value in record['internal']['counters'].iteritems():
+                if key.endswith('.packets_received'):
+                    packets += value
+                elif key.endswith('.drops'):
+                    drops += value
+    return totals, packets, drops
+
+
+def verify(args, sent, start_time):
+    """Wait for cardiff to deliver the counters sent and report the loss
+    and accuracy, returning True if every counter matched.
+
+    :param argparse.Namespace args: The command line arguments
+    :param dict sent: The counter totals that were sent
+    :param float start_time: The time the run started
+    :rtype: bool
+
+    """
+    expected = sum(sent.values())
+    deadline = time.time() + args.wait
+    while True:
+        totals, packets, drops = received(args.capture, args.run_id, start_time)
+        total = sum(totals.values())
+        if total >= expected or time.time() > deadline:
+            break
+        time.sleep(1)
+
+    missing = [key for key in sent if sent[key] and key not in totals]
+    mismatched = [key for key in sent
+                  if key in totals and round(totals[key]) != sent[key]]
+    error = max([abs(totals.get(key, 0) - sent[key]) for key in sent] or [0])
+    print 'Counter total sent:     %i' % expected
+    print 'Counter total received: %i' % total
+    print 'Loss:                   %.4f%%' % (
+        100.0 * (expected - total) / expected if expected else 0)
+    print 'Keys sent:              %i' % len(sent)
+    print 'Keys missing:           %i' % len(missing)
+    print 'Keys mismatched:        %i' % len(mismatched)
+    print 'Largest key error:      %s' % error
+    print 'Packets received:       %i' % packets
+    print 'Kernel drops:           %i' % drops
+    return not missing and not mismatched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8125)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='Target packets per second across all senders')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='The number of sender processes')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to send for')
+    parser.add_argument('--keys', type=int, default=1000,
+                        help='The number of keys per metric type')
+    parser.add_argument('--mix', type=parse_mix, default='c=4,g=2,s=1,ms=3',
+                        help='The weight of each metric type')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        default='uniform', help='The key distribution')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='The exponent of the Zipf key distribution')
+    parser.add_argument('--values', choices=VALUES, default='uniform',
+                        help='The value distribution')
+    parser.add_argument('--packing', type=int, default=1,
+                        help='The maximum number of lines per packet')
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE,
+                        help='The maximum packet size in bytes')
+    parser.add_argument('--prefix', default='loadgen')
+    parser.add_argument('--seed', type=int, default=8125)
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare the counter totals sent with the '
+                             'totals captured by the capture backend')
+    parser.add_argument('--capture', default='/tmp/cardiff-capture.json',
+                        help='The capture backend file to verify against')
+    parser.add_argument('--wait', type=float, default=60,
+                        help='Seconds to wait for the counters to be flushed')
+    args = parser.parse_args()
+    args.run_id = '%x_%i' % (int(time.time()), os.getpid())
 
-while True:
-    print 'Sending'
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('127.0.0.1', 8125))
+    queue = multiprocessing.Queue()
+    start_time = time.time()
+    senders = [multiprocessing.Process(target=send, args=(args, index, queue))
+               for index in xrange(args.processes)]
+    for sender in senders:
+        sender.start()
+    results = [queue.get() for _sender in senders]
+    for sender in senders:
+        sender.join()
 
-    for iteration in range(random.randint(0, 200)):
-        s.send('cardiff.test_counter_%i:%i|c' % (iteration, random.randint(0, 25)))
+    packets = sum(result['packets'] for result in results)
+    elapsed = max(result['elapsed'] for result in results)
+    print 'Packets sent:           %i' % packets
+    print 'Lines sent:             %i' % sum(result['lines']
+                                             for result in results)
+    print 'Bytes sent:             %i' % sum(result['bytes']
+                                             for result in results)
+    print 'Send errors:            %i' % sum(result['errors']
+                                             for result in results)
+    print 'Achieved rate:          %.1f packets/sec (target %.1f)' % (
+        packets / elapsed, args.rate)
 
-    for iteration in range(100):
-        s.send('cardiff.test_gauge_%i:%i|g' % (iteration, random.randint(0, 100)))
+    if args.verify:
+        sent = dict()
+        for result in results:
+            for key, value in result['totals'].iteritems():
+                sent[key] = sent.get(key, 0) + value
+        if not verify(args, sent, start_time):
+            sys.exit(1)
 
-    for iteration in range(100):
-        for timing in range(random.randint(0, 100)):
-            s.send('cardiff.test_timing_%i:%0.2f|ms' % (iteration,
-                                                        float(float(random.randint(0, 10000)) / 1000)))
 
-    s.close()
-    print 'Sleeping'
-    time.sleep(random.randint(0, 15))
+if __name__ == '__main__':
+    main()
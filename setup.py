@@ -4,7 +4,6 @@ import platform
 scripts = ['cardiff=cardiff.controller:main']
 
 requirements = ['helper',
-                'flatdict',
                 'pyyaml',
                 'tornado']
 
@@ -0,0 +1,203 @@
+"""
+Tests for the AMQP consumer, run against a broker stand-in that speaks enough
+AMQP 0-9-1 to consume from a queue.
+
+"""
+import mock
+import socket
+import threading
+import time
+import unittest
+
+from pamqp import body
+from pamqp import frame
+from pamqp import header
+from pamqp import specification
+from tornado import ioloop
+
+from cardiff import consumer
+
+TIMESTAMP = 1400000000
+
+
+class Broker(threading.Thread):
+    """Deliver the queued bodies to a consumer, respecting its prefetch
+    count, recording the acks and rejects.
+
+    """
+    def __init__(self, bodies):
+        super(Broker, self).__init__()
+        self.daemon = True
+        self.bodies = list(bodies)
+        self.acks = list()
+        self.acked = set()
+        self.rejected = set()
+        self.cancelled = threading.Event()
+        self.consuming = threading.Event()
+        self.delivery_tag = 0
+        self.prefetch = 0
+        self.consumer_tag = None
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    @property
+    def unacked(self):
+        return self.delivery_tag - len(self.acked) - len(self.rejected)
+
+    def deliver(self, connection):
+        while self.bodies and self.consumer_tag and \
+                (not self.prefetch or self.unacked < self.prefetch):
+            value = self.bodies.pop(0)
+            self.delivery_tag += 1
+            properties = specification.Basic.Properties(
+                timestamp=time.gmtime(TIMESTAMP))
+            self.write(connection, specification.Basic.Deliver(
+                self.consumer_tag, self.delivery_tag, False, '', 'cardiff'))
+            self.write(connection, header.ContentHeader(0, len(value),
+                                                        properties))
+            self.write(connection, body.ContentBody(value))
+
+    def handle(self, connection, value):
+        if isinstance(value, specification.Connection.StartOk):
+            self.write(connection, specification.Connection.Tune(
+                0, specification.FRAME_MAX_SIZE, 0), 0)
+        elif isinstance(value, specification.Connection.Open):
+            self.write(connection, specification.Connection.OpenOk(), 0)
+        elif isinstance(value, specification.Channel.Open):
+            self.write(connection, specification.Channel.OpenOk())
+        elif isinstance(value, specification.Basic.Qos):
+            self.prefetch = value.prefetch_count
+            self.write(connection, specification.Basic.QosOk())
+        elif isinstance(value, specification.Basic.Consume):
+            self.consumer_tag = value.consumer_tag
+            self.write(connection, specification.Basic.ConsumeOk(
+                value.consumer_tag))
+            self.consuming.set()
+        elif isinstance(value, specification.Basic.Ack):
+            self.acks.append(value)
+            tags = [value.delivery_tag]
+            if value.multiple:
+                tags = range(1, value.delivery_tag + 1)
+            self.acked.update([tag for tag in tags
+                               if tag not in self.rejected])
+        elif isinstance(value, specification.Basic.Reject):
+            self.rejected.add(value.delivery_tag)
+        elif isinstance(value, specification.Basic.Cancel):
+            self.consumer_tag = None
+            self.write(connection, specification.Basic.CancelOk(
+                value.consumer_tag))
+            self.cancelled.set()
+        elif isinstance(value, specification.Channel.Close):
+            self.write(connection, specification.Channel.CloseOk())
+        elif isinstance(value, specification.Connection.Close):
+            self.write(connection, specification.Connection.CloseOk(), 0)
+            return False
+        self.deliver(connection)
+        return True
+
+    def run(self):
+        connection = self.server.accept()[0]
+        buffer = connection.recv(8)
+        self.write(connection, specification.Connection.Start(), 0)
+        running = True
+        while running:
+            data = connection.recv(65536)
+            if not data:
+                break
+            buffer += data
+            while running and buffer:
+                try:
+                    consumed, channel, value = frame.unmarshal(buffer)
+                except Exception:
+                    break
+                buffer = buffer[consumed:]
+                running = self.handle(connection, value)
+        connection.close()
+        self.server.close()
+
+    @staticmethod
+    def write(connection, value, channel=1):
+        connection.sendall(frame.marshal(value, channel))
+
+
+class ConsumerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = ioloop.IOLoop()
+        self.received = list()
+
+    def tearDown(self):
+        self.ioloop.close()
+
+    def consume(self, bodies, prefetch=10, batch_size=5,
+                callback=None):
+        """Consume the bodies until each is acked or rejected"""
+        self.broker = Broker(bodies)
+        self.broker.start()
+        self.consumer = consumer.AMQPConsumer(
+            {'host': '127.0.0.1', 'port': self.broker.port,
+             'prefetch': prefetch, 'batch_size': batch_size},
+            self.ioloop, callback or self.on_message)
+        self.consumer.start()
+        total = len(bodies)
+
+        def check():
+            if len(self.broker.acked) + len(self.broker.rejected) == total:
+                self.consumer.stop()
+                self.ioloop.stop()
+        checker = ioloop.PeriodicCallback(check, 10, self.ioloop)
+        checker.start()
+        self.ioloop.add_timeout(time.time() + 5, self.ioloop.stop)
+        self.ioloop.start()
+        checker.stop()
+        self.consumer.thread.join(5)
+        self.broker.join(5)
+
+    def on_message(self, value, timestamp):
+        self.received.append((value, timestamp))
+
+    def test_messages_are_acked_in_batches(self):
+        bodies = ['foo:%i|c' % index for index in range(50)]
+        self.consume(bodies)
+        self.assertEqual([value for value, timestamp in self.received],
+                         bodies)
+        self.assertEqual(self.broker.acked, set(range(1, 51)))
+        self.assertLess(len(self.broker.acks), len(bodies))
+        self.assertTrue(all(ack.multiple for ack in self.broker.acks))
+
+    def test_failed_messages_are_rejected(self):
+        def callback(value, timestamp):
+            if value == 'bad':
+                raise ValueError(value)
+            self.on_message(value, timestamp)
+        with mock.patch.object(consumer, 'LOGGER') as log:
+            self.consume(['foo:1|c', 'bad', 'foo:2|c'], callback=callback)
+        self.assertTrue(log.exception.called)
+        self.assertEqual(self.broker.rejected, set([2]))
+        self.assertEqual(self.broker.acked, set([1, 3]))
+        self.assertEqual(len(self.received), 2)
+
+    def test_timestamps_are_utc(self):
+        self.consume(['foo:1|c'])
+        self.assertEqual(self.received, [('foo:1|c', TIMESTAMP)])
+
+    def test_stop_interrupts_an_idle_consumer(self):
+        self.broker = Broker([])
+        self.broker.start()
+        self.consumer = consumer.AMQPConsumer(
+            {'host': '127.0.0.1', 'port': self.broker.port},
+            self.ioloop, self.on_message)
+        self.consumer.start()
+        self.assertTrue(self.broker.consuming.wait(5))
+        # Wait for the consumer to block reading the next message
+        deadline = time.time() + 5
+        while self.consumer.queue is None and time.time() < deadline:
+            time.sleep(0.01)
+        start_time = time.time()
+        self.consumer.stop()
+        self.consumer.thread.join(5)
+        self.assertFalse(self.consumer.thread.is_alive())
+        self.assertTrue(self.broker.cancelled.is_set())
+        self.assertLess(time.time() - start_time, 5)
@@ -0,0 +1,217 @@
+"""
+Tests for parsing and aggregating statsd lines in the controller
+
+"""
+import mock
+import random
+import unittest
+
+from cardiff import controller
+from cardiff import series
+from cardiff import shedding
+
+
+class ProcessLineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cardiff = controller.standalone(10)
+
+    def snapshot(self):
+        """Return the counters, gauges, sets and timers by series name"""
+        return [dict([(str(key), value) for key, value in values.iteritems()])
+                for values in self.cardiff.snapshot()[1:5]]
+
+    def process(self, *lines):
+        with mock.patch.object(controller, 'LOGGER'):
+            return [self.cardiff.process_line(line) for line in lines]
+
+    def test_counter(self):
+        self.process('hits:1|c', 'hits:2|c', 'hits|c')
+        counters = self.snapshot()[0]
+        self.assertEqual(counters, {'hits': 4})
+        self.assertIsInstance(counters['hits'], int)
+
+    def test_sampled_counter(self):
+        self.process('hits:1|c|@0.5')
+        self.assertEqual(self.snapshot()[0], {'hits': 2.0})
+
+    def test_gauge(self):
+        self.process('load:5|g', 'load:3|g', 'queue:10|g', 'queue:-4|g')
+        self.assertEqual(self.snapshot()[1], {'load': 3, 'queue': 6})
+
+    def test_set(self):
+        self.process('users:alice|s', 'users:bob|s', 'users:alice|s')
+        self.assertEqual(self.snapshot()[2], {'users': {'alice': 2,
+                                                        'bob': 1}})
+
+    def test_timer(self):
+        self.process('latency:10|ms', 'latency:20|ms|@0.1')
+        timer = self.snapshot()[3]['latency']
+        self.assertEqual(list(timer), [10.0, 20.0])
+        self.assertAlmostEqual(timer.weight, 11)
+
+    def test_tags(self):
+        self.process('hits:1|c|#role:web,env:prod,canary',
+                     'hits:1|c|#env:prod,canary,role:web')
+        counters = self.cardiff.snapshot()[1]
+        self.assertEqual(counters.values(), [2])
+        key = counters.keys()[0]
+        self.assertEqual(series.name(key), 'hits')
+        self.assertEqual(series.tags(key), (('canary', ''), ('env', 'prod'),
+                                            ('role', 'web')))
+
+    def test_tags_with_sample_rate(self):
+        self.process('hits:1|c|@0.5|#env:prod')
+        self.assertEqual(self.snapshot()[0], {'hits;env=prod': 2.0})
+
+    def test_bad_lines(self):
+        self.assertEqual(self.process('hits', 'hits:1|x', 'hits:1|c|@0',
+                                      'hits:one|c'),
+                         [False, False, False, False])
+        self.assertEqual(self.cardiff.bad_lines.value, 4)
+        self.assertEqual(self.snapshot()[0], {})
+
+
+class SheddingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cardiff = controller.standalone(10)
+        self.cardiff.shedder = shedding.LoadShedder(mock.Mock(), dict())
+        self.cardiff.shedder.rate = 0.1
+        random.seed(1)
+
+    def snapshot(self):
+        return [dict([(str(key), value) for key, value in values.iteritems()])
+                for values in self.cardiff.snapshot()[1:5]]
+
+    def test_counters_are_sampled_and_scaled(self):
+        self.cardiff.process_data('\n'.join(['hits:1|c'] * 10000))
+        shed = self.cardiff.lines_shed.value
+        counters = self.snapshot()[0]
+        self.assertEqual(counters['hits'], (10000 - shed) * 10)
+        self.assertIsInstance(counters['hits'], int)
+        self.assertAlmostEqual(counters['hits'], 10000, delta=1000)
+
+    def test_low_frequency_series_are_unbiased(self):
+        self.cardiff.process_data('\n'.join(['rare.%i:1|c' % (value % 5000)
+                                             for value in range(10000)]))
+        counters = self.snapshot()[0]
+        self.assertLess(len(counters), 5000)
+        self.assertTrue(all([value % 10 == 0 for value in counters.values()]))
+        self.assertAlmostEqual(sum(counters.values()), 10000, delta=1000)
+
+    def test_timers_are_weighted(self):
+        for value in range(1000):
+            self.cardiff.process_data('latency:%i|ms' % value)
+        shed = self.cardiff.lines_shed.value
+        timer = self.snapshot()[3]['latency']
+        self.assertEqual(len(timer), 1000 - shed)
+        self.assertEqual(timer.weight, len(timer) * 10)
+
+    def test_rate_is_rounded_to_a_step(self):
+        self.cardiff.shedder.rate = 0.3
+        self.assertEqual(self.cardiff.shedder.step, 3)
+        self.assertAlmostEqual(self.cardiff.shedder.reset()[0], 1 / 3.0)
+
+    def test_gauges_and_sets_are_not_sampled(self):
+        self.cardiff.process_data('\n'.join(['queue:+1|g'] * 20 +
+                                            ['users:%i|s' % value
+                                             for value in range(20)]))
+        self.assertEqual(self.cardiff.lines_shed.value, 0)
+        counters, gauges, sets, timers = self.snapshot()
+        self.assertEqual(gauges, {'queue': 20})
+        self.assertEqual(len(sets['users']), 20)
+
+    def test_not_shedding(self):
+        self.cardiff.shedder.rate = 1.0
+        self.cardiff.process_data('hits:1|c\nhits:1|c')
+        counters = self.snapshot()[0]
+        self.assertEqual(counters, {'hits': 2})
+        self.assertIsInstance(counters['hits'], int)
+
+
+class RulesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cardiff = controller.standalone(10, {'rules': [
+            {'name': 'disabled', 'enabled': False, 'prefix': 'api.',
+             'action': 'deny'},
+            {'name': 'drop_debug', 'prefix': 'debug.', 'action': 'deny'},
+            {'name': 'repeated', 'regex': r'^(\w+)\.\1$', 'action': 'rewrite',
+             'replace': r'\1'},
+            {'name': 'named', 'regex': r'^legacy\.(?P<app>\w+)\.count$',
+             'action': 'rewrite', 'replace': r'app.\g<app>.count'},
+            {'name': 'debug_glob', 'glob': 'debug.*', 'action': 'rewrite',
+             'replace': 'never'},
+            {'name': 'glob', 'glob': 'web.*.hits', 'action': 'rewrite',
+             'replace': r'web.all.\1'}]})
+
+    def process(self, *lines):
+        with mock.patch.object(controller, 'LOGGER'):
+            for line in lines:
+                self.cardiff.process_line(line)
+        return dict([(str(key), value) for key, value
+                     in self.cardiff.snapshot()[1].iteritems()])
+
+    def test_deny(self):
+        self.assertEqual(self.process('debug.x:1|c', 'hits:1|c'),
+                         {'hits': 1})
+
+    def test_disabled_rules_are_skipped(self):
+        self.assertEqual(self.process('api.hits:1|c'), {'api.hits': 1})
+
+    def test_backreference(self):
+        self.assertEqual(self.process('echo.echo:1|c', 'echo.other:1|c'),
+                         {'echo': 1, 'echo.other': 1})
+
+    def test_named_group(self):
+        self.assertEqual(self.process('legacy.shop.count:2|c'),
+                         {'app.shop.count': 2})
+
+    def test_glob(self):
+        self.assertEqual(self.process('web.a.hits:1|c', 'web.b.hits:2|c'),
+                         {'web.all.a': 1, 'web.all.b': 2})
+
+    def test_first_rule_wins(self):
+        self.process('debug.x:1|c')
+        self.assertEqual(self.cardiff.rules.reset_hits(), {'drop_debug': 1})
+
+    def test_invalid_regex(self):
+        self.assertRaises(ValueError, controller.standalone, 10,
+                          {'rules': [{'regex': '(', 'action': 'deny'}]})
+
+
+class RollupsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cardiff = controller.standalone(10, {'rollups': [
+            {'name': 'api.all.requests', 'glob': 'api.*.requests'},
+            {'name': r'api.\1.latency', 'glob': 'api.*.*.latency',
+             'type': 'timers', 'function': 'merge', 'keep': False}]})
+
+    def process(self, *lines):
+        with mock.patch.object(controller, 'LOGGER'):
+            for line in lines:
+                self.cardiff.process_line(line)
+            stats = self.cardiff.snapshot()
+            self.cardiff.apply_rollups(stats)
+        return [dict([(str(key), value) for key, value in values.iteritems()])
+                for values in stats[1:5]]
+
+    def test_sum(self):
+        counters = self.process('api.a.requests:1|c', 'api.b.requests:2|c')[0]
+        self.assertEqual(counters, {'api.a.requests': 1, 'api.b.requests': 2,
+                                    'api.all.requests': 3})
+
+    def test_merge_without_keeping_the_raw_series(self):
+        timers = self.process('api.a.get.latency:10|ms',
+                              'api.a.put.latency:20|ms')[3]
+        self.assertEqual(timers.keys(), ['api.a.latency'])
+        self.assertEqual(sorted(timers['api.a.latency']), [10.0, 20.0])
+
+    def test_raw_series_are_not_overwritten(self):
+        with mock.patch('cardiff.rollups.LOGGER') as log:
+            counters = self.process('api.a.requests:1|c',
+                                    'api.all.requests:5|c')[0]
+        self.assertEqual(counters['api.all.requests'], 5)
+        self.assertTrue(log.warning.called)
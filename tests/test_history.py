@@ -0,0 +1,125 @@
+"""
+Tests for the in-memory flush history and its query API
+
+"""
+import json
+import mock
+import unittest
+
+from tornado import testing
+from tornado import web
+
+from cardiff import history
+from cardiff import samples
+from cardiff import servers
+
+TIERS = {'tiers': [{'retention': 60},
+                   {'resolution': 30, 'retention': 300}]}
+
+
+class HistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.history = history.History(TIERS, 10)
+
+    def record(self, timestamp, counters=None, gauges=None, sets=None,
+               timers=None):
+        self.history.record(timestamp, counters or {}, gauges or {},
+                            sets or {}, timers or {})
+
+    def test_flush_resolution(self):
+        for index in range(6):
+            self.record(1000 + index * 10, {'api.hits': index + 1})
+        self.assertEqual(self.history.query('counters.api.hits', 1000, 1050,
+                                            10),
+                         {'counters.api.hits': [[1000, 1.0], [1010, 2.0],
+                                                [1020, 3.0], [1030, 4.0],
+                                                [1040, 5.0], [1050, 6.0]]})
+
+    def test_coarser_tiers_combine_flushes(self):
+        for index in range(6):
+            self.record(1000 + index * 10, {'api.hits': index + 1},
+                        {'load': index},
+                        {'users': dict.fromkeys(range(5 - index), 1)})
+        self.assertEqual(self.history.query('counters.api.hits', 990, 1050,
+                                            30),
+                         {'counters.api.hits': [[990, 3.0], [1020, 12.0]]})
+        self.assertEqual(self.history.query('*.*', 990, 1050, 30),
+                         {'gauges.load': [[990, 1.0], [1020, 4.0]],
+                          'sets.users': [[990, 5.0], [1020, 3.0]]})
+
+    def test_timers(self):
+        self.record(1000, timers={'api.latency':
+                                  samples.Samples([1.0, 3.0], 4)})
+        self.assertEqual(self.history.query('timers.api.latency.*', 1000,
+                                            1000, 10),
+                         {'timers.api.latency.count': [[1000, 4.0]],
+                          'timers.api.latency.max': [[1000, 3.0]],
+                          'timers.api.latency.mean': [[1000, 2.0]],
+                          'timers.api.latency.min': [[1000, 1.0]]})
+
+    def test_periods_without_values(self):
+        self.record(1000, {'api.hits': 1})
+        self.record(1010, {'other': 1})
+        self.record(1020, {'api.hits': 3})
+        self.assertEqual(self.history.query('counters.api.hits', 1000, 1020,
+                                            10),
+                         {'counters.api.hits': [[1000, 1.0], [1010, None],
+                                                [1020, 3.0]]})
+
+    def test_glob_matching(self):
+        self.record(1000, {'api.hits': 1, 'api.misses': 1, 'web.hits': 1})
+        self.assertEqual(self.history.match('counters.api.*'),
+                         ['counters.api.hits', 'counters.api.misses'])
+        self.assertEqual(self.history.match('counters.*.hits'),
+                         ['counters.api.hits', 'counters.web.hits'])
+
+    def test_series_expire_after_the_retention(self):
+        self.record(1000, {'old': 1})
+        for timestamp in range(1010, 1400, 10):
+            self.record(timestamp, {'new': 1})
+        self.assertEqual(self.history.match('counters.*'), ['counters.new'])
+
+    def test_max_series(self):
+        self.history = history.History(dict(TIERS, max_series=1), 10)
+        self.record(1000, {'api.hits': 1, 'api.misses': 1})
+        self.assertEqual(len(self.history.match('counters.api.*')), 1)
+        self.assertEqual(self.history.usage()[::2], (1, 1))
+
+    def test_dropped_keys_are_counted_once_per_interval(self):
+        self.history = history.History(dict(TIERS, max_series=1), 10)
+        timers = {'api.latency': samples.Samples([1.0, 2.0])}
+        self.record(1000, {'api.hits': 1}, timers=timers)
+        self.record(1010, {'api.hits': 1}, timers=timers)
+        self.assertEqual(self.history.usage()[2], 1)
+        self.assertEqual(self.history.usage()[2], 0)
+        self.record(1020, {'api.hits': 1}, timers=timers)
+        self.assertEqual(self.history.usage()[2], 1)
+
+    def test_unknown_resolution(self):
+        self.assertRaises(ValueError, self.history.query, 'counters.*', 1000,
+                          1010, 60)
+
+    def test_no_retention(self):
+        self.assertRaises(ValueError, history.History,
+                          {'tiers': [{'resolution': 10}]}, 10)
+
+
+class HistoryHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.history = history.History(TIERS, 10)
+        self.history.record(1000, {'api.hits': 1}, {}, {}, {})
+        return web.Application([(r'/history', servers.HistoryHandler,
+                                 {'callback': self.history.query})])
+
+    def test_query(self):
+        response = self.fetch('/history?target=counters.api.hits'
+                              '&from=1000&until=1000&resolution=10')
+        self.assertEqual(json.loads(response.body),
+                         {'counters.api.hits': [[1000, 1.0]]})
+
+    def test_invalid_query(self):
+        with mock.patch('tornado.web.gen_log'):
+            response = self.fetch('/history?target=counters.*&resolution=60')
+        self.assertEqual(response.code, 400)
@@ -0,0 +1,171 @@
+"""
+Tests for encoding the InfluxDB line protocol and writing it to a local HTTP
+stand-in for InfluxDB
+
+"""
+import BaseHTTPServer
+import gzip
+import mock
+import SocketServer
+import StringIO
+import threading
+import unittest
+
+from cardiff.backends import influxdb
+from cardiff import samples
+from cardiff import series
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        with self.server.lock:
+            status = self.server.statuses.pop(0) if self.server.statuses \
+                else 204
+            self.server.requests.append((self.path, status, body))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class InfluxDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Record the write requests, responding with the queued statuses and
+    then 204.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, statuses=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.requests = list()
+        self.statuses = list(statuses or [])
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def lines(self):
+        """Return the written lines, leaving out the internal stats"""
+        return sorted([line for path, status, body in self.requests
+                       if status < 300 for line in body.split('\n')
+                       if not line.startswith('cardiff.')])
+
+
+class EncodingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = influxdb.InfluxDBBackend({}, 10)
+
+    def test_tags_are_escaped(self):
+        key = series.Series('api hits,total', (('env', 'prod=1'),
+                                               ('canary', '')), 1)
+        self.assertEqual(list(self.backend.value_lines(
+            self.backend.metric_values({key: 2}, 'counters'), ' 100')),
+            [r'api\ hits\,total,env=prod\=1,canary=true value=2.0 100'])
+
+    def test_values_that_can_not_be_written_are_skipped(self):
+        values = {series.Series('nan', (), 1): float('nan'),
+                  series.Series('inf', (), 2): float('inf'),
+                  series.Series('none', (), 3): None}
+        self.assertEqual(list(self.backend.value_lines(
+            self.backend.metric_values(values, 'gauges'), ' 100')), [])
+
+    def test_timer_fields(self):
+        line = list(self.backend.timer_lines(self.backend.metric_values(
+            {series.Series('latency', (), 1):
+             samples.Samples([10.0, 20.0], 4)}, 'timers'), ' 100'))[0]
+        name, fields, timestamp = line.split(' ')
+        self.assertEqual(name, 'latency')
+        self.assertEqual(timestamp, '100')
+        fields = dict([field.split('=') for field in fields.split(',')])
+        self.assertEqual(sorted(fields), sorted(influxdb.TIMER_FIELDS))
+        self.assertEqual(fields['count'], '4.0')
+        self.assertEqual(fields['mean'], '15.0')
+
+    def test_prefix_and_internal_host_tag(self):
+        backend = influxdb.InfluxDBBackend({'prefix': 'app'}, 10)
+        self.assertEqual(backend.format_internal_name(
+            'counters', ('controller', 'node a', 'packets')),
+            r'app.cardiff.controller.packets,host=node\ a')
+
+
+class WriteTests(unittest.TestCase):
+
+    def tearDown(self):
+        for index in xrange(self.backend.concurrency):
+            self.backend.close(index)
+        self.server.close()
+
+    def deliver(self, statuses=None, batch_size=2, count=5, **config):
+        self.server = InfluxDB(statuses)
+        config = dict({'port': self.server.server_address[1],
+                       'batch_size': batch_size, 'concurrency': 2,
+                       'backoff': 0}, **config)
+        with mock.patch.object(influxdb, 'LOGGER') as self.log:
+            self.backend = influxdb.InfluxDBBackend(config, 10)
+            self.backend.deliver(100, dict([(series.Series('key.%i' % index,
+                                                           (), index), index)
+                                            for index in range(count)]),
+                                 {}, {}, {}, {}, {}, {})
+        return self.backend.internal_stats({}, {}, {})[0]
+
+    def counter(self, stats, name):
+        return stats[self.backend.internal_key(name)]
+
+    def test_batches_are_written(self):
+        stats = self.deliver(gzip=True)
+        self.assertEqual(self.server.lines,
+                         ['key.%i value=%r 100' % (index, float(index))
+                          for index in range(5)])
+        # Each flush also writes the 7 internal stats of the backend
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.requests[0][0],
+                         '/write?db=cardiff&precision=s')
+        self.assertEqual(self.counter(stats, influxdb.BATCHES), 6)
+        self.assertEqual(self.counter(stats, influxdb.LINES), 12)
+        self.assertEqual(self.counter(stats, influxdb.FAILED), 0)
+
+    def test_server_errors_are_retried(self):
+        stats = self.deliver([503, 500], gzip=False)
+        self.assertEqual(len(self.server.lines), 5)
+        self.assertEqual(self.counter(stats, influxdb.RETRIED), 2)
+        self.assertEqual(self.counter(stats, influxdb.FAILED), 0)
+
+    def test_rejected_batches_are_not_retried(self):
+        stats = self.deliver([400], batch_size=20)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.counter(stats, influxdb.RETRIED), 0)
+        self.assertEqual(self.counter(stats, influxdb.FAILED), 1)
+
+    def test_batches_fail_after_the_retries(self):
+        stats = self.deliver([503] * 4, batch_size=20, retries=3)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.lines, [])
+        self.assertEqual(self.counter(stats, influxdb.RETRIED), 3)
+        self.assertEqual(self.counter(stats, influxdb.FAILED), 1)
+
+    def test_connection_errors_are_retried(self):
+        self.server = InfluxDB()
+        self.server.close()
+        with mock.patch.object(influxdb, 'LOGGER') as log:
+            self.backend = influxdb.InfluxDBBackend(
+                {'port': self.server.server_address[1], 'retries': 2,
+                 'backoff': 0, 'concurrency': 1}, 10)
+            self.assertFalse(self.backend.write(0, ['key value=1.0 100']))
+        self.assertEqual(log.warning.call_count, 3)
+        self.server = InfluxDB()
+        self.assertEqual(self.backend.internal_stats({}, {}, {})[0][
+            self.backend.internal_key(influxdb.FAILED)], 1)
@@ -0,0 +1,44 @@
+"""
+Tests for the logger backend
+
+"""
+import mock
+import unittest
+
+from cardiff.backends import logger
+from cardiff import series
+
+
+class DeliverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = logger.LoggerBackend({}, 10)
+        self.key = series.Series('users', (), 1)
+
+    def deliver(self, sets):
+        with mock.patch.object(logger, 'LOGGER') as log:
+            self.backend.deliver(0, {}, {}, sets, {}, {}, {}, {})
+        return [call[0] for call in log.info.call_args_list]
+
+    def test_set_members_are_logged(self):
+        calls = self.deliver({self.key: {'alice': 2, 'bob': 1}})
+        self.assertIn(('Set %s %s=%s', self.key, 'count', 2), calls)
+
+    def test_numeric_set_members_are_bucketed(self):
+        calls = self.deliver({self.key: {'1.5': 1, '2': 3}})
+        self.assertIn(('Set %s %s=%s', self.key, 'histogram',
+                       {'1500': 1, '2000': 1}), calls)
+
+    def test_empty_set(self):
+        calls = self.deliver({self.key: {}})
+        self.assertIn(('Set %s %s=%s', self.key, 'count', 0), calls)
+
+
+class CalcSetValuesTests(unittest.TestCase):
+
+    def test_values(self):
+        backend = logger.LoggerBackend({}, 10)
+        values = backend.calc_set_values({'b': 1, 'a': 4})
+        self.assertEqual(values['count'], 2)
+        self.assertEqual(values['count_ps'], 0.2)
+        self.assertEqual(values['values'], {'b': 1, 'a': 4})
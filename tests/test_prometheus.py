@@ -0,0 +1,104 @@
+"""
+Tests for rendering the Prometheus text exposition
+
+"""
+import gzip
+import mock
+import StringIO
+import unittest
+
+from tornado import testing
+from tornado import web
+
+from cardiff.backends import prometheus
+from cardiff import samples
+from cardiff import series
+
+
+class RenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = prometheus.PrometheusBackend({'ttl': 60}, 10)
+        self.backend.hostname = 'node'
+
+    def deliver(self, timestamp, counters=None, gauges=None, sets=None,
+                timers=None):
+        with mock.patch.object(prometheus, 'LOGGER') as log:
+            self.backend.deliver(timestamp, counters or {}, gauges or {},
+                                 sets or {}, timers or {}, {}, {}, {})
+        self.log = log
+        return [line for line in self.backend.exposition[0].split('\n')
+                if 'cardiff_' not in line]
+
+    def test_counters_are_totals_with_tags_as_labels(self):
+        key = series.Series('api.hits', (('env', 'prod'), ('ssl', '')), 1)
+        self.deliver(100, counters={key: 2})
+        lines = self.deliver(110, counters={key: 3})
+        self.assertIn('# TYPE api_hits_total counter', lines)
+        self.assertIn('api_hits_total{env="prod",ssl="true"} 5.0', lines)
+
+    def test_gauges_and_sets(self):
+        lines = self.deliver(100, gauges={series.Series('load', (), 1): 3},
+                             sets={series.Series('users', (), 2):
+                                   {'alice': 1, 'bob': 2}})
+        self.assertIn('# TYPE load gauge', lines)
+        self.assertIn('load 3.0', lines)
+        self.assertIn('users 2.0', lines)
+
+    def test_timers_are_summaries(self):
+        key = series.Series('latency', (), 1)
+        self.deliver(100, timers={key: samples.Samples([10.0, 20.0], 4)})
+        lines = self.deliver(110, timers={key: samples.Samples([30.0])})
+        self.assertIn('# TYPE latency summary', lines)
+        self.assertIn('latency{quantile="0.5"} 30.0', lines)
+        self.assertIn('latency_sum 90.0', lines)
+        self.assertIn('latency_count 5.0', lines)
+
+    def test_expired_series_are_removed(self):
+        self.deliver(100, gauges={series.Series('load', (), 1): 3})
+        lines = self.deliver(200, gauges={series.Series('queue', (), 2): 1})
+        self.assertNotIn('load 3.0', lines)
+        self.assertIn('queue 1.0', lines)
+
+    def test_conflicting_types_are_left_out(self):
+        lines = self.deliver(100, counters={series.Series('foo', (), 1): 1},
+                             gauges={series.Series('foo_total', (), 2): 7})
+        self.assertIn('# TYPE foo_total counter', lines)
+        self.assertIn('foo_total 1.0', lines)
+        self.assertNotIn('foo_total 7.0', lines)
+        self.assertTrue(self.log.warning.called)
+        self.deliver(110, counters={series.Series('foo', (), 1): 1},
+                     gauges={series.Series('foo_total', (), 2): 7})
+        self.assertFalse(self.log.warning.called)
+
+    def test_summary_sample_names_conflict(self):
+        lines = self.deliver(100, gauges={series.Series('latency_count', (),
+                                                        1): 7},
+                             timers={series.Series('latency', (), 2):
+                                     samples.Samples([1.0])})
+        self.assertIn('latency_count 7.0', lines)
+        self.assertNotIn('# TYPE latency summary', lines)
+        self.assertTrue(self.log.warning.called)
+
+
+class ScrapeTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.backend = prometheus.PrometheusBackend({}, 10)
+        self.backend.exposition = 'load 3.0\n', \
+            self.backend.compress('load 3.0\n')
+        return web.Application([(prometheus.PATH, prometheus.ScrapeHandler,
+                                 {'backend': self.backend})])
+
+    def test_plain(self):
+        response = self.fetch(prometheus.PATH)
+        self.assertEqual(response.headers['Content-Type'],
+                         prometheus.CONTENT_TYPE)
+        self.assertEqual(response.body, 'load 3.0\n')
+
+    def test_gzip(self):
+        response = self.fetch(prometheus.PATH, use_gzip=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(response.body)).read()
+        self.assertEqual(body, 'load 3.0\n')
@@ -0,0 +1,72 @@
+"""
+Tests for the bulk ingest HTTP endpoint
+
+"""
+import gzip
+import json
+import mock
+import StringIO
+import zlib
+
+from tornado import testing
+from tornado import web
+
+from cardiff import controller
+from cardiff import servers
+
+
+def compress(value):
+    buffer = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as handle:
+        handle.write(value)
+    return buffer.getvalue()
+
+
+class BulkIngestTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.cardiff = controller.standalone(10)
+        return web.Application([(r'/metrics', servers.BulkIngestHandler,
+                                 {'callback': self.cardiff.process_lines})])
+
+    def post(self, body, encoding=None):
+        headers = {'Content-Encoding': encoding} if encoding else {}
+        with mock.patch.object(controller, 'LOGGER'):
+            with mock.patch.object(servers, 'LOGGER'):
+                return self.fetch('/metrics', method='POST', body=body,
+                                  headers=headers)
+
+    def counters(self):
+        return dict([(str(key), value) for key, value
+                     in self.cardiff.snapshot()[1].iteritems()])
+
+    def test_plain(self):
+        response = self.post('hits:1|c\nhits:2|c\nbad\n')
+        self.assertEqual(json.loads(response.body),
+                         {'accepted': 2, 'rejected': 1})
+        self.assertEqual(self.counters(), {'hits': 3})
+
+    def test_gzip(self):
+        lines = '\n'.join(['key.%i:1|c' % value for value in range(20000)])
+        response = self.post(compress(lines), 'gzip')
+        self.assertEqual(json.loads(response.body),
+                         {'accepted': 20000, 'rejected': 0})
+        self.assertEqual(len(self.counters()), 20000)
+
+    def test_deflate(self):
+        response = self.post(zlib.compress('hits:1|c'), 'deflate')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.counters(), {'hits': 1})
+
+    def test_corrupt_body_is_not_aggregated(self):
+        lines = '\n'.join(['key.%i:1|c' % value for value in range(20000)])
+        body = compress(lines)
+        body = body[:len(body) // 2] + 'x' * 100 + body[len(body) // 2 + 100:]
+        self.assertEqual(self.post(body, 'gzip').code, 400)
+        self.assertEqual(self.counters(), {})
+
+    def test_truncated_body_is_not_aggregated(self):
+        lines = '\n'.join(['key.%i:1|c' % value for value in range(20000)])
+        body = compress(lines)
+        self.assertEqual(self.post(body[:len(body) // 2], 'gzip').code, 400)
+        self.assertEqual(self.counters(), {})
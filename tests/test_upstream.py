@@ -0,0 +1,87 @@
+"""
+Tests for sending metrics to an upstream cardiff and merging them there
+
+"""
+import mock
+import pickle
+import unittest
+
+from cardiff.backends import upstream
+from cardiff import controller
+from cardiff import samples
+from cardiff import series
+
+
+class UpstreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tagged = series.Series('hits', (('env', 'prod'),), 1)
+        self.key = series.Series('load', (), 2)
+        self.timer = series.Series('latency', (), 3)
+        self.stats = [1400000000,
+                      {self.tagged: 3, series.Series('hits', (), 4): 2},
+                      {self.key: -5},
+                      {series.Series('users', (), 5): {'alice': 2}},
+                      {self.timer: samples.Samples([10.0, 20.0], 8)},
+                      {('controller', 'node', 'packets'): 10},
+                      {},
+                      {('controller', 'node', 'flush'): [1.5]}]
+
+    def frames(self, config):
+        backend = upstream.UpstreamBackend(config, 10)
+        backend.hostname = 'node'
+        with mock.patch.object(upstream, 'LOGGER'):
+            with mock.patch.object(backend, 'connect'):
+                backend.socket = mock.Mock()
+                backend.deliver(*self.stats)
+        frames = [call[0][0] for call in backend.socket.sendall.call_args_list]
+        for frame in frames:
+            self.assertEqual(frame[-1], chr(upstream.UpstreamBackend.FRAME_END))
+        return [pickle.loads(frame[:-1]) for frame in frames]
+
+    def merge(self, frames):
+        cardiff = controller.standalone(10)
+        with mock.patch.object(controller, 'LOGGER'):
+            for frame in frames:
+                cardiff.downstream_data(**frame)
+        stats = cardiff.snapshot()
+        return [dict([(str(key), value) for key, value in values.iteritems()])
+                for values in stats[1:5]] + stats[5:]
+
+    def test_single_legacy_frame_by_default(self):
+        frames = self.frames({'host': 'localhost'})
+        self.assertEqual(len(frames), 1)
+        frame = frames[0]
+        key = [key for key in frame['counters'] if key != self.tagged][0]
+        self.assertIs(type(key), str)
+        self.assertIs(type(frame['timers']['latency']), list)
+        self.assertEqual(frame['internal']['counters']['controller'],
+                         {'node': {'packets': 10}})
+        self.assertEqual(frame['internal']['gauges']['backend']['node']
+                         ['upstream.flush_timestamp'], 1400000000)
+
+    def test_legacy_frame_is_merged(self):
+        counters, gauges, sets, timers, int_counters, int_gauges, \
+            int_timers = self.merge(self.frames({'host': 'localhost'}))
+        self.assertEqual(counters, {'hits': 2, 'hits;env=prod': 3})
+        self.assertEqual(gauges, {'load': -5})
+        self.assertEqual(sets, {'users': {'alice': 2}})
+        self.assertEqual(list(timers['latency']), [10.0, 20.0])
+        self.assertEqual(timers['latency'].weight, 2)
+        self.assertEqual(int_counters[('controller', 'node', 'packets')], 10)
+        self.assertEqual(int_counters[('backend', 'node',
+                                       'upstream.exceptions')], 0)
+        self.assertEqual(int_timers[('controller', 'node', 'flush')], [1.5])
+
+    def test_framed_current_format_is_merged(self):
+        frames = self.frames({'host': 'localhost', 'frame_size': 2,
+                              'legacy_format': False})
+        self.assertEqual(len(frames), 3)
+        self.assertIn(('controller', 'node', 'packets'),
+                      frames[0]['internal']['counters'])
+        self.assertEqual(frames[1]['internal'], {})
+        counters, gauges, sets, timers, int_counters, int_gauges, \
+            int_timers = self.merge(frames)
+        self.assertEqual(counters, {'hits': 2, 'hits;env=prod': 3})
+        self.assertEqual(timers['latency'].weight, 8)
+        self.assertEqual(int_counters[('controller', 'node', 'packets')], 10)
@@ -0,0 +1,138 @@
+"""
+Tests for the backend worker processes
+
+"""
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tornado import ioloop
+
+from cardiff.backends import base
+from cardiff import admin
+from cardiff import samples
+from cardiff import series
+from cardiff import workers
+
+
+class EncodeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.key = series.Series('requests', (('host', 'a'), ('ssl', '')), 7)
+        self.stats = [1400000000,
+                      {self.key: 5, 'plain': 1.5},
+                      {self.key: None},
+                      {self.key: {'alice': 2, 'bob': 1}},
+                      {self.key: samples.Samples([1.0, 2.5], 20)},
+                      {('controller', 'host', 'packets'): 10},
+                      {('controller', 'host', 'keys'): 2.5},
+                      {('backend', 'host', 'logger'): [1.5, 2.0]}]
+
+    def decode(self, decoder=None):
+        return (decoder or workers.Decoder()).decode(
+            workers.encode(self.stats))
+
+    def test_roundtrip(self):
+        stats = self.decode()
+        self.assertEqual(stats[0], 1400000000)
+        self.assertEqual(stats[1], {self.key: 5, 'plain': 1.5})
+        self.assertIsInstance(stats[1][self.key], int)
+        self.assertEqual(stats[2], {self.key: None})
+        self.assertEqual(stats[3], {self.key: {'alice': 2, 'bob': 1}})
+        self.assertEqual(list(stats[4][self.key]), [1.0, 2.5])
+        self.assertEqual(stats[4][self.key].weight, 20)
+        self.assertEqual(stats[5], {('controller', 'host', 'packets'): 10})
+        self.assertEqual(stats[6], {('controller', 'host', 'keys'): 2.5})
+        self.assertEqual(list(stats[7][('backend', 'host', 'logger')]),
+                         [1.5, 2.0])
+
+    def test_series_are_restored(self):
+        key = self.decode()[1].keys()
+        key = [value for value in key if value != 'plain'][0]
+        self.assertEqual(key.id, 7)
+        self.assertEqual(series.name(key), 'requests')
+        self.assertEqual(series.tags(key), (('host', 'a'), ('ssl', '')))
+
+    def test_series_are_reused(self):
+        decoder = workers.Decoder()
+        first = [key for key in self.decode(decoder)[1] if key != 'plain']
+        second = [key for key in self.decode(decoder)[1] if key != 'plain']
+        self.assertIs(first[0], second[0])
+
+    def test_invalid_snapshot(self):
+        self.assertRaises(ValueError, workers.Decoder().decode,
+                          'X' * workers.HEADER.size)
+
+
+class Crash(base.Backend):
+    name = 'crash'
+
+    def deliver(self, *args):
+        os._exit(3)
+
+
+class Echo(base.Backend):
+    name = 'echo'
+
+    def deliver(self, *args):
+        pass
+
+
+class WorkersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ioloop = ioloop.IOLoop()
+        self.delivered = list()
+        self.spawner = workers.Spawner([Crash({}, 10), Echo({}, 10)])
+        self.spawner.start()
+        self.workers = workers.Workers(self.spawner, self.ioloop,
+                                       self.on_delivered, self.directory,
+                                       restart_delay=0.1)
+        self.workers.start()
+
+    def tearDown(self):
+        self.workers.stop()
+        self.ioloop.close()
+        shutil.rmtree(self.directory)
+
+    def on_delivered(self, name, duration, error):
+        self.delivered.append((name, error))
+
+    def run_ioloop(self, seconds):
+        self.ioloop.add_timeout(time.time() + seconds, self.ioloop.stop)
+        self.ioloop.start()
+
+    def test_workers_are_not_children_of_the_controller(self):
+        for worker in self.workers.workers.values():
+            self.assertNotEqual(worker.pid, self.spawner.process.pid)
+            self.assertRaises(OSError, os.waitpid, worker.pid, os.WNOHANG)
+
+    def test_exited_workers_are_restarted(self):
+        pid = self.workers.workers['crash'].pid
+        with mock.patch.object(workers, 'LOGGER'):
+            self.workers.deliver([0, {}, {}, {}, {}, {}, {}, {}])
+            self.run_ioloop(1)
+        self.assertEqual(self.delivered, [('echo', None)])
+        worker = self.workers.workers['crash']
+        self.assertTrue(worker.alive)
+        self.assertNotEqual(worker.pid, pid)
+        self.assertEqual(self.workers.usage()['crash'], (0, 1, 0))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_admin_reports_the_worker_status(self):
+        with mock.patch.object(workers, 'LOGGER'):
+            self.workers.deliver([0, {}, {}, {}, {}, {}, {}, {}])
+            self.run_ioloop(1)
+        controller = mock.Mock(workers=self.workers,
+                               backends=[Crash({}, 10), Echo({}, 10)],
+                               backend_health={})
+        lines = admin.Admin(controller).backends()
+        self.assertIn('crash: worker=alive pid=%i pending=0 exits=1 ' %
+                      self.workers.workers['crash'].pid, lines[0])
+        self.assertIn('echo: worker=alive pid=%i pending=0 exits=0 ' %
+                      self.workers.workers['echo'].pid, lines[1])
+        self.assertNotIn('exceptions', lines[0])